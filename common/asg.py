@@ -0,0 +1,116 @@
+# Copyright 2013-2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You may not use this file except in compliance with the
+# License. A copy of the License is located at
+#
+# http://aws.amazon.com/apache2.0/
+#
+# or in the "LICENSE.txt" file accompanying this file. This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+# OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import random
+import time
+
+log = logging.getLogger(__name__)
+
+
+class AsgStateCache(object):
+    """
+    Cache of the ASG limits and desired capacity, used to limit the calls to the Auto Scaling APIs.
+
+    The cached state is refreshed by describe_auto_scaling_groups when older than ttl seconds, and updated in place by
+    the writes performed through set_desired_capacity. Writes are sent only if the desired capacity actually changes
+    and at most once every min_update_interval seconds. The desired capacity is also lowered by the ASG itself when
+    instances are terminated with ShouldDecrementDesiredCapacity, so an update is skipped only if the state is younger
+    than max_staleness seconds and already has the requested value.
+    """
+
+    def __init__(self, asg_client, asg_name, ttl=60, ttl_jitter=0, min_update_interval=0, max_staleness=None):
+        """
+        :param asg_client: ASG boto3 client
+        :param asg_name: name of the ASG
+        :param ttl: maximum age of the cached state in seconds
+        :param ttl_jitter: randomization of the ttl, as a fraction of it, to spread the refreshes of many clients
+        :param min_update_interval: minimum time between two updates of the desired capacity, in seconds
+        :param max_staleness: maximum age of a cached desired capacity trusted to skip an update, in seconds, the ttl
+            if None
+        """
+        self.asg_client = asg_client
+        self.asg_name = asg_name
+        self.ttl = ttl
+        self.ttl_jitter = ttl_jitter
+        self.min_update_interval = min_update_interval
+        self.max_staleness = max_staleness if max_staleness is not None else ttl
+        self._state = None
+        self._updated = 0
+        self._expiration = 0
+        self._last_update = 0
+
+    def _refresh(self):
+        asg = self.asg_client.describe_auto_scaling_groups(AutoScalingGroupNames=[self.asg_name]).get(
+            'AutoScalingGroups'
+        )[0]
+        self._update_state(
+            {'MinSize': asg.get('MinSize'), 'DesiredCapacity': asg.get('DesiredCapacity'), 'MaxSize': asg.get('MaxSize')}
+        )
+
+    def _update_state(self, state):
+        self._state = state
+        self._updated = time.time()
+        self._expiration = self._updated + self.ttl * (1 + random.uniform(-self.ttl_jitter, self.ttl_jitter))
+
+    def get(self, force_refresh=False, max_age=None):
+        """
+        Get the ASG state, refreshing it if expired.
+
+        :param force_refresh: True to refresh the state regardless of its age
+        :param max_age: refresh the state if older than max_age seconds, even if not expired yet
+        :return: a dictionary with MinSize, DesiredCapacity and MaxSize
+        """
+        now = time.time()
+        if (force_refresh or self._state is None or now >= self._expiration or
+                (max_age is not None and now - self._updated >= max_age)):
+            self._refresh()
+            log.debug("Refreshed state of ASG %s: %s" % (self.asg_name, self._state))
+        return self._state
+
+    def set(self, state):
+        """
+        Seed the cache with a state obtained elsewhere, e.g. published by the master node.
+
+        :param state: a dictionary with MinSize, DesiredCapacity and MaxSize
+        """
+        self._update_state(dict(state))
+
+    def invalidate(self):
+        """Force a refresh on the next access."""
+        self._expiration = 0
+
+    def set_desired_capacity(self, desired):
+        """
+        Update the ASG desired capacity, unless it already has the requested value or it was updated too recently.
+
+        :param desired: the new desired capacity
+        :return: True if the ASG has been updated
+        """
+        state = self.get()
+        if desired == state.get('DesiredCapacity'):
+            # the cached value may be stale
+            state = self.get(max_age=self.max_staleness)
+        if desired == state.get('DesiredCapacity'):
+            log.debug("Desired capacity of ASG %s is already %d. Skipping update" % (self.asg_name, desired))
+            return False
+
+        since_last_update = time.time() - self._last_update
+        if since_last_update < self.min_update_interval:
+            log.info("ASG %s updated %d seconds ago. Deferring update of desired capacity to %d"
+                     % (self.asg_name, since_last_update, desired))
+            return False
+
+        self.asg_client.update_auto_scaling_group(AutoScalingGroupName=self.asg_name, DesiredCapacity=desired)
+        self._last_update = time.time()
+        state = dict(state, DesiredCapacity=desired)
+        self._update_state(state)
+        return True
@@ -0,0 +1,85 @@
+# Copyright 2013-2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You may not use this file except in compliance with the
+# License. A copy of the License is located at
+#
+# http://aws.amazon.com/apache2.0/
+#
+# or in the "LICENSE.txt" file accompanying this file. This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+# OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Cluster state published by the master node on the shared filesystem.
+
+jobwatcher periodically writes what it knows about the cluster (ASG limits, stack readiness, ...) to a JSON file, so
+that compute nodes can read it instead of each calling the AWS APIs.
+
+The time of the last scale-out lets the nodes hold the release of idle nodes for a while after jobwatcher asked for
+more nodes, so that they are not terminated right before the next wave of jobs and replaced by booting nodes.
+"""
+
+import json
+import logging
+import time
+
+from common.utils import atomic_write
+
+log = logging.getLogger(__name__)
+
+
+def write_cluster_state(path, state):
+    """
+    Publish the cluster state, stamped with the current time.
+
+    :param path: path of the state file on the shared filesystem
+    :param state: dictionary to publish
+    """
+    state = dict(state, timestamp=time.time())
+    try:
+        atomic_write(path, json.dumps(state))
+    except (IOError, OSError) as e:
+        log.warning("Unable to publish cluster state to %s: %s" % (path, e))
+
+
+def read_cluster_state(path, max_age):
+    """
+    Read the cluster state published by the master node.
+
+    :param path: path of the state file on the shared filesystem
+    :param max_age: maximum age of the state in seconds
+    :return: the state dictionary, or None if the state is not available or older than max_age
+    """
+    try:
+        with open(path) as f:
+            state = json.load(f)
+    except (IOError, ValueError) as e:
+        log.debug("Cluster state %s not available: %s" % (path, e))
+        return None
+
+    age = time.time() - state.get('timestamp', 0)
+    if age > max_age:
+        log.info("Ignoring cluster state %s published %d seconds ago" % (path, age))
+        return None
+    return state
+
+
+def get_scalein_delay(last_scale_out, scalein_cooldown, launch_time=None, min_node_lifetime=0, now=None):
+    """
+    Get how long an idle node must still be kept, after a recent scale-out or a recent launch of the node.
+
+    :param last_scale_out: time of the last scale-out decision of jobwatcher, None if unknown
+    :param scalein_cooldown: seconds after a scale-out during which idle nodes are not released
+    :param launch_time: launch time of the node, None if unknown
+    :param min_node_lifetime: seconds after its launch during which a node is not released
+    :param now: current time, defaults to time.time()
+    :return: the number of seconds before the node can be released, 0 if it can be released now
+    """
+    now = time.time() if now is None else now
+    delay = 0
+    # times in the future, e.g. clocks of the master and compute nodes out of sync, don't extend the hold
+    if last_scale_out and scalein_cooldown > 0:
+        delay = max(delay, min(last_scale_out + scalein_cooldown - now, scalein_cooldown))
+    if launch_time and min_node_lifetime > 0:
+        delay = max(delay, min(launch_time + min_node_lifetime - now, min_node_lifetime))
+    return delay
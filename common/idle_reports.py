@@ -0,0 +1,93 @@
+# Copyright 2013-2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You may not use this file except in compliance with the
+# License. A copy of the License is located at
+#
+# http://aws.amazon.com/apache2.0/
+#
+# or in the "LICENSE.txt" file accompanying this file. This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+# OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Idle reports written by the compute nodes on the shared filesystem.
+
+When the master-side reaper is enabled, nodewatcher does not terminate its own instance: it reports that the node has
+been idle for longer than scaledown_idletime and jobwatcher decides which nodes to release.
+"""
+
+import errno
+import json
+import logging
+import os
+import time
+
+from common.utils import atomic_write
+
+log = logging.getLogger(__name__)
+
+
+def write_idle_report(reports_dir, instance_id, hostname, idle_time, launch_time=None):
+    """
+    Report the node as idle, refreshing the report timestamp.
+
+    :param reports_dir: shared directory containing the idle reports
+    :param instance_id: the instance id of the node
+    :param hostname: the hostname of the node
+    :param idle_time: how long the node has been idle, in seconds
+    :param launch_time: launch time of the node, None if unknown
+    """
+    report = {
+        'instance_id': instance_id, 'hostname': hostname, 'idle_time': idle_time, 'launch_time': launch_time,
+        'timestamp': time.time(),
+    }
+    try:
+        atomic_write(os.path.join(reports_dir, '%s.json' % instance_id), json.dumps(report))
+    except (IOError, OSError) as e:
+        log.warning("Unable to write idle report in %s: %s" % (reports_dir, e))
+
+
+def remove_idle_report(reports_dir, instance_id):
+    """
+    Withdraw the idle report of the node, if any.
+
+    :param reports_dir: shared directory containing the idle reports
+    :param instance_id: the instance id of the node
+    """
+    try:
+        os.remove(os.path.join(reports_dir, '%s.json' % instance_id))
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            log.warning("Unable to remove idle report of %s: %s" % (instance_id, e))
+
+
+def read_idle_reports(reports_dir, max_age):
+    """
+    Read the idle reports refreshed in the last max_age seconds.
+
+    :param reports_dir: shared directory containing the idle reports
+    :param max_age: maximum age of a report in seconds, older reports come from dead or hung nodes
+    :return: the list of reports, longest idle first
+    """
+    reports = []
+    now = time.time()
+    try:
+        names = os.listdir(reports_dir)
+    except OSError as e:
+        log.warning("Unable to read idle reports from %s: %s" % (reports_dir, e))
+        return reports
+
+    for name in names:
+        if not name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(reports_dir, name)) as f:
+                report = json.load(f)
+        except (IOError, ValueError):
+            # being replaced or removed by the node
+            continue
+        if now - report.get('timestamp', 0) <= max_age:
+            reports.append(report)
+
+    reports.sort(key=lambda report: report.get('idle_time'), reverse=True)
+    return reports
@@ -0,0 +1,245 @@
+# Copyright 2013-2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You may not use this file except in compliance with the
+# License. A copy of the License is located at
+#
+# http://aws.amazon.com/apache2.0/
+#
+# or in the "LICENSE.txt" file accompanying this file. This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+# OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Scale-up latency breakdown.
+
+Each daemon appends the scale-up stages it observes to its own JSON lines file in a shared directory:
+
+- jobwatcher: scale_up, when it raises the ASG desired capacity, with the requested capacity
+- sqswatcher: compute_ready, when it receives the COMPUTE_READY event of an instance, with the time the event was sent,
+  and host_added, when the instance has been added to the scheduler, with the EC2 launch time
+- nodewatcher: first_job, when the node runs its first job, with the submission time of the jobs when available
+
+Records are keyed by instance id and job id, the report correlates them to compute the latency of each stage:
+
+- detection: job submission to the scale-up decision that launched the instance
+- asg_launch: scale-up decision to EC2 launch time
+- boot: EC2 launch time to the COMPUTE_READY event sent by the node
+- sqs_delivery: COMPUTE_READY event sent to received by sqswatcher
+- add_host: COMPUTE_READY event received to the instance added to the scheduler
+- dispatch: instance added to the scheduler to the first job seen on the node
+- job_start: job submission to the job seen running on a new node
+"""
+
+import argparse
+import bisect
+import calendar
+import glob
+import json
+import logging
+import math
+import numbers
+import os
+import threading
+import time
+from datetime import datetime
+
+log = logging.getLogger(__name__)
+
+stages = ('detection', 'asg_launch', 'boot', 'sqs_delivery', 'add_host', 'dispatch', 'job_start')
+
+
+class LatencyLog(object):
+    """Thread safe writer of the stage records of a daemon."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def record(self, stage, instance_id=None, job_ids=None, timestamp=None, **data):
+        """
+        Append a stage record, never failing the caller.
+
+        :param stage: name of the stage, e.g. scale_up
+        :param instance_id: instance the record refers to, if any
+        :param job_ids: jobs the record refers to, if any
+        :param timestamp: time of the stage in seconds since the epoch, now by default
+        :param data: additional values to record
+        """
+        record = dict(data, stage=stage, timestamp=timestamp if timestamp is not None else time.time())
+        if instance_id:
+            record['instance_id'] = instance_id
+        if job_ids:
+            record['job_ids'] = job_ids
+        line = json.dumps(record) + "\n"
+        try:
+            with self._lock:
+                with open(self.path, 'a') as f:
+                    f.write(line)
+        except (IOError, OSError) as e:
+            log.warning("Unable to write latency record to %s: %s" % (self.path, e))
+
+
+def get_latency_log(directory, name):
+    """
+    Get the stage records writer of a daemon.
+
+    :param directory: shared directory containing the records of all the daemons, None to disable the records
+    :param name: name of the daemon, unique in the cluster
+    :return: a LatencyLog, or None if disabled or the directory is not available
+    """
+    if not directory or directory == 'NONE':
+        return None
+    try:
+        return LatencyLog(os.path.join(directory, '%s.jsonl' % name))
+    except (IOError, OSError) as e:
+        log.warning("Scale-up latency records disabled, unable to create %s: %s" % (directory, e))
+        return None
+
+
+def to_timestamp(value):
+    """
+    Convert the time formats returned by the AWS APIs to seconds since the epoch.
+
+    :param value: a datetime, naive ones being in UTC, an ISO 8601 UTC string like 2019-01-01T00:00:00.000Z, or a number
+    :return: the number of seconds since the epoch, None if value is None
+    """
+    if value is None:
+        return None
+    if isinstance(value, numbers.Number):
+        return float(value)
+    if not isinstance(value, datetime):
+        value = datetime.strptime(value.rstrip('Z'), '%Y-%m-%dT%H:%M:%S.%f' if '.' in value else '%Y-%m-%dT%H:%M:%S')
+    if value.utcoffset() is not None:
+        value = value - value.utcoffset()
+    return calendar.timegm(value.timetuple()) + value.microsecond / 1e6
+
+
+def read_records(paths, since=None):
+    """
+    Read the stage records of the given files, skipping the malformed lines.
+
+    :param paths: list of JSON lines files
+    :param since: ignore the records older than this time, in seconds since the epoch
+    :return: the list of records
+    """
+    records = []
+    for path in paths:
+        try:
+            with open(path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # partial line of a record being written
+                        continue
+                    if since is None or record.get('timestamp', 0) >= since:
+                        records.append(record)
+        except IOError as e:
+            log.warning("Unable to read %s: %s" % (path, e))
+    return records
+
+
+def compute_latencies(records):
+    """
+    Correlate the stage records and compute the latency of each stage.
+
+    Instances are attributed to the last scale-up decision preceding their launch time.
+
+    :param records: list of stage records of all the daemons
+    :return: dictionary stage -> list of latencies in seconds
+    """
+    latencies = dict((stage, []) for stage in stages)
+    decisions = sorted(r['timestamp'] for r in records if r.get('stage') == 'scale_up')
+    instances = {}
+    for record in records:
+        if record.get('instance_id') and record.get('stage') in ('compute_ready', 'host_added', 'first_job'):
+            # keep the first occurrence, events can be delivered more than once
+            instances.setdefault(record['instance_id'], {}).setdefault(record['stage'], record)
+
+    def _add(stage, start, end):
+        if start is not None and end is not None and end >= start:
+            latencies[stage].append(end - start)
+
+    job_starts = {}
+    for instance in instances.values():
+        ready = instance.get('compute_ready', {})
+        added = instance.get('host_added', {})
+        first_job = instance.get('first_job', {})
+        launch_time = added.get('launch_time')
+        decision = None
+        if launch_time is not None:
+            index = bisect.bisect_right(decisions, launch_time)
+            decision = decisions[index - 1] if index else None
+
+        _add('asg_launch', decision, launch_time)
+        _add('boot', launch_time, ready.get('sent_time'))
+        _add('sqs_delivery', ready.get('sent_time'), ready.get('timestamp'))
+        _add('add_host', ready.get('timestamp'), added.get('timestamp'))
+        _add('dispatch', added.get('timestamp'), first_job.get('timestamp'))
+
+        for job_id, submit_time in (first_job.get('submit_times') or {}).items():
+            # a job spanning several nodes started when seen on the first one
+            start = job_starts.get(job_id)
+            if start is None or first_job['timestamp'] < start[1]:
+                job_starts[job_id] = (submit_time, first_job['timestamp'], decision)
+
+    for submit_time, start_time, decision in job_starts.values():
+        if decision is not None and submit_time <= decision:
+            _add('detection', submit_time, decision)
+        _add('job_start', submit_time, start_time)
+    return latencies
+
+
+def percentile(values, percent):
+    """
+    Nearest-rank percentile.
+
+    :param values: list of numbers
+    :param percent: percentile between 0 and 100
+    :return: the percentile, None if values is empty
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    rank = int(math.ceil(percent / 100.0 * len(values)))
+    return values[max(0, min(rank, len(values)) - 1)]
+
+
+def format_report(latencies, percentiles=(50, 90, 99)):
+    """
+    Format the latency percentiles of each stage as a table.
+
+    :param latencies: dictionary stage -> list of latencies in seconds
+    :param percentiles: percentiles to report
+    :return: the report text
+    """
+    header = "%-14s %8s" % ('stage', 'samples') + ''.join("%9s" % ('p%d' % p) for p in percentiles) + "%9s" % 'max'
+    lines = [header]
+    for stage in stages:
+        values = latencies.get(stage, [])
+        columns = [percentile(values, p) for p in percentiles] + [max(values) if values else None]
+        lines.append("%-14s %8d" % (stage, len(values)) +
+                     ''.join("%9s" % ('-' if c is None else '%.1f' % c) for c in columns))
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Report the scale-up latency of each stage, from job submission to "
+                                                 "the job running on a new node.")
+    parser.add_argument("paths", nargs='+',
+                        help="latency_dir of the daemons, or record files written by the daemons")
+    parser.add_argument("--hours", type=float, help="only consider the records of the last hours")
+    args = parser.parse_args()
+
+    files = []
+    for path in args.paths:
+        files.extend(sorted(glob.glob(os.path.join(path, '*.jsonl'))) if os.path.isdir(path) else [path])
+    since = time.time() - args.hours * 3600 if args.hours else None
+    print(format_report(compute_latencies(read_records(files, since))))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,189 @@
+# Copyright 2013-2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You may not use this file except in compliance with the
+# License. A copy of the License is located at
+#
+# http://aws.amazon.com/apache2.0/
+#
+# or in the "LICENSE.txt" file accompanying this file. This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+# OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Shared executor for the scheduler command line tools.
+
+Read-only queries (squeue, qstat, pbsnodes -x, ...) are cached for a short, per-command time to live, and identical
+queries issued concurrently are collapsed into a single process. Any other command is considered mutating: it is
+always executed and it invalidates the cache, so that following queries observe its effects.
+"""
+
+import logging
+import os
+import subprocess
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# seconds a query result is reused, keep it shorter than the polling intervals of the callers
+DEFAULT_TTLS = {
+    'squeue': 2,
+    'sinfo': 2,
+    'scontrol': 2,
+    'qstat': 2,
+    'qconf': 2,
+    'pbsnodes': 2,
+    'bjobs': 2,
+    'bhosts': 2,
+}
+
+
+def _is_query(args):
+    """
+    Tell whether the given command only reads the scheduler state.
+
+    :param args: the command as a list of arguments
+    :return: true if the command doesn't modify the scheduler state
+    """
+    name = os.path.basename(args[0])
+    options = args[1:]
+    if name in ('squeue', 'sinfo', 'qstat', 'bjobs', 'bhosts'):
+        return True
+    if name == 'scontrol':
+        return len(options) > 0 and options[0] == 'show'
+    if name == 'qconf':
+        # qconf -sh, -sel, -sp <pe>, ...
+        return len(options) > 0 and all(not option.startswith('-') or option.startswith('-s') for option in options)
+    if name == 'pbsnodes':
+        return all(option not in ('-o', '-c', '-r', '-N', '-A') for option in options)
+    return False
+
+
+class CommandResult(object):
+    def __init__(self, returncode, output):
+        self.returncode = returncode
+        self.output = output
+
+
+class _InFlight(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class CommandExecutor(object):
+    """Run scheduler commands, caching and deduplicating read-only queries."""
+
+    def __init__(self, ttls=None):
+        """
+        :param ttls: dictionary command name -> time to live of the cached results in seconds, DEFAULT_TTLS if None
+        """
+        self.ttls = dict(DEFAULT_TTLS if ttls is None else ttls)
+        self._lock = threading.Lock()
+        self._cache = {}
+        self._in_flight = {}
+        self._generation = 0
+
+    def invalidate(self):
+        """Drop all the cached results."""
+        with self._lock:
+            self._cache.clear()
+            self._generation += 1
+
+    def run(self, args, env=None, merge_stderr=False):
+        """
+        Run the given command, or return the cached output of an identical recent query.
+
+        :param args: the command as a list of arguments
+        :param env: environment of the command, the current environment if None
+        :param merge_stderr: True to return stderr together with stdout, otherwise stderr is inherited
+        :return: a CommandResult
+        """
+        ttl = self.ttls.get(os.path.basename(args[0]), 0) if _is_query(args) else None
+        if ttl is None:
+            try:
+                return self._execute(args, env, merge_stderr)
+            finally:
+                self.invalidate()
+        if ttl <= 0:
+            return self._execute(args, env, merge_stderr)
+
+        key = (tuple(args), tuple(sorted(env.items())) if env is not None else None, merge_stderr)
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached and time.time() - cached[0] < ttl:
+                log.debug("Using cached output of %s" % args)
+                return cached[1]
+            in_flight = self._in_flight.get(key)
+            owner = in_flight is None
+            if owner:
+                in_flight = _InFlight()
+                self._in_flight[key] = in_flight
+                generation = self._generation
+
+        if not owner:
+            log.debug("Waiting for in-flight %s" % args)
+            in_flight.done.wait()
+            if in_flight.error:
+                raise in_flight.error
+            return in_flight.result
+
+        try:
+            in_flight.result = self._execute(args, env, merge_stderr)
+            return in_flight.result
+        except Exception as e:
+            in_flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+                # don't cache results that may predate a mutating command
+                if in_flight.result is not None and generation == self._generation:
+                    self._cache[key] = (time.time(), in_flight.result)
+            in_flight.done.set()
+
+    @staticmethod
+    def _execute(args, env, merge_stderr):
+        log.debug("Running %s" % args)
+        dev_null = open(os.devnull, "rb")
+        try:
+            process = subprocess.Popen(
+                args,
+                env=env,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT if merge_stderr else None,
+                stdin=dev_null,
+            )
+            output = process.communicate()[0]
+            return CommandResult(process.returncode, output)
+        finally:
+            dev_null.close()
+
+
+executor = CommandExecutor()
+
+
+def run_command(args, env=None, merge_stderr=False):
+    """
+    Run a scheduler command through the shared executor.
+
+    :param args: the command as a list of arguments
+    :param env: environment of the command, the current environment if None
+    :param merge_stderr: True to return stderr together with stdout, otherwise stderr is inherited
+    :return: the command output
+    """
+    return executor.run(args, env, merge_stderr).output
+
+
+def check_command(args, env=None):
+    """
+    Run a scheduler command through the shared executor, raising an error if it fails, as subprocess.check_call.
+
+    :param args: the command as a list of arguments
+    :param env: environment of the command, the current environment if None
+    :raise subprocess.CalledProcessError: if the command returns a non zero exit code
+    """
+    result = executor.run(args, env)
+    if result.returncode != 0:
+        raise subprocess.CalledProcessError(result.returncode, args)
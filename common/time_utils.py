@@ -0,0 +1,56 @@
+# Copyright 2013-2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You may not use this file except in compliance with the
+# License. A copy of the License is located at
+#
+# http://aws.amazon.com/apache2.0/
+#
+# or in the "LICENSE.txt" file accompanying this file. This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+# OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions and
+# limitations under the License.
+
+import ctypes
+import ctypes.util
+import os
+import time
+
+CLOCK_MONOTONIC = 1
+
+
+class _Timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+def _load_clock_gettime():
+    for library in (ctypes.util.find_library('rt'), ctypes.util.find_library('c')):
+        if not library:
+            continue
+        try:
+            clock_gettime = ctypes.CDLL(library, use_errno=True).clock_gettime
+        except (OSError, AttributeError):
+            continue
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_Timespec)]
+        return clock_gettime
+    return None
+
+
+_clock_gettime = _load_clock_gettime()
+
+
+def monotonic():
+    """
+    Get the value of a clock that cannot go backwards, in seconds.
+
+    The reference point is the last boot, so values can be compared across restarts of the daemons but not across
+    reboots. Falls back to the wall clock if CLOCK_MONOTONIC is not available.
+
+    :return: the current value of the monotonic clock, in seconds
+    """
+    if hasattr(time, 'monotonic'):
+        return time.monotonic()
+    if _clock_gettime:
+        timespec = _Timespec()
+        if _clock_gettime(CLOCK_MONOTONIC, ctypes.pointer(timespec)) == 0:
+            return timespec.tv_sec + timespec.tv_nsec * 1e-9
+        raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+    return time.time()
@@ -0,0 +1,459 @@
+import threading
+import time
+import unittest
+from datetime import datetime, timedelta, tzinfo
+
+import latency
+from asg import AsgStateCache
+from scheduler_commands import CommandExecutor, CommandResult
+
+try:
+    import cluster_state
+    import utils
+except ImportError:
+    # boto3 not installed
+    cluster_state = utils = None
+
+
+class _CountingExecutor(CommandExecutor):
+    """Executor counting the processes it would start, each lasting duration seconds."""
+
+    def __init__(self, ttls=None, duration=0, error=None):
+        CommandExecutor.__init__(self, ttls)
+        self.duration = duration
+        self.error = error
+        self.executed = []
+        self.started = threading.Event()
+
+    def _execute(self, args, env, merge_stderr):
+        self.executed.append(args)
+        self.started.set()
+        time.sleep(self.duration)
+        if self.error:
+            raise self.error
+        return CommandResult(0, 'output %d' % len(self.executed))
+
+
+squeue = ['/opt/slurm/bin/squeue', '-h']
+scontrol_update = ['/opt/slurm/bin/scontrol', 'update', 'NodeName=compute-1', 'State=RESUME']
+
+
+class command_executor_tests(unittest.TestCase):
+    def test_query_cached_within_ttl(self):
+        executor = _CountingExecutor()
+        outputs = [executor.run(squeue).output for _ in range(3)]
+        expected = ['output 1'] * 3
+        self.assertEqual(outputs, expected, "test_query_cached_within_ttl failed: Got %s; Expected: %s"
+                         % (outputs, expected))
+        self.assertEqual(len(executor.executed), 1, "test_query_cached_within_ttl failed: Got %s" % executor.executed)
+
+    def test_query_expires_after_ttl(self):
+        executor = _CountingExecutor(ttls={'squeue': 0.01})
+        executor.run(squeue)
+        time.sleep(0.02)
+        executor.run(squeue)
+        self.assertEqual(len(executor.executed), 2, "test_query_expires_after_ttl failed: Got %s" % executor.executed)
+
+    def test_distinct_queries_not_shared(self):
+        executor = _CountingExecutor()
+        executor.run(squeue)
+        executor.run(squeue + ['-o', '%i'])
+        executor.run(squeue, env={'SLURM_CONF': '/opt/slurm/etc/slurm.conf'})
+        self.assertEqual(len(executor.executed), 3, "test_distinct_queries_not_shared failed: Got %s"
+                         % executor.executed)
+
+    def test_mutating_command_invalidates_cache(self):
+        executor = _CountingExecutor()
+        executor.run(squeue)
+        executor.run(scontrol_update)
+        executor.run(scontrol_update)
+        output = executor.run(squeue).output
+        expected = 'output 4'
+        self.assertEqual(output, expected, "test_mutating_command_invalidates_cache failed: Got %s; Expected: %s"
+                         % (output, expected))
+
+    def test_concurrent_queries_collapsed(self):
+        executor = _CountingExecutor(duration=0.2)
+        outputs = []
+
+        def _query():
+            outputs.append(executor.run(squeue).output)
+
+        threads = [threading.Thread(target=_query) for _ in range(5)]
+        threads[0].start()
+        executor.started.wait()
+        for thread in threads[1:]:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        expected = ['output 1'] * 5
+        self.assertEqual(outputs, expected, "test_concurrent_queries_collapsed failed: Got %s; Expected: %s"
+                         % (outputs, expected))
+        self.assertEqual(len(executor.executed), 1, "test_concurrent_queries_collapsed failed: Got %s"
+                         % executor.executed)
+
+    def test_result_of_query_overlapping_mutation_not_cached(self):
+        executor = _CountingExecutor(duration=0.2)
+        thread = threading.Thread(target=executor.run, args=(squeue,))
+        thread.start()
+        executor.started.wait()
+        executor.invalidate()
+        thread.join()
+        executor.duration = 0
+        executor.run(squeue)
+        self.assertEqual(len(executor.executed), 2, "test_result_of_query_overlapping_mutation_not_cached failed: "
+                         "Got %s" % executor.executed)
+
+    def test_error_propagated_to_waiters(self):
+        executor = _CountingExecutor(duration=0.2, error=OSError(2, 'No such file or directory'))
+        errors = []
+
+        def _query():
+            try:
+                executor.run(squeue)
+            except OSError as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=_query) for _ in range(3)]
+        threads[0].start()
+        executor.started.wait()
+        for thread in threads[1:]:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(errors), 3, "test_error_propagated_to_waiters failed: Got %s" % errors)
+        self.assertEqual(len(executor.executed), 1, "test_error_propagated_to_waiters failed: Got %s"
+                         % executor.executed)
+        # failures are not cached
+        executor.error = None
+        output = executor.run(squeue).output
+        expected = 'output 2'
+        self.assertEqual(output, expected, "test_error_propagated_to_waiters failed: Got %s; Expected: %s"
+                         % (output, expected))
+
+
+class _AsgClient(object):
+    """Auto Scaling client recording the calls, the ASG is shared with the tests to simulate external changes."""
+
+    def __init__(self, desired=2):
+        self.asg = {'MinSize': 0, 'DesiredCapacity': desired, 'MaxSize': 10}
+        self.describes = 0
+        self.updates = []
+
+    def describe_auto_scaling_groups(self, AutoScalingGroupNames):
+        self.describes += 1
+        return {'AutoScalingGroups': [dict(self.asg)]}
+
+    def update_auto_scaling_group(self, AutoScalingGroupName, DesiredCapacity):
+        self.updates.append(DesiredCapacity)
+        self.asg['DesiredCapacity'] = DesiredCapacity
+
+
+class asg_state_cache_tests(unittest.TestCase):
+    def test_state_cached_within_ttl(self):
+        client = _AsgClient()
+        cache = AsgStateCache(client, 'asg', ttl=60)
+        for _ in range(3):
+            cache.get()
+        self.assertEqual(client.describes, 1, "test_state_cached_within_ttl failed: Got %d describes"
+                         % client.describes)
+
+    def test_state_refreshed_after_ttl(self):
+        client = _AsgClient()
+        cache = AsgStateCache(client, 'asg', ttl=0.01)
+        cache.get()
+        client.asg['DesiredCapacity'] = 5
+        time.sleep(0.02)
+        desired = cache.get().get('DesiredCapacity')
+        self.assertEqual(desired, 5, "test_state_refreshed_after_ttl failed: Got %s; Expected: 5" % desired)
+        self.assertEqual(client.describes, 2, "test_state_refreshed_after_ttl failed: Got %d describes"
+                         % client.describes)
+
+    def test_forced_refresh(self):
+        client = _AsgClient()
+        cache = AsgStateCache(client, 'asg', ttl=60)
+        cache.get()
+        client.asg['DesiredCapacity'] = 1
+        desired = cache.get(force_refresh=True).get('DesiredCapacity')
+        self.assertEqual(desired, 1, "test_forced_refresh failed: Got %s; Expected: 1" % desired)
+        cache.invalidate()
+        cache.get()
+        self.assertEqual(client.describes, 3, "test_forced_refresh failed: Got %d describes" % client.describes)
+
+    def test_max_age(self):
+        client = _AsgClient()
+        cache = AsgStateCache(client, 'asg', ttl=60)
+        cache.get()
+        cache.get(max_age=60)
+        self.assertEqual(client.describes, 1, "test_max_age failed: Got %d describes" % client.describes)
+        time.sleep(0.02)
+        cache.get(max_age=0.01)
+        self.assertEqual(client.describes, 2, "test_max_age failed: Got %d describes" % client.describes)
+
+    def test_update_written_through(self):
+        client = _AsgClient()
+        cache = AsgStateCache(client, 'asg', ttl=60)
+        updated = cache.set_desired_capacity(4)
+        self.assertTrue(updated, "test_update_written_through failed: not updated")
+        desired = cache.get().get('DesiredCapacity')
+        self.assertEqual(desired, 4, "test_update_written_through failed: Got %s; Expected: 4" % desired)
+        self.assertEqual(client.describes, 1, "test_update_written_through failed: Got %d describes"
+                         % client.describes)
+
+    def test_equal_desired_capacity_skipped(self):
+        client = _AsgClient()
+        cache = AsgStateCache(client, 'asg', ttl=60, max_staleness=60)
+        for _ in range(3):
+            updated = cache.set_desired_capacity(2)
+            self.assertFalse(updated, "test_equal_desired_capacity_skipped failed: updated")
+        self.assertEqual(client.updates, [], "test_equal_desired_capacity_skipped failed: Got %s" % client.updates)
+        self.assertEqual(client.describes, 1, "test_equal_desired_capacity_skipped failed: Got %d describes"
+                         % client.describes)
+
+    def test_stale_desired_capacity_refreshed_before_skipping(self):
+        client = _AsgClient()
+        cache = AsgStateCache(client, 'asg', ttl=60, max_staleness=0.01)
+        cache.get()
+        # lowered by a node terminating itself
+        client.asg['DesiredCapacity'] = 1
+        time.sleep(0.02)
+        updated = cache.set_desired_capacity(2)
+        self.assertTrue(updated, "test_stale_desired_capacity_refreshed_before_skipping failed: not updated")
+        self.assertEqual(client.updates, [2], "test_stale_desired_capacity_refreshed_before_skipping failed: Got %s"
+                         % client.updates)
+
+    def test_updates_rate_limited(self):
+        client = _AsgClient()
+        cache = AsgStateCache(client, 'asg', ttl=60, min_update_interval=60)
+        cache.set_desired_capacity(3)
+        updated = cache.set_desired_capacity(4)
+        self.assertFalse(updated, "test_updates_rate_limited failed: updated")
+        self.assertEqual(client.updates, [3], "test_updates_rate_limited failed: Got %s" % client.updates)
+
+
+class _Clock(object):
+    """Stand-in for the time module, the time only changes when the test advances it."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+class _Midpoint(object):
+    """Stand-in for the random module, always returning the middle of the range, i.e. no jitter."""
+
+    def uniform(self, a, b):
+        return (a + b) / 2.0
+
+
+class stack_status_tests(unittest.TestCase):
+    def setUp(self):
+        if utils is None:
+            return
+        self.clock = _Clock()
+        self.checks = []
+        self.ready = False
+        self.saved = (utils.time, utils.random, utils.is_stack_ready)
+        utils.time = self.clock
+        utils.is_stack_ready = self._is_stack_ready
+
+    def tearDown(self):
+        if utils is None:
+            return
+        utils.time, utils.random, utils.is_stack_ready = self.saved
+
+    def _is_stack_ready(self, stack_name, region, proxy_config):
+        self.checks.append(self.clock.now)
+        return self.ready
+
+    def _poll(self, stack_status, duration):
+        # as the daemons do, at every cycle
+        for _ in range(duration):
+            stack_status.is_ready()
+            self.clock.now += 1
+
+    def test_backoff_schedule(self):
+        if utils is None:
+            return
+        utils.random = _Midpoint()
+        stack_status = utils.StackStatus('stack', 'us-east-1', None)
+        self._poll(stack_status, 3200)
+        delays = [int(b - a) for a, b in zip(self.checks, self.checks[1:])]
+        expected = [60, 120, 240, 480, 600, 600, 600]
+        self.assertEqual(self.checks[0], 1015, "test_backoff_schedule failed: Got %s; Expected: %s"
+                         % (self.checks[0], 1015))
+        self.assertEqual(delays, expected, "test_backoff_schedule failed: Got %s; Expected: %s" % (delays, expected))
+
+    def test_backoff_max_delay(self):
+        if utils is None:
+            return
+        utils.random = _Midpoint()
+        stack_status = utils.StackStatus('stack', 'us-east-1', None, max_delay=100)
+        self._poll(stack_status, 600)
+        delays = [int(b - a) for a, b in zip(self.checks, self.checks[1:])]
+        expected = [60, 100, 100, 100, 100, 100]
+        self.assertEqual(delays, expected, "test_backoff_max_delay failed: Got %s; Expected: %s" % (delays, expected))
+
+    def test_backoff_jitter(self):
+        if utils is None:
+            return
+        stack_status = utils.StackStatus('stack', 'us-east-1', None)
+        self._poll(stack_status, 20000)
+        self.assertTrue(self.checks[0] <= 1030, "test_backoff_jitter failed: first check at %s" % self.checks[0])
+        delays = [b - a for a, b in zip(self.checks, self.checks[1:])]
+        # the delay is capped before the jitter is applied
+        self.assertTrue(max(delays) <= 600 * 1.2 + 1, "test_backoff_jitter failed: Got %s" % max(delays))
+        self.assertTrue(min(delays[5:]) >= 600 * 0.8, "test_backoff_jitter failed: Got %s" % min(delays[5:]))
+
+    def test_no_check_once_ready(self):
+        if utils is None:
+            return
+        utils.random = _Midpoint()
+        stack_status = utils.StackStatus('stack', 'us-east-1', None)
+        self._poll(stack_status, 100)
+        self.ready = True
+        self._poll(stack_status, 100)
+        self.assertTrue(stack_status.is_ready(), "test_no_check_once_ready failed: stack not ready")
+        self._poll(stack_status, 3600)
+        expected = [1015, 1075, 1195]
+        self.assertEqual(self.checks, expected, "test_no_check_once_ready failed: Got %s; Expected: %s"
+                         % (self.checks, expected))
+
+    def test_set_ready(self):
+        if utils is None:
+            return
+        stack_status = utils.StackStatus('stack', 'us-east-1', None)
+        stack_status.set_ready()
+        self._poll(stack_status, 3600)
+        self.assertTrue(stack_status.is_ready(), "test_set_ready failed: stack not ready")
+        self.assertEqual(self.checks, [], "test_set_ready failed: Got %s; Expected: []" % self.checks)
+
+
+class scalein_delay_tests(unittest.TestCase):
+    def _assert_delay(self, name, expected, *args, **kwargs):
+        kwargs.setdefault('now', 10000)
+        delay = cluster_state.get_scalein_delay(*args, **kwargs)
+        self.assertEqual(delay, expected, "%s failed: Got %s; Expected: %s" % (name, delay, expected))
+
+    def test_no_hold(self):
+        if cluster_state is None:
+            return
+        self._assert_delay('test_no_hold', 0, None, 0)
+        self._assert_delay('test_no_hold', 0, None, 600, launch_time=None, min_node_lifetime=1800)
+
+    def test_recent_scale_out(self):
+        if cluster_state is None:
+            return
+        self._assert_delay('test_recent_scale_out', 400, 9800, 600)
+
+    def test_cooldown_expired(self):
+        if cluster_state is None:
+            return
+        self._assert_delay('test_cooldown_expired', 0, 9400, 600)
+        self._assert_delay('test_cooldown_expired', 0, 9000, 600)
+
+    def test_cooldown_disabled(self):
+        if cluster_state is None:
+            return
+        self._assert_delay('test_cooldown_disabled', 0, 9999, 0)
+
+    def test_scale_out_unknown(self):
+        if cluster_state is None:
+            return
+        # e.g. no scale-out since jobwatcher started
+        self._assert_delay('test_scale_out_unknown', 0, None, 600)
+
+    def test_scale_out_in_the_future(self):
+        if cluster_state is None:
+            return
+        # clocks of the master and compute nodes out of sync
+        self._assert_delay('test_scale_out_in_the_future', 600, 13600, 600)
+
+    def test_recent_launch(self):
+        if cluster_state is None:
+            return
+        self._assert_delay('test_recent_launch', 1500, None, 0, launch_time=9700, min_node_lifetime=1800)
+
+    def test_lifetime_expired(self):
+        if cluster_state is None:
+            return
+        self._assert_delay('test_lifetime_expired', 0, None, 0, launch_time=8200, min_node_lifetime=1800)
+        self._assert_delay('test_lifetime_expired', 0, None, 0, launch_time=9700, min_node_lifetime=0)
+
+    def test_launch_in_the_future(self):
+        if cluster_state is None:
+            return
+        self._assert_delay('test_launch_in_the_future', 1800, None, 0, launch_time=20000, min_node_lifetime=1800)
+
+    def test_longest_hold(self):
+        if cluster_state is None:
+            return
+        self._assert_delay('test_longest_hold', 1500, 9800, 600, launch_time=9700, min_node_lifetime=1800)
+        self._assert_delay('test_longest_hold', 400, 9800, 600, launch_time=8000, min_node_lifetime=1800)
+
+    def test_current_time(self):
+        if cluster_state is None:
+            return
+        delay = cluster_state.get_scalein_delay(time.time() - 100, 600)
+        self.assertTrue(499 <= delay <= 500, "test_current_time failed: Got %s; Expected: 500" % delay)
+
+
+class _Utc2(tzinfo):
+    def utcoffset(self, dt):
+        return timedelta(hours=2)
+
+    def dst(self, dt):
+        return timedelta(0)
+
+
+class latency_tests(unittest.TestCase):
+    def test_to_timestamp(self):
+        for value, expected in [(None, None), (1546300800, 1546300800.0), ('2019-01-01T00:00:00Z', 1546300800.0),
+                                ('2019-01-01T00:00:01.500Z', 1546300801.5),
+                                (datetime(2019, 1, 1, 0, 0, 0), 1546300800.0),
+                                (datetime(2019, 1, 1, 2, 0, 0, tzinfo=_Utc2()), 1546300800.0)]:
+            timestamp = latency.to_timestamp(value)
+            self.assertEqual(timestamp, expected, "test_to_timestamp failed for %s. Got %s; Expected: %s"
+                             % (value, timestamp, expected))
+
+    def test_percentile(self):
+        values = [5, 1, 4, 2, 3, 6, 7, 8, 9, 10]
+        for percent, expected in [(0, 1), (10, 1), (50, 5), (90, 9), (99, 10), (100, 10)]:
+            result = latency.percentile(values, percent)
+            self.assertEqual(result, expected, "test_percentile failed for p%d. Got %s; Expected: %s"
+                             % (percent, result, expected))
+        self.assertEqual(latency.percentile([], 50), None, "test_percentile failed for an empty list")
+
+    def test_compute_latencies(self):
+        records = [
+            {'stage': 'scale_up', 'timestamp': 100},
+            {'stage': 'scale_up', 'timestamp': 200},
+            {'stage': 'compute_ready', 'instance_id': 'i-1', 'timestamp': 401, 'sent_time': 400},
+            # delivered again
+            {'stage': 'compute_ready', 'instance_id': 'i-1', 'timestamp': 700, 'sent_time': 400},
+            {'stage': 'host_added', 'instance_id': 'i-1', 'timestamp': 420, 'launch_time': 150},
+            {'stage': 'first_job', 'instance_id': 'i-1', 'timestamp': 500, 'submit_times': {'1': 50, '2': 120}},
+            {'stage': 'compute_ready', 'instance_id': 'i-2', 'timestamp': 451, 'sent_time': 450},
+            {'stage': 'host_added', 'instance_id': 'i-2', 'timestamp': 460, 'launch_time': 210},
+            # job 2 spans both nodes, it started when seen on the first one
+            {'stage': 'first_job', 'instance_id': 'i-2', 'timestamp': 480, 'submit_times': {'2': 120}},
+        ]
+        latencies = latency.compute_latencies(records)
+        latencies = dict((stage, sorted(values)) for stage, values in latencies.items())
+        expected = {
+            'detection': [50, 80],
+            'asg_launch': [10, 50],
+            'boot': [240, 250],
+            'sqs_delivery': [1, 1],
+            'add_host': [9, 19],
+            'dispatch': [20, 80],
+            'job_start': [360, 450],
+        }
+        self.assertEqual(latencies, expected, "test_compute_latencies failed. Got %s; Expected: %s"
+                         % (latencies, expected))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+# Copyright 2013-2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You may not use this file except in compliance with the
+# License. A copy of the License is located at
+#
+# http://aws.amazon.com/apache2.0/
+#
+# or in the "LICENSE.txt" file accompanying this file. This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+# OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import os
+import random
+import tempfile
+import time
+
+import boto3
+
+log = logging.getLogger(__name__)
+
+
+def atomic_write(path, data):
+    """
+    Write data to the given path, replacing any previous content atomically.
+
+    :param path: destination file path
+    :param data: the string to write, text is encoded in UTF-8
+    """
+    if not isinstance(data, bytes):
+        data = data.encode('utf-8')
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, path)
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def next_backoff_delay(delay, max_delay, multiplier=2, jitter=0.2):
+    """
+    Compute the next delay of a jittered exponential backoff.
+
+    :param delay: the current delay in seconds
+    :param max_delay: upper bound of the delay in seconds, before jitter
+    :param multiplier: multiplier factor for the delay
+    :param jitter: randomization of the delay, as a fraction of it
+    :return: the next delay in seconds
+    """
+    delay = min(delay * multiplier, max_delay)
+    return delay * (1 + random.uniform(-jitter, jitter))
+
+
+def is_stack_ready(stack_name, region, proxy_config):
+    """
+    Verify if the Stack is in one of the *_COMPLETE states.
+
+    :param stack_name: Stack to query for
+    :param region: AWS region
+    :param proxy_config: Proxy configuration
+    :return: true if the stack is in the *_COMPLETE status
+    """
+    log.info('Checking for status of the stack %s' % stack_name)
+    cfn_client = boto3.client('cloudformation', region_name=region, config=proxy_config)
+    stacks = cfn_client.describe_stacks(StackName=stack_name)
+    return stacks['Stacks'][0]['StackStatus'] in ['CREATE_COMPLETE', 'UPDATE_COMPLETE', 'UPDATE_ROLLBACK_COMPLETE']
+
+
+class StackStatus(object):
+    """Track the stack readiness, polling CloudFormation with a jittered exponential backoff until ready."""
+
+    def __init__(self, stack_name, region, proxy_config, max_delay=600):
+        """
+        :param stack_name: Stack to query for
+        :param region: AWS region
+        :param proxy_config: Proxy configuration
+        :param max_delay: maximum delay between two checks, in seconds
+        """
+        self.stack_name = stack_name
+        self.region = region
+        self.proxy_config = proxy_config
+        self.max_delay = max_delay
+        self._ready = False
+        # spread the first checks of nodes started together
+        self._delay = 30
+        self._next_check = time.time() + random.uniform(0, self._delay)
+
+    def is_ready(self):
+        """
+        Verify if the stack is ready, querying CloudFormation only if the backoff delay expired.
+
+        :return: true if the stack reached one of the *_COMPLETE states
+        """
+        if not self._ready and time.time() >= self._next_check:
+            self._ready = is_stack_ready(self.stack_name, self.region, self.proxy_config)
+            log.info('Stack %s ready: %s' % (self.stack_name, self._ready))
+            self._delay = next_backoff_delay(self._delay, self.max_delay)
+            self._next_check = time.time() + self._delay
+        return self._ready
+
+    def set_ready(self):
+        """Mark the stack as ready, e.g. when published by the master node."""
+        self._ready = True
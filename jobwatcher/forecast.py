@@ -0,0 +1,348 @@
+# Copyright 2013-2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You may not use this file except in compliance with the
+# License. A copy of the License is located at
+#
+# http://aws.amazon.com/apache2.0/
+#
+# or in the "LICENSE.txt" file accompanying this file. This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+# OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import math
+import os
+import struct
+import time
+
+log = logging.getLogger(__name__)
+
+
+class DemandHistory(object):
+    """
+    Fixed size ring buffer of (timestamp, pending nodes, busy nodes) samples, persisted to a binary file.
+
+    Samples are aggregated per minute, keeping the maximum demand observed in the minute, so that the size of the
+    history doesn't depend on the polling interval. Each sample takes 12 bytes on disk.
+    """
+
+    _header = struct.Struct('<4sII')
+    _record = struct.Struct('<Iii')
+    _magic = b'JWDH'
+
+    def __init__(self, path, capacity=7 * 24 * 60):
+        self.path = path
+        self.capacity = capacity
+        self.samples = []
+        self._next = 0
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                magic, capacity, next_idx = self._header.unpack(f.read(self._header.size))
+                if magic != self._magic or capacity != self.capacity:
+                    raise ValueError("incompatible history format")
+                records = []
+                data = f.read(self._record.size)
+                while len(data) == self._record.size:
+                    records.append(self._record.unpack(data))
+                    data = f.read(self._record.size)
+        except (IOError, ValueError, struct.error) as e:
+            log.info("Starting with an empty demand history %s (%s)" % (self.path, e))
+            self._reset()
+            return
+
+        # restore chronological order
+        if len(records) == self.capacity:
+            records = records[next_idx:] + records[:next_idx]
+        self.samples = [r for r in records if r[0] > 0]
+        self._next = next_idx % self.capacity
+        log.info("Loaded %d samples from demand history %s" % (len(self.samples), self.path))
+
+    def _reset(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(self.path, 'wb') as f:
+            f.write(self._header.pack(self._magic, self.capacity, 0))
+        self.samples = []
+        self._next = 0
+
+    def _write(self, index, sample):
+        with open(self.path, 'r+b') as f:
+            f.seek(self._header.size + index * self._record.size)
+            f.write(self._record.pack(*sample))
+            f.seek(0)
+            f.write(self._header.pack(self._magic, self.capacity, (index + 1) % self.capacity))
+
+    def add(self, timestamp, pending, busy):
+        """
+        Add a sample to the history, merging it with the last one if taken in the same minute.
+
+        :param timestamp: sample time, in seconds since the epoch
+        :param pending: number of nodes required by pending jobs
+        :param busy: number of nodes running jobs
+        """
+        minute = int(timestamp) // 60 * 60
+        if self.samples and self.samples[-1][0] == minute:
+            last = self.samples[-1]
+            if pending + busy <= last[1] + last[2]:
+                return
+            sample = (minute, pending, busy)
+            self.samples[-1] = sample
+            self._write((self._next - 1) % self.capacity, sample)
+        else:
+            sample = (minute, pending, busy)
+            self.samples.append(sample)
+            if len(self.samples) > self.capacity:
+                del self.samples[0]
+            self._write(self._next, sample)
+            self._next = (self._next + 1) % self.capacity
+
+
+def ewma_forecast(samples, horizon, alpha):
+    """
+    Forecast the demand at now + horizon by extrapolating the EWMA of the demand growth rate.
+
+    :param samples: chronological list of (timestamp, pending, busy) samples
+    :param horizon: forecast horizon in seconds
+    :param alpha: smoothing factor, greater than 0 and not greater than 1
+    :return: the forecasted number of nodes
+    """
+    if not samples:
+        return 0
+    # older samples have a negligible weight
+    samples = samples[-int(10 / alpha):]
+    rate = 0.0
+    for previous, current in zip(samples, samples[1:]):
+        elapsed = current[0] - previous[0]
+        if elapsed <= 0:
+            continue
+        growth = float((current[1] + current[2]) - (previous[1] + previous[2])) / elapsed
+        # only arrivals can anticipate a scale-up, decreases are handled by nodewatcher
+        rate = alpha * max(growth, 0) + (1 - alpha) * rate
+    last = samples[-1]
+    return last[1] + last[2] + rate * horizon
+
+
+def seasonal_forecast(samples, now, horizon, period=24 * 60 * 60, seasons=7):
+    """
+    Forecast the peak demand in the next horizon seconds from the demand observed at the same time in past periods.
+
+    :param samples: chronological list of (timestamp, pending, busy) samples
+    :param now: current time in seconds since the epoch
+    :param horizon: forecast horizon in seconds
+    :param period: length of a season in seconds, one day by default
+    :param seasons: number of past seasons to consider
+    :return: the average over past seasons of the peak demand in the equivalent window
+    """
+    peaks = [0] * seasons
+    found = [False] * seasons
+    for timestamp, pending, busy in samples:
+        # the window of season k spans [now - k * period, now - k * period + horizon]
+        season = int((now - timestamp + period / 2) // period)
+        if season < 1 or season > seasons:
+            continue
+        # position of the sample relative to the same instant of its season
+        offset = timestamp + season * period - now
+        if 0 <= offset <= horizon:
+            peaks[season - 1] = max(peaks[season - 1], pending + busy)
+            found[season - 1] = True
+
+    observed = [peak for peak, seen in zip(peaks, found) if seen]
+    if not observed:
+        return 0
+    return float(sum(observed)) / len(observed)
+
+
+class DemandForecaster(object):
+    """Pre-scale the cluster ahead of predicted demand, tracking the time to first job start saved."""
+
+    models = ('ewma', 'seasonal')
+
+    def __init__(self, history, model, horizon, max_prescale, alpha=0.3, boot_time=300):
+        """
+        :param history: DemandHistory used to persist demand samples
+        :param model: forecasting model, one of DemandForecaster.models
+        :param horizon: how far ahead to anticipate demand, in seconds
+        :param max_prescale: maximum number of nodes to launch ahead of the current demand
+        :param alpha: EWMA smoothing factor, greater than 0 and not greater than 1
+        :param boot_time: estimated time for a new node to become available to the scheduler, in seconds
+        """
+        if model not in self.models:
+            raise ValueError("Unknown forecasting model %s, must be one of %s" % (model, ', '.join(self.models)))
+        if not 0 < alpha <= 1:
+            raise ValueError("Invalid EWMA smoothing factor %s, must be greater than 0 and not greater than 1" % alpha)
+        self.history = history
+        self.model = model
+        self.horizon = horizon
+        self.max_prescale = max_prescale
+        self.alpha = alpha
+        self.boot_time = boot_time
+        self.saved_time = 0
+        self._prescale = None
+
+    def _predict(self, now):
+        if self.model == 'ewma':
+            return ewma_forecast(self.history.samples, self.horizon, self.alpha)
+        return seasonal_forecast(self.history.samples, now, self.horizon)
+
+    def get_target(self, now, pending, busy):
+        """
+        Record the current demand and compute the number of nodes to provision.
+
+        :param now: current time in seconds since the epoch
+        :param pending: number of nodes required by pending jobs
+        :param busy: number of nodes running jobs
+        :return: the number of nodes to provision, never lower than the current demand
+        """
+        self.history.add(now, pending, busy)
+        demand = pending + busy
+        predicted = int(math.ceil(self._predict(now)))
+        target = max(demand, min(predicted, demand + self.max_prescale))
+        if target > demand:
+            log.info("Predicted demand of %d nodes in the next %d seconds, pre-scaling to %d nodes"
+                     % (predicted, self.horizon, target))
+        self._track_savings(now, demand, target)
+        return target
+
+    def _track_savings(self, now, demand, target):
+        if self._prescale is None:
+            if target > demand:
+                self._prescale = (now, demand, target)
+            return
+
+        started, base_demand, prescaled_target = self._prescale
+        if demand > base_demand:
+            # the predicted jobs arrived, they found nodes that had been booting since the pre-scale decision
+            saved = min(now - started, self.boot_time)
+            self.saved_time += saved
+            log.info("Pre-scaling saved about %d seconds to first job start (%d seconds in total)"
+                     % (saved, self.saved_time))
+            self._prescale = (now, demand, target) if target > demand else None
+        elif now - started > 2 * self.horizon:
+            log.info("Predicted demand of %d nodes did not materialize" % prescaled_target)
+            self._prescale = (now, demand, target) if target > demand else None
+
+
+_days = ('mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun')
+
+
+def _parse_minutes(value):
+    hours, minutes = value.split(':')
+    if not 0 <= int(hours) <= 24 or not 0 <= int(minutes) < 60:
+        raise ValueError("invalid time %s" % value)
+    return int(hours) * 60 + int(minutes)
+
+
+def parse_reserve_schedule(value):
+    """
+    Parse a warm reserve schedule, e.g. mon-fri 08:00-18:00=4; sat,sun 10:00-14:00=1.
+
+    :param value: semicolon separated list of days, local time window and number of nodes
+    :return: list of (set of week days, first minute of the day, last minute of the day, nodes), days numbered from
+        0 for Monday
+    """
+    schedule = []
+    for entry in value.split(';'):
+        if not entry.strip():
+            continue
+        try:
+            window, nodes = entry.split('=')
+            days, hours = window.split()
+            week_days = set()
+            for day_range in days.lower().split(','):
+                first, _, last = day_range.partition('-')
+                last = last or first
+                if first not in _days or last not in _days:
+                    raise ValueError("unknown day %s" % day_range)
+                first, last = _days.index(first), _days.index(last)
+                if first <= last:
+                    week_days.update(range(first, last + 1))
+                else:
+                    # wraps around the end of the week
+                    week_days.update(range(first, 7))
+                    week_days.update(range(last + 1))
+            start, end = [_parse_minutes(bound) for bound in hours.split('-')]
+            schedule.append((week_days, start, end, int(nodes)))
+        except ValueError as e:
+            raise ValueError("Invalid warm reserve schedule entry '%s': %s" % (entry.strip(), e))
+    return schedule
+
+
+def scheduled_reserve(schedule, now):
+    """
+    Get the number of warm nodes required by the schedule at the given time.
+
+    :param schedule: schedule as returned by parse_reserve_schedule
+    :param now: time in seconds since the epoch, the schedule is in local time
+    :return: the largest number of nodes of the windows including now, 0 if none
+    """
+    local_time = time.localtime(now)
+    minute = local_time.tm_hour * 60 + local_time.tm_min
+    reserve = 0
+    for week_days, start, end, nodes in schedule:
+        if local_time.tm_wday in week_days and start <= minute < end:
+            reserve = max(reserve, nodes)
+    return reserve
+
+
+def arrival_rate(samples, now, window):
+    """
+    Estimate the rate of arrival of new demand from the increases of the demand in the recent samples.
+
+    :param samples: chronological list of (timestamp, pending, busy) samples
+    :param now: current time in seconds since the epoch
+    :param window: how far back to look, in seconds
+    :return: the number of nodes of new demand per second
+    """
+    recent = [sample for sample in samples if now - window <= sample[0] <= now]
+    arrivals = 0
+    for previous, current in zip(recent, recent[1:]):
+        arrivals += max((current[1] + current[2]) - (previous[1] + previous[2]), 0)
+    return float(arrivals) / window
+
+
+class WarmReserve(object):
+    """
+    Keep idle nodes for the demand expected in the next minutes, so that short jobs start without waiting for a node
+    to boot.
+
+    The reserve follows the recent arrival rate of the demand, or a schedule such as business hours.
+    """
+
+    models = ('rate', 'schedule')
+
+    def __init__(self, model, history=None, horizon=600, window=1800, max_reserve=10, schedule=None):
+        """
+        :param model: reserve model, one of WarmReserve.models
+        :param history: DemandHistory of the recent demand, required by the rate model
+        :param horizon: the reserve covers the demand expected in the next horizon seconds
+        :param window: seconds of history used to estimate the arrival rate
+        :param max_reserve: maximum number of nodes of the rate model
+        :param schedule: schedule of the schedule model, as returned by parse_reserve_schedule
+        """
+        if model not in self.models:
+            raise ValueError("Unknown warm reserve model %s, must be one of %s" % (model, ', '.join(self.models)))
+        self.model = model
+        self.history = history
+        self.horizon = horizon
+        self.window = window
+        self.max_reserve = max_reserve
+        self.schedule = schedule or []
+
+    def get_reserve(self, now, pending, busy):
+        """
+        Record the current demand and compute the number of idle nodes to keep.
+
+        :param now: current time in seconds since the epoch
+        :param pending: number of nodes required by pending jobs
+        :param busy: number of nodes running jobs
+        :return: the number of idle nodes to keep in addition to the current demand
+        """
+        if self.model == 'schedule':
+            return scheduled_reserve(self.schedule, now)
+        self.history.add(now, pending, busy)
+        expected = arrival_rate(self.history.samples, now, self.window) * self.horizon
+        return min(int(math.ceil(expected)), self.max_reserve)
@@ -20,11 +20,24 @@ import sys
 import time
 import logging
 import json
+import pickle
+import re
 from botocore.exceptions import ClientError
 from botocore.config import Config
+from common.asg import AsgStateCache
+from common.cluster_state import read_cluster_state, write_cluster_state
+from common.latency import get_latency_log
+from common.utils import StackStatus, atomic_write
+from forecast import DemandForecaster, DemandHistory, WarmReserve, parse_reserve_schedule
+from plugins.utils import get_filtered_demand, plan_capacity
+from reaper import IdleNodesReaper
+from trigger import next_poll_interval, open_trigger_socket, wait_for_trigger
 
 log = logging.getLogger(__name__)
-pricing_file = '/opt/parallelcluster/instances.json'
+pricing_key = 'instances/instances.json'
+pricing_file = 'instances.json'
+catalog_file = 'instances.catalog'
+manifest_file = 'instances.manifest'
 cfnconfig_file = '/opt/parallelcluster/cfnconfig'
 
 
@@ -44,6 +57,21 @@ def _load_scheduler_module(scheduler):
     return _scheduler
 
 
+def _get_option(config, option, default, getter=None):
+    """
+    Get an optional integer parameter from the jobwatcher configuration.
+
+    :param config: jobwatcher configuration
+    :param option: the option to read
+    :param default: value to return if the option is not set
+    :param getter: config method used to parse the value, config.getint by default
+    :return: the option value or the default
+    """
+    if not config.has_option('jobwatcher', option):
+        return default
+    return (getter or config.getint)('jobwatcher', option)
+
+
 def _get_asg_name(stack_name, region, proxy_config):
     """
     Get autoscaling group name.
@@ -83,31 +111,95 @@ def _read_cfnconfig():
     return cfnconfig_params
 
 
-def _get_vcpus_from_pricing_file(instance_type):
+def _parse_number(value):
+    """
+    Parse a numeric value from the pricing file, e.g. "4", "7.5 GiB" or "1,952".
+
+    :param value: the value to parse
+    :return: the parsed number as float, or None if the value doesn't contain any number
+    """
+    match = re.search(r'[0-9]+(\.[0-9]+)?', str(value).replace(',', ''))
+    return float(match.group(0)) if match else None
+
+
+def _compile_catalog(pricing_path, catalog_path):
     """
-    Read pricing file and get number of vcpus for the given instance type.
+    Compile the pricing file into a compact catalog containing only the fields used by jobwatcher.
+
+    The catalog is a pickled dictionary instance_type -> {'vcpus': <int>, 'memory': <MiB>, 'gpus': <int>,
+    'price': <float>}, so that it can be loaded at startup without parsing the whole pricing file.
+
+    :param pricing_path: the instances.json file downloaded from S3
+    :param catalog_path: destination path of the catalog
+    :return: the compiled catalog
+    """
+    with open(pricing_path) as f:
+        instances = json.load(f)
 
+    catalog = {}
+    for instance_type, properties in instances.items():
+        vcpus = _parse_number(properties.get('vcpus'))
+        if vcpus is None:
+            log.debug("Skipping instance type %s with no vcpus information" % instance_type)
+            continue
+        memory = _parse_number(properties.get('memory'))
+        gpus = _parse_number(properties.get('gpu', properties.get('gpus', 0)))
+        catalog[str(instance_type)] = {
+            'vcpus': int(vcpus),
+            # memory is expressed in GiB in the pricing file
+            'memory': int(memory * 1024) if memory is not None else None,
+            'gpus': int(gpus or 0),
+            # hourly on-demand price, when available
+            'price': _parse_number(properties.get('price')) if properties.get('price') is not None else None,
+        }
+
+    atomic_write(catalog_path, pickle.dumps(catalog, pickle.HIGHEST_PROTOCOL))
+    log.info("Compiled %d instance types into %s" % (len(catalog), catalog_path))
+    return catalog
+
+
+def _load_catalog(pcluster_dir):
+    """
+    Load the compiled instance catalog, compiling it from the pricing file if needed.
+
+    :param pcluster_dir: Parallelcluster configuration folder
+    :return: a dictionary instance_type -> instance information
+    """
+    catalog_path = os.path.join(pcluster_dir, catalog_file)
+    try:
+        with open(catalog_path, 'rb') as f:
+            return pickle.load(f)
+    except (IOError, EOFError, pickle.UnpicklingError) as e:
+        log.warning("Unable to load instance catalog %s (%s). Compiling it from pricing file." % (catalog_path, e))
+        return _compile_catalog(os.path.join(pcluster_dir, pricing_file), catalog_path)
+
+
+def _get_vcpus_from_catalog(catalog, instance_type):
+    """
+    Get number of vcpus for the given instance type from the instance catalog.
+
+    :param catalog: the instance catalog
     :param instance_type: the instance type to search for.
     :return: the number of vcpus or -1 if the instance type cannot be found
     """
-    with open(pricing_file) as f:
-        instances = json.load(f)
-        try:
-            vcpus = int(instances[instance_type]["vcpus"])
-            log.info("Instance %s has %s vcpus." % (instance_type, vcpus))
-        except KeyError:
-            log.error("Unable to get vcpus from file %s. Instance type %s not found." % (pricing_file, instance_type))
-            vcpus = -1
+    try:
+        vcpus = catalog[instance_type]["vcpus"]
+        log.info("Instance %s has %s vcpus." % (instance_type, vcpus))
+    except KeyError:
+        log.error("Unable to get vcpus from instance catalog. Instance type %s not found." % instance_type)
+        vcpus = -1
 
-        return vcpus
+    return vcpus
 
 
-def _get_instance_properties(instance_type):
+def _get_instance_properties(catalog, instance_type):
     """
     Get instance properties for the given instance type, according to the cfn_scheduler_slots configuration parameter.
 
+    :param catalog: the instance catalog
     :param instance_type: instance type to search for
-    :return: a dictionary containing the instance properties. E.g. {'slots': <slots>}
+    :return: a dictionary containing the instance properties. E.g. {'slots': <slots>, 'memory': <MiB>,
+        'resources': {'gpu': <gpus>}}
     """
     try:
         cfnconfig_params = _read_cfnconfig()
@@ -118,7 +210,7 @@ def _get_instance_properties(instance_type):
         )
         cfn_scheduler_slots = "vcpus"
 
-    vcpus = _get_vcpus_from_pricing_file(instance_type)
+    vcpus = _get_vcpus_from_catalog(catalog, instance_type)
 
     if cfn_scheduler_slots == "cores":
         log.info("Instance %s will use number of cores as slots based on configuration." % instance_type)
@@ -146,33 +238,356 @@ def _get_instance_properties(instance_type):
         log.critical("slots value is invalid. Setting it to 0.")
         slots = 0
 
-    return {'slots': slots}
+    # memory and generic resources available per node, for the plugins packing them
+    properties = catalog.get(instance_type, {})
+    resources = {'gpu': properties.get('gpus')} if properties.get('gpus') else {}
+    return {'slots': slots, 'memory': properties.get('memory'), 'resources': resources}
 
 
-def _fetch_pricing_file(pcluster_dir, region, proxy_config):
+def _read_manifest(manifest_path):
     """
-    Download pricing file.
+    Read the manifest describing the last downloaded version of the pricing file.
+
+    :param manifest_path: path of the manifest file
+    :return: a dictionary containing the ETag and LastModified of the local pricing file, if any
+    """
+    try:
+        with open(manifest_path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def _download_pricing_file_from_s3(bucket_name, manifest, region, proxy_config):
+    """
+    Download the pricing file from S3, unless the version described by the manifest is still current.
+
+    :param bucket_name: S3 bucket containing the pricing file
+    :param manifest: manifest of the local copy, empty if there is no local copy
+    :param region: AWS Region
+    :param proxy_config: Proxy Configuration
+    :return: a tuple (content, manifest), with content None if the local copy is up to date
+    """
+    s3 = boto3.client('s3', region_name=region, config=proxy_config)
+    request = {'Bucket': bucket_name, 'Key': pricing_key}
+    if manifest.get('ETag'):
+        request['IfNoneMatch'] = manifest.get('ETag')
+    try:
+        response = s3.get_object(**request)
+    except ClientError as e:
+        if e.response.get('Error').get('Code') in ('304', 'NotModified'):
+            return None, manifest
+        raise
+
+    return response['Body'].read(), {
+        'ETag': response.get('ETag'),
+        'LastModified': str(response.get('LastModified')),
+    }
+
+
+def _copy_pricing_file_from_dir(source_dir, manifest):
+    """
+    Copy the pricing file from a local directory laid out as the S3 bucket, unless the local copy is still current.
+
+    :param source_dir: directory to use in place of the S3 bucket
+    :param manifest: manifest of the local copy, empty if there is no local copy
+    :return: a tuple (content, manifest), with content None if the local copy is up to date
+    """
+    source_path = os.path.join(source_dir, pricing_key)
+    stat = os.stat(source_path)
+    etag = '%d-%d' % (stat.st_mtime, stat.st_size)
+    if manifest.get('ETag') == etag:
+        return None, manifest
+
+    with open(source_path, 'rb') as f:
+        return f.read(), {'ETag': etag, 'LastModified': str(stat.st_mtime)}
+
+
+def _fetch_pricing_file(pcluster_dir, region, proxy_config, source=None):
+    """
+    Download pricing file, if changed since the last download, and compile it into the instance catalog.
 
     :param proxy_config: Proxy Configuration
     :param pcluster_dir: Parallelcluster configuration folder
     :param region: AWS Region
+    :param source: S3 bucket name or local directory to fetch the pricing file from, <region>-aws-parallelcluster if None
     """
-    s3 = boto3.resource('s3', region_name=region, config=proxy_config)
     try:
         if not os.path.exists(pcluster_dir):
             os.makedirs(pcluster_dir)
     except OSError as ex:
         log.critical('Could not create directory %s. Failed with exception: %s' % (pcluster_dir, ex))
         raise
-    bucket_name = '%s-aws-parallelcluster' % region
+
+    pricing_path = os.path.join(pcluster_dir, pricing_file)
+    catalog_path = os.path.join(pcluster_dir, catalog_file)
+    manifest_path = os.path.join(pcluster_dir, manifest_file)
+    manifest = {}
+    if os.path.isfile(pricing_path) and os.path.isfile(catalog_path):
+        manifest = _read_manifest(manifest_path)
+
+    source = source or '%s-aws-parallelcluster' % region
     try:
-        bucket = s3.Bucket(bucket_name)
-        bucket.download_file('instances/instances.json', '%s/instances.json' % pcluster_dir)
-    except ClientError as e:
-        log.critical("Could not save instance mapping file %s/instances.json from S3 bucket %s. "
-                     "Failed with exception: %s" % (pcluster_dir, bucket_name, e))
+        if os.path.isdir(source):
+            content, manifest = _copy_pricing_file_from_dir(source, manifest)
+        else:
+            content, manifest = _download_pricing_file_from_s3(source, manifest, region, proxy_config)
+    except (ClientError, IOError, OSError) as e:
+        log.critical("Could not save instance mapping file %s from %s. Failed with exception: %s"
+                     % (pricing_path, source, e))
         raise
 
+    if content is None:
+        log.info("Instance mapping file %s is up to date" % pricing_path)
+        return
+
+    atomic_write(pricing_path, content)
+    _compile_catalog(pricing_path, catalog_path)
+    atomic_write(manifest_path, json.dumps(manifest))
+    log.info("Saved instance mapping file %s from %s" % (pricing_path, source))
+
+
+def _scale_up(asg_cache, pending, running, required, latency_log=None):
+    """
+    Raise the ASG desired capacity to the number of required nodes, within the ASG limits.
+
+    :param asg_cache: AsgStateCache of the compute fleet ASG
+    :param pending: number of nodes requested by pending jobs
+    :param running: number of nodes running jobs
+    :param required: number of nodes to provision
+    :param latency_log: LatencyLog recording the scale-up decision, None to disable it
+    """
+    # get current limits, the cached desired capacity may be stale when it seems to cover the demand, since the
+    # nodewatchers decrement it when terminating their instance
+    asg = asg_cache.get()
+    if running < required <= asg.get('DesiredCapacity'):
+        asg = asg_cache.get(max_age=asg_cache.max_staleness)
+
+    min_size = asg.get('MinSize')
+    current_desired = asg.get('DesiredCapacity')
+    max_size = asg.get('MaxSize')
+    log.info("min/desired/max %d/%d/%d" % (min_size, current_desired, max_size))
+    log.info("%d nodes requested, %d nodes running" % (pending, running))
+
+    # Check to make sure requested number of instances is within ASG limits
+    if required <= current_desired:
+        log.info("%d nodes required, %d nodes in asg. Noop" % (required, current_desired))
+    else:
+        if required > max_size:
+            log.info(
+                "The number of required nodes %d is greater than max %d. Requesting max %d."
+                % (required, max_size, max_size)
+            )
+        else:
+            log.info(
+                "Setting desired to %d nodes, requesting %d more nodes from asg."
+                % (required, required - current_desired)
+            )
+        requested = min(required, max_size)
+
+        # update ASG
+        asg_cache.set_desired_capacity(requested)
+        if latency_log:
+            latency_log.record(
+                'scale_up', pending=pending, running=running, required=required, previous_desired=current_desired,
+                requested=requested,
+            )
+
+
+def _get_compute_fleets(config, catalog, primary_asg_name, primary_asg_cache):
+    """
+    Get the candidate instance types of the capacity planner and their ASGs.
+
+    The candidates are listed in the compute_instance_types option, e.g. c5.large:asg-small,c5.18xlarge:asg-large.
+    The costs of all the candidates are compared in the same unit: they are read from the compute_instance_costs
+    option, e.g. c5.large:0.085, if it lists every candidate, or from the prices in the instance catalog if known for
+    every candidate, and are proportional to the number of vcpus otherwise. Instance types missing from the catalog are
+    not candidates.
+
+    :param config: jobwatcher configuration
+    :param catalog: the instance catalog
+    :param primary_asg_name: the ASG of compute_instance_type
+    :param primary_asg_cache: AsgStateCache of the primary ASG, shared with the planner
+    :return: list of dictionaries with instance_type, asg_name, asg_cache and cost keys, None if not configured
+    """
+    if not config.has_option('jobwatcher', 'compute_instance_types'):
+        return None
+
+    costs = {}
+    if config.has_option('jobwatcher', 'compute_instance_costs'):
+        for item in config.get('jobwatcher', 'compute_instance_costs').split(','):
+            instance_type, cost = item.strip().split(':')
+            costs[instance_type] = float(cost)
+
+    candidates = []
+    for item in config.get('jobwatcher', 'compute_instance_types').split(','):
+        instance_type, asg_name = item.strip().split(':')
+        if _get_vcpus_from_catalog(catalog, instance_type) < 0:
+            log.error("Ignoring capacity planner candidate %s, not in the instance catalog" % instance_type)
+            continue
+        candidates.append((instance_type, asg_name))
+
+    instance_types = [candidate_type for candidate_type, _ in candidates]
+    if not all(candidate_type in costs for candidate_type in instance_types):
+        if costs:
+            log.warning("compute_instance_costs doesn't list all of %s. Ignoring it" % ','.join(instance_types))
+        costs = {}
+        for instance_type in instance_types:
+            costs[instance_type] = catalog[instance_type].get('price')
+        if not all(costs.values()):
+            log.info("Unknown price for some of %s. Using the number of vcpus as cost" % ','.join(instance_types))
+            for instance_type in instance_types:
+                costs[instance_type] = catalog[instance_type]['vcpus']
+
+    asg_client = primary_asg_cache.asg_client
+    fleets = []
+    for instance_type, asg_name in candidates:
+        cost = costs[instance_type]
+        if asg_name == primary_asg_name:
+            asg_cache = primary_asg_cache
+        else:
+            asg_cache = AsgStateCache(
+                asg_client,
+                asg_name,
+                ttl=primary_asg_cache.ttl,
+                min_update_interval=primary_asg_cache.min_update_interval,
+                max_staleness=primary_asg_cache.max_staleness,
+            )
+        fleets.append({'instance_type': instance_type, 'asg_name': asg_name, 'asg_cache': asg_cache, 'cost': cost})
+        log.info("Capacity planner candidate %s in ASG %s with cost %s" % (instance_type, asg_name, cost))
+    return fleets
+
+
+def _get_asg_hostnames(ec2, asg_name):
+    """
+    Get the hostnames of the running instances of the given ASG.
+
+    :param ec2: EC2 boto3 resource
+    :param asg_name: name of the ASG
+    :return: list of private DNS names
+    """
+    instances = ec2.instances.filter(Filters=[
+        {'Name': 'tag:aws:autoscaling:groupName', 'Values': [asg_name]},
+        {'Name': 'instance-state-name', 'Values': ['running']},
+    ])
+    return [instance.private_dns_name for instance in instances if instance.private_dns_name]
+
+
+def _scale_up_fleets(scheduler_module, fleets, plan, ec2, latency_log=None, prescale=0):
+    """
+    Raise the desired capacity of each ASG to run its planned nodes in addition to its nodes running jobs.
+
+    :param scheduler_module: scheduler specific module to use
+    :param fleets: candidate instance types, as returned by _get_compute_fleets
+    :param plan: dictionary instance_type -> number of nodes to launch
+    :param ec2: EC2 boto3 resource, used to find the nodes of each ASG
+    :param latency_log: LatencyLog recording the scale-up decisions, None to disable it
+    :param prescale: nodes to launch ahead of the demand, in the first ASG
+    """
+    for index, fleet in enumerate(fleets):
+        pending = plan.get(fleet['instance_type'], 0)
+        extra = max(prescale, 0) if index == 0 else 0
+        if pending + extra <= 0:
+            continue
+        hostnames = _get_asg_hostnames(ec2, fleet['asg_name'])
+        running = len(scheduler_module.get_nodes_with_jobs(hostnames)) if hostnames else 0
+        log.info("%s: %d nodes planned, %d nodes running jobs" % (fleet['instance_type'], pending, running))
+        _scale_up(fleet['asg_cache'], pending, running, running + pending + extra, latency_log)
+
+
+def _publish_cluster_state(cluster_state_file, asg_cache, stack_status, pending, filtered=None, last_scale_out=None,
+                           busy=None, warm_reserve=0):
+    """
+    Publish the ASG limits, the stack readiness and the pending demand for the compute nodes.
+
+    :param cluster_state_file: path of the state file on the shared filesystem
+    :param asg_cache: AsgStateCache of the compute fleet ASG
+    :param stack_status: StackStatus tracking the stack readiness
+    :param pending: number of nodes requested by pending jobs, None if unknown
+    :param filtered: jobs, slots and jobs per reason of the pending jobs that can't run, excluded from the demand
+    :param last_scale_out: time of the last scale-out decision, i.e. more nodes required than running jobs, None if
+        unknown
+    :param busy: number of nodes running jobs, None if unknown
+    :param warm_reserve: number of idle nodes to keep in addition to the demand
+    """
+    state = {'asg': asg_cache.get(), 'stack_ready': stack_status.is_ready(), 'pending_nodes': pending,
+             'filtered_demand': filtered, 'last_scale_out': last_scale_out, 'busy_nodes': busy,
+             'warm_reserve': warm_reserve}
+    write_cluster_state(cluster_state_file, state)
+
+
+def _get_forecaster(config, pcluster_dir):
+    """
+    Build the demand forecaster from the configuration, if predictive scaling is enabled.
+
+    :param config: jobwatcher configuration
+    :param pcluster_dir: Parallelcluster configuration folder, where the demand history is persisted
+    :return: a DemandForecaster, or None if forecast_model is not configured
+    """
+    if not config.has_option('jobwatcher', 'forecast_model'):
+        return None
+    model = config.get('jobwatcher', 'forecast_model')
+    if model == "NONE":
+        return None
+
+    alpha = _get_option(config, 'forecast_ewma_alpha', 0.3, config.getfloat)
+    if not 0 < alpha <= 1:
+        log.error("forecast_ewma_alpha config parameter '%s' is invalid, it must be greater than 0 and not greater "
+                  "than 1. Assuming 0.3" % alpha)
+        alpha = 0.3
+
+    history = DemandHistory(os.path.join(pcluster_dir, 'demand.history'))
+    forecaster = DemandForecaster(
+        history,
+        model,
+        horizon=_get_option(config, 'forecast_horizon', 10) * 60,
+        max_prescale=_get_option(config, 'prescale_max_nodes', 10),
+        alpha=alpha,
+        boot_time=_get_option(config, 'forecast_boot_time', 300),
+    )
+    log.info("Predictive scaling enabled with model %s" % model)
+    return forecaster
+
+
+def _get_warm_reserve(config, pcluster_dir, forecaster=None):
+    """
+    Build the warm reserve policy from the configuration, if enabled.
+
+    :param config: jobwatcher configuration
+    :param pcluster_dir: Parallelcluster configuration folder, where the demand history is persisted
+    :param forecaster: DemandForecaster sharing its demand history, if any
+    :return: a WarmReserve, or None if warm_reserve is not configured or invalid
+    """
+    if not config.has_option('jobwatcher', 'warm_reserve'):
+        return None
+    model = config.get('jobwatcher', 'warm_reserve')
+    if model == "NONE":
+        return None
+    if model not in WarmReserve.models:
+        log.error("warm_reserve config parameter '%s' is invalid. Warm reserve disabled" % model)
+        return None
+
+    schedule = None
+    history = None
+    if model == 'schedule':
+        try:
+            schedule = parse_reserve_schedule(config.get('jobwatcher', 'warm_reserve_schedule'))
+        except (ConfigParser.NoOptionError, ValueError) as e:
+            log.error("Unable to read warm_reserve_schedule, warm reserve disabled: %s" % e)
+            return None
+    else:
+        history = forecaster.history if forecaster else DemandHistory(os.path.join(pcluster_dir, 'demand.history'))
+
+    log.info("Warm reserve enabled with model %s" % model)
+    return WarmReserve(
+        model,
+        history,
+        horizon=_get_option(config, 'warm_reserve_horizon', 10) * 60,
+        window=_get_option(config, 'warm_reserve_window', 30) * 60,
+        max_reserve=_get_option(config, 'warm_reserve_max_nodes', 10),
+        schedule=schedule,
+    )
+
 
 def main():
     logging.basicConfig(
@@ -208,26 +623,104 @@ def main():
         with open(_configfilename, 'w') as configfile:
             config.write(configfile)
 
-    # fetch the pricing file on startup
-    _fetch_pricing_file(pcluster_dir, region, proxy_config)
+    instances_source = None
+    if config.has_option('jobwatcher', 'instances_source'):
+        instances_source = config.get('jobwatcher', 'instances_source')
+
+    # fetch the pricing file on startup, if changed, and load the compiled catalog
+    _fetch_pricing_file(pcluster_dir, region, proxy_config, instances_source)
+    catalog = _load_catalog(pcluster_dir)
+
+    # polling intervals, the defaults keep the fixed 60 seconds cycle
+    min_interval = _get_option(config, 'poll_interval_min', 60)
+    max_interval = max(min_interval, _get_option(config, 'poll_interval_max', 60))
+    trigger_sock = None
+    if config.has_option('jobwatcher', 'trigger_socket'):
+        trigger_socket_group = config.get('jobwatcher', 'trigger_socket_group') \
+            if config.has_option('jobwatcher', 'trigger_socket_group') else None
+        trigger_sock = open_trigger_socket(config.get('jobwatcher', 'trigger_socket'), trigger_socket_group)
+
+    forecaster = _get_forecaster(config, pcluster_dir)
+    warm_reserve = _get_warm_reserve(config, pcluster_dir, forecaster)
+
+    # cache the ASG state between cycles, it's refreshed by our updates and every asg_cache_ttl seconds, or every
+    # asg_max_staleness seconds while the desired capacity seems to cover the demand
+    asg_cache = AsgStateCache(
+        boto3.client('autoscaling', region_name=region, config=proxy_config),
+        asg_name,
+        ttl=_get_option(config, 'asg_cache_ttl', 120),
+        min_update_interval=_get_option(config, 'asg_min_update_interval', 30),
+        max_staleness=_get_option(config, 'asg_max_staleness', 90),
+    )
 
     # load scheduler
     s = _load_scheduler_module(scheduler)
 
+    # plan the capacity across several instance types and ASGs, if configured
+    fleets = _get_compute_fleets(config, catalog, asg_name, asg_cache)
+    if fleets and not hasattr(s, 'get_pending_jobs_info'):
+        log.warning("Capacity planning not supported by scheduler %s, scaling %s only" % (scheduler, asg_name))
+        fleets = None
+    if fleets:
+        planner_objective = config.get('jobwatcher', 'planner_objective') \
+            if config.has_option('jobwatcher', 'planner_objective') else 'cost'
+        if planner_objective not in ('cost', 'nodes'):
+            log.error("planner_objective config parameter '%s' is invalid. Assuming 'cost'" % planner_objective)
+            planner_objective = 'cost'
+        ec2 = boto3.resource('ec2', region_name=region, config=proxy_config)
+
+    cluster_state_file = None
+    last_scale_out = None
+    if config.has_option('jobwatcher', 'cluster_state_file'):
+        cluster_state_file = config.get('jobwatcher', 'cluster_state_file')
+        stack_status = StackStatus(stack_name, region, proxy_config)
+        # keep the scale-in cooldown of the nodes across restarts
+        last_state = read_cluster_state(cluster_state_file, max_age=float('inf'))
+        last_scale_out = last_state.get('last_scale_out') if last_state else None
+
+    reaper = None
+    if config.has_option('jobwatcher', 'idle_reports_dir'):
+        reaper = IdleNodesReaper(
+            s,
+            asg_cache,
+            config.get('jobwatcher', 'idle_reports_dir'),
+            batch_size=_get_option(config, 'reaper_batch_size', 50),
+            terminate_interval=_get_option(config, 'reaper_terminate_interval', 0.5, config.getfloat),
+            scalein_cooldown=_get_option(config, 'scalein_cooldown', 0) * 60,
+            min_node_lifetime=_get_option(config, 'min_node_lifetime', 0) * 60,
+            max_duration=_get_option(config, 'reaper_max_duration', 10, config.getfloat),
+        )
+        log.info("Idle nodes will be released by jobwatcher")
+
+    latency_log = None
+    if config.has_option('jobwatcher', 'latency_dir'):
+        latency_log = get_latency_log(config.get('jobwatcher', 'latency_dir'), 'jobwatcher')
+
+    interval = min_interval
     while True:
+        pending = 0
+        running = None
+        reserve = 0
         # get the number of vcpu's per compute instance
-        instance_properties = _get_instance_properties(instance_type)
+        instance_properties = _get_instance_properties(catalog, instance_type)
         if instance_properties.get('slots') <= 0:
             log.critical("Error detecting number of slots per instance. The cluster will not scale up.")
 
         else:
             # Get number of nodes requested
-            pending = s.get_required_nodes(instance_properties)
+            plan = None
+            if fleets:
+                for fleet in fleets:
+                    fleet.update(_get_instance_properties(catalog, fleet['instance_type']))
+                plan = plan_capacity(s.get_pending_jobs_info(), fleets, planner_objective)
+                pending = sum(plan.values())
+            else:
+                pending = s.get_required_nodes(instance_properties)
 
             if pending < 0:
                 log.critical("Error detecting number of required nodes. The cluster will not scale up.")
 
-            elif pending == 0:
+            elif pending == 0 and forecaster is None and reaper is None and warm_reserve is None:
                 log.debug("There are no pending jobs. Noop.")
 
             else:
@@ -235,39 +728,38 @@ def main():
                 running = s.get_busy_nodes(instance_properties)
                 log.info("%s jobs pending; %s jobs running" % (pending, running))
 
-                # connect to asg
-                asg_client = boto3.client('autoscaling', region_name=region, config=proxy_config)
-
-                # get current limits
-                asg = asg_client.describe_auto_scaling_groups(AutoScalingGroupNames=[asg_name]).get('AutoScalingGroups')[0]
-
-                min_size = asg.get('MinSize')
-                current_desired = asg.get('DesiredCapacity')
-                max_size = asg.get('MaxSize')
-                log.info("min/desired/max %d/%d/%d" % (min_size, current_desired, max_size))
-                log.info("%d nodes requested, %d nodes running" % (pending, running))
-
-                # Check to make sure requested number of instances is within ASG limits
                 required = running + pending
-                if required <= current_desired:
-                    log.info("%d nodes required, %d nodes in asg. Noop" % (required, current_desired))
-                else:
-                    if required > max_size:
-                        log.info(
-                            "The number of required nodes %d is greater than max %d. Requesting max %d."
-                            % (required, max_size, max_size)
-                        )
-                    else:
-                        log.info(
-                            "Setting desired to %d nodes, requesting %d more nodes from asg."
-                            % (required, required - current_desired)
-                        )
-                    requested = min(required, max_size)
-
-                    # update ASG
-                    asg_client.update_auto_scaling_group(AutoScalingGroupName=asg_name, DesiredCapacity=requested)
-
-        time.sleep(60)
+                if forecaster:
+                    required = forecaster.get_target(time.time(), pending, running)
+
+                if required > running:
+                    # more nodes than the ones running jobs are needed, hold the release of idle nodes
+                    last_scale_out = time.time()
+                if warm_reserve:
+                    # keep idle nodes ready for the demand expected in the next minutes
+                    reserve = warm_reserve.get_reserve(time.time(), pending, running)
+                    if reserve:
+                        log.info("Keeping a warm reserve of %d idle nodes" % reserve)
+                    required = max(required, running + pending + reserve)
+                if plan is not None:
+                    _scale_up_fleets(s, fleets, plan, ec2, latency_log, prescale=required - running - pending)
+                elif required > running:
+                    _scale_up(asg_cache, pending, running, required, latency_log)
+
+                # as nodewatcher does, never release nodes while there are pending jobs
+                if reaper and pending == 0:
+                    reaper.reap(required, last_scale_out)
+
+        if cluster_state_file:
+            valid_pending = pending if instance_properties.get('slots') > 0 and pending >= 0 else None
+            _publish_cluster_state(
+                cluster_state_file, asg_cache, stack_status, valid_pending, get_filtered_demand(), last_scale_out,
+                running, reserve,
+            )
+
+        interval = next_poll_interval(interval, pending > 0, min_interval, max_interval)
+        log.debug("Waiting up to %d seconds for the next cycle" % interval)
+        wait_for_trigger(trigger_sock, interval)
 
 
 if __name__ == '__main__':
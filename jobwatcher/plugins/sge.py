@@ -1,22 +1,121 @@
 import logging
 import json
-from utils import run_command
+import time
+import xml.etree.ElementTree as ET
+from utils import run_command, get_optimal_nodes, parse_memory, set_filtered_jobs
 
 log = logging.getLogger(__name__)
 
-# get nodes requested from pending jobs
-def get_required_nodes(instance_properties):
-    command = "/opt/sge/bin/lx-amd64/qstat -g d -s p -u '*'"
+# memory requests, per slot for consumable resources
+memory_resources = ('h_vmem', 'mem_free')
+# parallel environments allocation rules, cached for pe_cache_ttl seconds
+pe_cache_ttl = 300
+_allocation_rules = {}
+
+
+def _get_allocation_rule(pe_name):
+    cached = _allocation_rules.get(pe_name)
+    if cached and cached[1] > time.time():
+        return cached[0]
+
+    command = "/opt/sge/bin/lx-amd64/qconf -sp %s" % pe_name
+    # Sample output:
+    # pe_name            mpi
+    # slots              9999
+    # allocation_rule    $fill_up
     _output = run_command(command, {'SGE_ROOT': '/opt/sge',
                                     'PATH': '/opt/sge/bin:/opt/sge/bin/lx-amd64:/bin:/usr/bin'})
-    slots = 0
-    output = _output.split("\n")[2:]
-    for line in output:
+    allocation_rule = None
+    for line in _output.split("\n"):
         line_arr = line.split()
-        if len(line_arr) >= 8:
-            slots += int(line_arr[7])
-    vcpus = instance_properties.get('slots')
-    return -(-slots // vcpus)
+        if len(line_arr) == 2 and line_arr[0] == 'allocation_rule':
+            allocation_rule = line_arr[1]
+    if allocation_rule is None:
+        log.warning("Unable to get the allocation rule of parallel environment %s, assuming $fill_up" % pe_name)
+        allocation_rule = '$fill_up'
+    _allocation_rules[pe_name] = (allocation_rule, time.time() + pe_cache_ttl)
+    return allocation_rule
+
+
+def _get_min_slots(slot_range):
+    # Slot range requested for the parallel environment, e.g. 8, 4-8, 4- or -8
+    low = slot_range.strip().split('-')[0]
+    return int(low) if low.isdigit() else 1
+
+
+def _get_pe_nodes(allocation_rule, slots):
+    # $pe_slots places all the slots on a single host, an integer rule places that many slots on each host,
+    # $fill_up and $round_robin use as many hosts as needed, the packer adds nodes when a node is full
+    if allocation_rule.isdigit() and int(allocation_rule) > 0:
+        return -(-slots // int(allocation_rule))
+    return 1
+
+
+def _get_pending_jobs():
+    command = "/opt/sge/bin/lx-amd64/qstat -xml -g d -r -s p -u '*'"
+    # Sample output:
+    # <job_info>
+    #   <queue_info/>
+    #   <job_info>
+    #     <job_list state="pending">
+    #       <JB_job_number>42</JB_job_number>
+    #       <state>qw</state>
+    #       <slots>8</slots>
+    #       <hard_request name="h_vmem" resource_contribution="0.000000">2G</hard_request>
+    #       <requested_pe name="mpi">4-8</requested_pe>
+    #     </job_list>
+    #   </job_info>
+    # </job_info>
+    _output = run_command(command, {'SGE_ROOT': '/opt/sge',
+                                    'PATH': '/opt/sge/bin:/opt/sge/bin/lx-amd64:/bin:/usr/bin'})
+    try:
+        root = ET.fromstring(_output)
+    except Exception:
+        log.error("Unable to parse output of %s: %s" % (command, _output))
+        return []
+
+    jobs = []
+    filtered = []
+    for job in root.findall('.//job_list'):
+        slots = int(job.findtext('slots') or 1)
+        state = job.findtext('state') or ''
+        if 'h' in state or 'E' in state:
+            # held jobs, e.g. hqw for a user hold or a dependency, and jobs in error, e.g. Eqw, can't start
+            filtered.append((job.findtext('JB_job_number'), state, 1, slots))
+            continue
+        nodes = 1
+        allocation_rule = None
+        requested_pe = job.find('requested_pe')
+        if requested_pe is not None:
+            # the job can start with the lowest number of slots of its range
+            slots = _get_min_slots(requested_pe.text or '')
+            allocation_rule = _get_allocation_rule(requested_pe.get('name'))
+            nodes = _get_pe_nodes(allocation_rule, slots)
+        memory_per_slot = 0
+        for request in job.findall('hard_request'):
+            if request.get('name') in memory_resources:
+                # plain amounts are in bytes
+                memory_per_slot = max(memory_per_slot, parse_memory(request.text or '', default_unit='b'))
+        jobs.append((nodes, slots, memory_per_slot * slots, None, 1, allocation_rule == '$pe_slots'))
+    set_filtered_jobs(filtered)
+    return jobs
+
+
+# get the nodes, slots, memory, resources, count and single host constraint of each pending job that can run
+def get_pending_jobs_info():
+    return _get_pending_jobs()
+
+
+# get nodes requested from pending jobs
+def get_required_nodes(instance_properties):
+    jobs = _get_pending_jobs()
+    nodes_requested = [job[0] for job in jobs]
+    slots_requested = [job[1] for job in jobs]
+    memory_requested = [job[2] for job in jobs]
+    single_host_requested = [job[5] for job in jobs]
+    return get_optimal_nodes(nodes_requested, slots_requested, instance_properties, memory_requested,
+                             single_host_requested=single_host_requested)
+
 
 # get nodes reserved by running jobs
 # if a host has 1 or more job running on it, it'll be marked busy
@@ -35,3 +134,39 @@ def get_busy_nodes(instance_properties):
                 nodes += 1
     return nodes
 
+
+def _queue_instances(hostnames):
+    return ' '.join('all.q@%s' % hostname for hostname in hostnames)
+
+
+# disable the queue on the given hosts, so that no new job is scheduled on them
+def drain_nodes(hostnames):
+    command = "/opt/sge/bin/lx-amd64/qmod -d %s" % _queue_instances(hostnames)
+    run_command(command, {'SGE_ROOT': '/opt/sge',
+                          'PATH': '/opt/sge/bin:/opt/sge/bin/lx-amd64:/bin:/usr/bin'})
+
+
+# enable the queue on hosts previously drained
+def resume_nodes(hostnames):
+    command = "/opt/sge/bin/lx-amd64/qmod -e %s" % _queue_instances(hostnames)
+    run_command(command, {'SGE_ROOT': '/opt/sge',
+                          'PATH': '/opt/sge/bin:/opt/sge/bin/lx-amd64:/bin:/usr/bin'})
+
+
+# get the subset of the given hosts that are still running jobs
+def get_nodes_with_jobs(hostnames):
+    command = "/opt/sge/bin/lx-amd64/qstat -f -q all.q -u '*'"
+    # Sample output:
+    # queuename                      qtype resv/used/tot. load_avg arch          states
+    # ---------------------------------------------------------------------------------
+    # all.q@ip-172-31-68-26.ec2.inte BIP   0/1/4          0.01     lx-amd64      d
+    _output = run_command(command, {'SGE_ROOT': '/opt/sge',
+                                    'PATH': '/opt/sge/bin:/opt/sge/bin/lx-amd64:/bin:/usr/bin'})
+    busy = set()
+    for line in _output.split("\n"):
+        line_arr = line.split()
+        if len(line_arr) >= 5 and line_arr[0].startswith('all.q@'):
+            (resv, used, total) = line_arr[2].split('/')
+            if int(used) > 0 or int(resv) > 0:
+                busy.add(line_arr[0].split('@')[1].split('.')[0])
+    return [hostname for hostname in hostnames if hostname.split('.')[0] in busy]
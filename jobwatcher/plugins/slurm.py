@@ -1,27 +1,124 @@
 import logging
-from utils import run_command, get_optimal_nodes
+from utils import run_command, get_optimal_nodes, parse_memory, set_filtered_jobs
 
 
 log = logging.getLogger(__name__)
 
+# pending reasons of the jobs that can't run however many nodes are launched, besides the association and QOS limits
+blocked_reasons = ('Dependency', 'DependencyNeverSatisfied', 'JobHeldUser', 'JobHeldAdmin', 'BeginTime')
 
-# get nodes requested from pending jobs
-def get_required_nodes(instance_properties):
-    command = "/opt/slurm/bin/squeue -r -h -o '%i %t %D %C'"
-    # Example output of squeue
-    # 25 PD 1 24
-    # 26 R 1 24
+
+def _get_job_memory(value, nodes, slots):
+    # Memory per node, or per cpu when suffixed by c, e.g. 4000M or 2G or 1000Mc
+    per_cpu = value.endswith('c')
+    memory = parse_memory(value.rstrip('cn'))
+    return memory * slots if per_cpu else memory * nodes
+
+
+def _get_job_resources(value, nodes):
+    # Generic resources per node, e.g. gpu:2 or gres:gpu:tesla:2 or (null)
+    resources = {}
+    for gres in value.split(','):
+        gres = gres.split('(')[0]
+        if gres.startswith('gres:'):
+            gres = gres[len('gres:'):]
+        gres_arr = gres.split(':')
+        if not gres_arr[0] or gres_arr[0] in ('(null)', 'N/A'):
+            continue
+        count = int(gres_arr[-1]) if len(gres_arr) > 1 and gres_arr[-1].isdigit() else 1
+        resources[gres_arr[0]] = resources.get(gres_arr[0], 0) + count * nodes
+    return resources
+
+
+def _get_array_tasks(job_id):
+    """
+    Parse the pending tasks of a job array, as printed by squeue without -r, e.g. 73_[1-200000%500] or 74_[1,5-9:2].
+
+    :param job_id: the job id
+    :return: the array job id, the number of pending tasks and the throttle limit, None if not throttled, for the
+        pending tasks of an array, None otherwise
+    """
+    if not job_id.endswith(']') or '_[' not in job_id:
+        return None
+    array_id, tasks = job_id[:-1].split('_[', 1)
+    throttle = None
+    if '%' in tasks:
+        tasks, limit = tasks.split('%', 1)
+        throttle = int(limit) if limit.isdigit() and int(limit) > 0 else None
+    count = 0
+    for task_range in tasks.split(','):
+        task_range, step = (task_range.split(':', 1) + ['1'])[:2]
+        bounds = task_range.split('-')
+        if not all(bound.isdigit() for bound in bounds) or not step.isdigit() or int(step) <= 0:
+            log.warning("Unable to parse array tasks %s of job %s" % (task_range, array_id))
+            continue
+        first, last = int(bounds[0]), int(bounds[-1])
+        if last >= first:
+            count += (last - first) // int(step) + 1
+    return array_id, count, throttle
+
+
+def _is_blocked(reason):
+    # Held jobs, jobs waiting for a dependency or their begin time, and jobs beyond an association or QOS limit,
+    # e.g. AssocGrpCpuLimit or QOSMaxJobsPerUserLimit
+    return reason in blocked_reasons or (reason.startswith(('Assoc', 'QOS')) and reason.endswith('Limit'))
+
+
+# get the nodes, slots, memory, generic resources and number of tasks requested by each pending job that can run
+def get_pending_jobs_info():
+    command = "/opt/slurm/bin/squeue -h -o '%i %t %D %C %m %b %r'"
+    # Example output of squeue, the pending tasks of a job array are compressed in a single line
+    # 25 PD 1 24 4000M (null) Resources
+    # 26 R 1 24 2G gpu:2 None
+    # 27 PD 1 4 4000M (null) Dependency
+    # 73_[3-200000%500] PD 1 1 1000M (null) Priority
+    # 73_1 R 1 1 1000M (null) None
     _output = run_command(command, {})
-    slots_requested = []
-    nodes_requested = []
+    jobs = []
+    filtered = []
+    running_tasks = {}
     output = _output.split("\n")
     for line in output:
         line_arr = line.split()
-        if len(line_arr) == 4 and line_arr[1] == 'PD':
-            slots_requested.append(int(line_arr[3]))
-            nodes_requested.append(int(line_arr[2]))
+        if len(line_arr) != 7:
+            continue
+        if line_arr[1] != 'PD':
+            # running tasks count against the throttle limit of their array
+            array_id = line_arr[0].split('_')[0]
+            running_tasks[array_id] = running_tasks.get(array_id, 0) + 1
+            continue
+        nodes = int(line_arr[2])
+        slots = int(line_arr[3])
+        array_tasks = _get_array_tasks(line_arr[0])
+        if _is_blocked(line_arr[6]):
+            filtered.append((line_arr[0], line_arr[6], array_tasks[1] if array_tasks else 1, slots))
+            continue
+        jobs.append([nodes, slots, _get_job_memory(line_arr[4], nodes, slots),
+                     _get_job_resources(line_arr[5], nodes), array_tasks])
+
+    for job in jobs:
+        array_tasks = job.pop()
+        count = 1
+        if array_tasks:
+            array_id, count, throttle = array_tasks
+            if throttle is not None:
+                # only the tasks allowed by the throttle limit can start
+                count = max(0, min(count, throttle - running_tasks.get(array_id, 0)))
+        job.append(count)
+    set_filtered_jobs(filtered)
+    return [tuple(job) for job in jobs if job[4] > 0]
 
-    return get_optimal_nodes(nodes_requested, slots_requested, instance_properties)
+
+# get nodes requested from pending jobs
+def get_required_nodes(instance_properties):
+    jobs = get_pending_jobs_info()
+    nodes_requested = [job[0] for job in jobs]
+    slots_requested = [job[1] for job in jobs]
+    memory_requested = [job[2] for job in jobs]
+    resources_requested = [job[3] for job in jobs]
+    counts_requested = [job[4] for job in jobs]
+    return get_optimal_nodes(nodes_requested, slots_requested, instance_properties, memory_requested,
+                             resources_requested, counts_requested)
 
 
 # get nodes reserved by running jobs
@@ -39,3 +136,62 @@ def get_busy_nodes(instance_properties):
         if len(line_arr) == 2 and (line_arr[1] == 'mix' or line_arr[1] == 'alloc'):
             nodes += int(line_arr[0])
     return nodes
+
+
+def _get_node_names(hostnames):
+    """
+    Map the given hostnames to Slurm node names.
+
+    Node names match the short hostname, except for the nodes of a pre-provisioned pool, bound to the instances by
+    sqswatcher through their NodeHostname.
+
+    :param hostnames: list of hostnames
+    :return: dictionary hostname -> node name
+    """
+    command = "/opt/slurm/bin/sinfo -h -N -o '%N %n'"
+    # Sample output:
+    # compute-1 ip-10-0-0-10
+    # compute-2 ip-10-0-0-11
+    _output = run_command(command, {})
+    bound_nodes = {}
+    for line in _output.split("\n"):
+        line_arr = line.split()
+        if len(line_arr) == 2:
+            bound_nodes[line_arr[1]] = line_arr[0]
+
+    node_names = {}
+    for hostname in hostnames:
+        # Slurm won't use FQDN
+        short_name = hostname.split('.')[0]
+        node_names[hostname] = bound_nodes.get(short_name, short_name)
+    return node_names
+
+
+# drain the given nodes, so that no new job is scheduled on them
+def drain_nodes(hostnames):
+    command = "/opt/slurm/bin/scontrol update nodename=%s state=drain reason='Scaling down idle nodes'" \
+              % ','.join(_get_node_names(hostnames).values())
+    run_command(command, {})
+
+
+# put back in service nodes previously drained
+def resume_nodes(hostnames):
+    command = "/opt/slurm/bin/scontrol update nodename=%s state=resume" % ','.join(_get_node_names(hostnames).values())
+    run_command(command, {})
+
+
+# get the subset of the given hosts that are still running jobs
+def get_nodes_with_jobs(hostnames):
+    node_names = _get_node_names(hostnames)
+    command = "/opt/slurm/bin/sinfo -h -N -n %s -o '%%N %%T'" % ','.join(node_names.values())
+    # Sample output:
+    # ip-10-0-0-10 drained
+    # ip-10-0-0-11 draining
+    _output = run_command(command, {})
+    busy = set()
+    for line in _output.split("\n"):
+        line_arr = line.split()
+        # strip power saving and not responding flags, e.g. idle~ or mixed*
+        if len(line_arr) == 2 and line_arr[1].rstrip('*~#%$@') in ('allocated', 'mixed', 'completing', 'draining'):
+            busy.add(line_arr[0])
+    return [hostname for hostname in hostnames if node_names[hostname] in busy]
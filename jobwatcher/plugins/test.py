@@ -14,6 +14,7 @@ import logging
 
 log = logging.getLogger(__name__)
 
+
 # get nodes requested from pending jobs
 def get_required_nodes(instance_properties):
     # Test function. Change as needed.
@@ -21,6 +22,13 @@ def get_required_nodes(instance_properties):
     vcpus = instance_properties.get('slots')
     return -(-slots // vcpus)
 
+
+# get the nodes and slots requested by each pending job
+def get_pending_jobs_info():
+    # Test function. Change as needed.
+    return [(1, 4)]
+
+
 # get nodes reserved by running jobs
 def get_busy_nodes(instance_properties):
     # Test function. Change as needed.
@@ -28,6 +36,7 @@ def get_busy_nodes(instance_properties):
     vcpus = instance_properties.get('slots')
     return -(-slots // vcpus)
 
+
 def nodes(slots, instance_properties):
     if slots <= 0:
         return 0
@@ -36,3 +45,16 @@ def nodes(slots, instance_properties):
         vcpus = int(instances[instance_type]["vcpus"])
         log.info("Instance %s has %s slots." % (instance_type, vcpus))
         return
+
+
+def drain_nodes(hostnames):
+    pass
+
+
+def resume_nodes(hostnames):
+    pass
+
+
+def get_nodes_with_jobs(hostnames):
+    # Test function. Change as needed.
+    return []
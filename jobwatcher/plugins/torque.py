@@ -1,11 +1,11 @@
 import logging
 import xml.etree.ElementTree as ET
-from utils import run_command, get_optimal_nodes
+from utils import run_command, get_optimal_nodes, parse_memory, set_filtered_jobs
 
 log = logging.getLogger(__name__)
 
-# get nodes requested from pending jobs
-def get_required_nodes(instance_properties):
+# get the nodes, slots and memory requested by each pending job that can run
+def get_pending_jobs_info():
     command = "/opt/torque/bin/qstat -at"
 
     # Example output of torque
@@ -14,21 +14,34 @@ def get_required_nodes(instance_properties):
     # ----------------------- ----------- -------- ---------------- ------ ----- ------ --------- --------- - ---------
     # 0.ip-172-31-11-1.ec2.i  centos      batch    job.sh             5343     5     30       --   01:00:00 Q  00:04:58
     # 1.ip-172-31-11-1.ec2.i  centos      batch    job.sh             5340     3      6       --   01:00:00 R  00:08:14
-    # 2.ip-172-31-11-1.ec2.i  centos      batch    job.sh             5387     2      4       --   01:00:00 R  00:08:27
+    # 2.ip-172-31-11-1.ec2.i  centos      batch    job.sh             5387     2      4      8gb   01:00:00 Q       --
 
     status = ['Q']
+    # held jobs, e.g. waiting for a dependency, and jobs waiting for their execution time can't start
+    blocked_status = {'H': 'Held', 'W': 'Waiting'}
     _output = run_command(command, {})
     output = _output.split("\n")[5:]
-    slots_requested = []
-    nodes_requested = []
+    jobs = []
+    filtered = []
     for line in output:
         line_arr = line.split()
-        if len(line_arr) >= 10 and line_arr[9] in status:
+        if len(line_arr) >= 10 and line_arr[9] in blocked_status:
+            filtered.append((line_arr[0], blocked_status[line_arr[9]], 1, int(line_arr[6])))
+        elif len(line_arr) >= 10 and line_arr[9] in status:
             # if a job has been looked at to account for pending nodes, don't look at it again
-            slots_requested.append(int(line_arr[6]))
-            nodes_requested.append(int(line_arr[5]))
+            # the mem resource is the memory of the whole job, in bytes if not suffixed
+            jobs.append((int(line_arr[5]), int(line_arr[6]), parse_memory(line_arr[7], default_unit='b')))
+    set_filtered_jobs(filtered)
+    return jobs
 
-    return get_optimal_nodes(nodes_requested, slots_requested, instance_properties)
+
+# get nodes requested from pending jobs
+def get_required_nodes(instance_properties):
+    jobs = get_pending_jobs_info()
+    nodes_requested = [job[0] for job in jobs]
+    slots_requested = [job[1] for job in jobs]
+    memory_requested = [job[2] for job in jobs]
+    return get_optimal_nodes(nodes_requested, slots_requested, instance_properties, memory_requested)
 
 
 # get nodes reserved by running jobs
@@ -57,3 +70,36 @@ def get_busy_nodes(instance_properties):
         if len(node.findall('jobs')) != 0:
             count += 1
     return count
+
+
+def _short_names(hostnames):
+    return ' '.join(hostname.split('.')[0] for hostname in hostnames)
+
+
+# mark the given nodes offline, so that no new job is scheduled on them
+def drain_nodes(hostnames):
+    command = "/opt/torque/bin/pbsnodes -o %s" % _short_names(hostnames)
+    run_command(command, {})
+
+
+# clear the offline state of nodes previously drained
+def resume_nodes(hostnames):
+    command = "/opt/torque/bin/pbsnodes -c %s" % _short_names(hostnames)
+    run_command(command, {})
+
+
+# get the subset of the given hosts that are still running jobs
+def get_nodes_with_jobs(hostnames):
+    command = "/opt/torque/bin/pbsnodes -x %s" % _short_names(hostnames)
+    _output = run_command(command, {})
+    busy = set()
+    try:
+        root = ET.fromstring(_output)
+    except Exception:
+        log.error("Unable to parse output of %s: %s" % (command, _output))
+        # assume all the nodes are busy, they will be checked again at the next cycle
+        return hostnames
+    for node in root.findall('Node'):
+        if len(node.findall('jobs')) != 0:
+            busy.add(node.findtext('name').split('.')[0])
+    return [hostname for hostname in hostnames if hostname.split('.')[0] in busy]
@@ -1,6 +1,24 @@
+import grp
+import json
+import os
+import pickle
+import shutil
+import slurm
+import stat
+import tempfile
+import threading
+import time
 import utils
 import unittest
 
+from jobwatcher import trigger
+
+try:
+    from jobwatcher import jobwatcher
+except ImportError:
+    # boto3 not installed
+    jobwatcher = None
+
 instance_properties = {'slots': 8}
 
 
@@ -35,6 +53,298 @@ class optimal_node_count_tests(unittest.TestCase):
         expected = 6
         self.assertEqual(nodes, expected, "test_each_node_partial_capacity failed: Got %s; Expected: %s" % (nodes, expected))
 
+    def test_memory_bound_jobs(self):
+        properties = {'slots': 8, 'memory': 16384}
+        nodes = utils.get_optimal_nodes([1, 1, 1, 1], [1, 1, 1, 1], properties, [12288, 12288, 2048, 2048])
+        expected = 2
+        self.assertEqual(nodes, expected, "test_memory_bound_jobs failed: Got %s; Expected: %s" % (nodes, expected))
+
+    def test_memory_spread_across_nodes(self):
+        properties = {'slots': 8, 'memory': 16384}
+        nodes = utils.get_optimal_nodes([1], [8], properties, [65536])
+        expected = 4
+        self.assertEqual(nodes, expected, "test_memory_spread_across_nodes failed: Got %s; Expected: %s"
+                         % (nodes, expected))
+
+    def test_generic_resources(self):
+        properties = {'slots': 8, 'memory': 16384, 'resources': {'gpu': 1}}
+        nodes = utils.get_optimal_nodes([1, 1, 1], [1, 1, 1], properties, None, [{'gpu': 1}, {'gpu': 1}, {}])
+        expected = 2
+        self.assertEqual(nodes, expected, "test_generic_resources failed: Got %s; Expected: %s" % (nodes, expected))
+
+    def test_unavailable_resources(self):
+        nodes = utils.get_optimal_nodes([1, 1], [1, 1], instance_properties, None, [{'gpu': 1}, {}])
+        expected = 1
+        self.assertEqual(nodes, expected, "test_unavailable_resources failed: Got %s; Expected: %s" % (nodes, expected))
+
+    def test_array_tasks(self):
+        nodes = utils.get_optimal_nodes([1, 1], [6, 1], instance_properties, None, None, [1, 200000])
+        expected = 25001
+        self.assertEqual(nodes, expected, "test_array_tasks failed: Got %s; Expected: %s" % (nodes, expected))
+
+    def test_multi_node_array_tasks(self):
+        nodes = utils.get_optimal_nodes([2, 1], [8, 4], instance_properties, None, None, [3, 3])
+        expected = 5
+        self.assertEqual(nodes, expected, "test_multi_node_array_tasks failed: Got %s; Expected: %s"
+                         % (nodes, expected))
+
+    def test_large_multi_node_array_tasks(self):
+        nodes = utils.get_optimal_nodes([2, 3], [8, 6], instance_properties, None, None, [200000, 100000])
+        expected = 275000
+        self.assertEqual(nodes, expected, "test_large_multi_node_array_tasks failed: Got %s; Expected: %s"
+                         % (nodes, expected))
+
+    def test_single_host_jobs(self):
+        nodes = utils.get_optimal_nodes([1, 1], [16, 6], instance_properties, None, None, None, [True, True])
+        expected = 1
+        self.assertEqual(nodes, expected, "test_single_host_jobs failed: Got %s; Expected: %s" % (nodes, expected))
+
+
+class parse_memory_tests(unittest.TestCase):
+    def test_units(self):
+        for value, default_unit, expected in [('4000M', 'm', 4000), ('2G', 'm', 2048), ('1.5gb', 'b', 1536),
+                                              ('512mb', 'b', 512), ('1073741824', 'b', 1024), ('1000', 'm', 1000),
+                                              ('--', 'b', 0), ('0', 'm', 0)]:
+            memory = utils.parse_memory(value, default_unit)
+            self.assertEqual(memory, expected, "test_units failed for %s: Got %s; Expected: %s"
+                             % (value, memory, expected))
+
+
+small = {'instance_type': 'small', 'slots': 4, 'cost': 4}
+large = {'instance_type': 'large', 'slots': 32, 'cost': 32}
+
+
+class plan_capacity_tests(unittest.TestCase):
+    def test_empty_queue(self):
+        plan = utils.plan_capacity([], [small, large])
+        expected = {'small': 0, 'large': 0}
+        self.assertEqual(plan, expected, "test_empty_queue failed. Got %s; Expected: %s" % (plan, expected))
+
+    def test_large_jobs_use_large_nodes(self):
+        plan = utils.plan_capacity([(1, 32), (1, 30)], [small, large], 'nodes')
+        expected = {'small': 0, 'large': 2}
+        self.assertEqual(plan, expected, "test_large_jobs_use_large_nodes failed. Got %s; Expected: %s"
+                         % (plan, expected))
+
+    def test_small_jobs_use_small_nodes(self):
+        plan = utils.plan_capacity([(1, 2), (1, 4)], [small, large])
+        expected = {'small': 2, 'large': 0}
+        self.assertEqual(plan, expected, "test_small_jobs_use_small_nodes failed. Got %s; Expected: %s"
+                         % (plan, expected))
+
+    def test_small_jobs_fill_large_nodes(self):
+        plan = utils.plan_capacity([(1, 24), (1, 4), (1, 2), (1, 2)], [small, large])
+        expected = {'small': 0, 'large': 1}
+        self.assertEqual(plan, expected, "test_small_jobs_fill_large_nodes failed. Got %s; Expected: %s"
+                         % (plan, expected))
+
+    def test_cheaper_per_slot_wins(self):
+        discounted = dict(large, cost=16)
+        plan = utils.plan_capacity([(1, 4)] * 8, [small, discounted])
+        expected = {'small': 0, 'large': 1}
+        self.assertEqual(plan, expected, "test_cheaper_per_slot_wins failed. Got %s; Expected: %s" % (plan, expected))
+
+    def test_memory_picks_large_nodes(self):
+        instance_types = [dict(small, memory=8192), dict(large, memory=65536)]
+        plan = utils.plan_capacity([(1, 1, 20000), (1, 1, 20000)], instance_types)
+        expected = {'small': 0, 'large': 1}
+        self.assertEqual(plan, expected, "test_memory_picks_large_nodes failed. Got %s; Expected: %s"
+                         % (plan, expected))
+
+    def test_multi_node_jobs(self):
+        plan = utils.plan_capacity([(2, 48), (4, 8)], [small, large], 'nodes')
+        expected = {'small': 0, 'large': 4}
+        self.assertEqual(plan, expected, "test_multi_node_jobs failed. Got %s; Expected: %s" % (plan, expected))
+
+    def test_array_tasks(self):
+        plan = utils.plan_capacity([(1, 4, 0, None, 64)], [small, large], 'nodes')
+        expected = {'small': 0, 'large': 8}
+        self.assertEqual(plan, expected, "test_array_tasks failed. Got %s; Expected: %s" % (plan, expected))
+
+    def test_single_host_jobs(self):
+        # four small nodes would be cheaper, but the slots of the job must be on the same node
+        plan = utils.plan_capacity([(1, 16, 0, None, 1, True)], [small, large])
+        expected = {'small': 0, 'large': 1}
+        self.assertEqual(plan, expected, "test_single_host_jobs failed. Got %s; Expected: %s" % (plan, expected))
+
+
+class array_tasks_tests(unittest.TestCase):
+    def test_task_ranges(self):
+        for job_id, expected in [('25', None), ('73_5', None), ('73_[1-200000%500]', ('73', 200000, 500)),
+                                 ('74_[1,5-9:2,12]', ('74', 5, None)), ('75_[3-3]', ('75', 1, None))]:
+            tasks = slurm._get_array_tasks(job_id)
+            self.assertEqual(tasks, expected, "test_task_ranges failed for %s: Got %s; Expected: %s"
+                             % (job_id, tasks, expected))
+
+
+class pending_reason_tests(unittest.TestCase):
+    def test_blocked_reasons(self):
+        for reason, expected in [('Resources', False), ('Priority', False), ('Dependency', True),
+                                 ('JobHeldUser', True), ('BeginTime', True), ('AssocGrpCpuLimit', True),
+                                 ('QOSMaxJobsPerUserLimit', True), ('PartitionNodeLimit', False)]:
+            blocked = slurm._is_blocked(reason)
+            self.assertEqual(blocked, expected, "test_blocked_reasons failed for %s: Got %s; Expected: %s"
+                             % (reason, blocked, expected))
+
+    def test_filtered_demand(self):
+        utils.set_filtered_jobs([('27', 'Dependency', 1, 4), ('73_[1-100]', 'JobHeldUser', 100, 2)])
+        filtered = utils.get_filtered_demand()
+        expected = {'jobs': 101, 'slots': 204, 'reasons': {'Dependency': 1, 'JobHeldUser': 100}}
+        self.assertEqual(filtered, expected, "test_filtered_demand failed: Got %s; Expected: %s" % (filtered, expected))
+
+
+pricing = {
+    'c5.large': {'vcpus': '2', 'memory': '4 GiB', 'price': '0.085'},
+    'p3.2xlarge': {'vcpus': '8', 'memory': '61 GiB', 'gpu': '1', 'price': '3.06'},
+    'x1e.32xlarge': {'vcpus': '128', 'memory': '3,904 GiB'},
+    'unknown': {'memory': '1 GiB'},
+}
+
+
+class instance_catalog_tests(unittest.TestCase):
+    def setUp(self):
+        if jobwatcher is None:
+            return
+        self.directory = tempfile.mkdtemp()
+        self.source = os.path.join(self.directory, 'bucket')
+        self.pcluster_dir = os.path.join(self.directory, 'parallelcluster')
+        os.makedirs(os.path.join(self.source, 'instances'))
+        self._write_source(pricing)
+
+    def tearDown(self):
+        if jobwatcher is None:
+            return
+        shutil.rmtree(self.directory)
+
+    def _write_source(self, instances, mtime=1000000000):
+        path = os.path.join(self.source, jobwatcher.pricing_key)
+        with open(path, 'w') as f:
+            json.dump(instances, f)
+        os.utime(path, (mtime, mtime))
+
+    def _fetch(self):
+        jobwatcher._fetch_pricing_file(self.pcluster_dir, 'us-east-1', None, self.source)
+        with open(os.path.join(self.pcluster_dir, jobwatcher.catalog_file), 'rb') as f:
+            return pickle.load(f)
+
+    def test_compile_catalog(self):
+        if jobwatcher is None:
+            return
+        catalog_path = os.path.join(self.directory, 'instances.catalog')
+        catalog = jobwatcher._compile_catalog(os.path.join(self.source, jobwatcher.pricing_key), catalog_path)
+        expected = {
+            'c5.large': {'vcpus': 2, 'memory': 4096, 'gpus': 0, 'price': 0.085},
+            'p3.2xlarge': {'vcpus': 8, 'memory': 62464, 'gpus': 1, 'price': 3.06},
+            'x1e.32xlarge': {'vcpus': 128, 'memory': 3997696, 'gpus': 0, 'price': None},
+        }
+        self.assertEqual(catalog, expected, "test_compile_catalog failed. Got %s; Expected: %s" % (catalog, expected))
+        with open(catalog_path, 'rb') as f:
+            stored = pickle.load(f)
+        self.assertEqual(stored, expected, "test_compile_catalog failed. Got %s; Expected: %s" % (stored, expected))
+
+    def test_fetch_skips_unchanged_file(self):
+        if jobwatcher is None:
+            return
+        catalog = self._fetch()
+        self.assertEqual(sorted(catalog), ['c5.large', 'p3.2xlarge', 'x1e.32xlarge'],
+                         "test_fetch_skips_unchanged_file failed. Got %s" % catalog)
+        catalog_path = os.path.join(self.pcluster_dir, jobwatcher.catalog_file)
+        os.utime(catalog_path, (0, 0))
+        self._fetch()
+        self.assertEqual(os.stat(catalog_path).st_mtime, 0, "test_fetch_skips_unchanged_file failed: recompiled")
+
+    def test_fetch_updated_file(self):
+        if jobwatcher is None:
+            return
+        self._fetch()
+        self._write_source({'c5.large': {'vcpus': '2', 'memory': '4 GiB', 'price': '0.1'}}, mtime=1000000060)
+        catalog = self._fetch()
+        expected = {'c5.large': {'vcpus': 2, 'memory': 4096, 'gpus': 0, 'price': 0.1}}
+        self.assertEqual(catalog, expected, "test_fetch_updated_file failed. Got %s; Expected: %s"
+                         % (catalog, expected))
+
+    def test_fetch_without_local_catalog(self):
+        if jobwatcher is None:
+            return
+        self._fetch()
+        os.remove(os.path.join(self.pcluster_dir, jobwatcher.catalog_file))
+        catalog = self._fetch()
+        self.assertTrue('c5.large' in catalog, "test_fetch_without_local_catalog failed. Got %s" % catalog)
+
+
+class poll_interval_tests(unittest.TestCase):
+    def test_back_off_while_idle(self):
+        intervals = []
+        interval = 10
+        for has_pending in [False, False, False, False, False, True, False]:
+            interval = trigger.next_poll_interval(interval, has_pending, 10, 60)
+            intervals.append(interval)
+        expected = [20, 40, 60, 60, 60, 10, 20]
+        self.assertEqual(intervals, expected, "test_back_off_while_idle failed. Got %s; Expected: %s"
+                         % (intervals, expected))
+
+    def test_never_below_min_interval(self):
+        interval = trigger.next_poll_interval(0, False, 10, 60)
+        self.assertEqual(interval, 10, "test_never_below_min_interval failed. Got %s" % interval)
+
+
+class trigger_tests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'jobwatcher', 'trigger.sock')
+        self.sock = trigger.open_trigger_socket(self.path)
+
+    def tearDown(self):
+        self.sock.close()
+        shutil.rmtree(self.directory)
+
+    def test_timeout_without_trigger(self):
+        triggered = trigger.wait_for_trigger(self.sock, 0.05)
+        self.assertFalse(triggered, "test_timeout_without_trigger failed")
+
+    def test_burst_handled_in_one_cycle(self):
+        for _ in range(5):
+            self.assertTrue(trigger.notify(self.path), "test_burst_handled_in_one_cycle failed: not delivered")
+        triggered = trigger.wait_for_trigger(self.sock, 1, debounce=0.05)
+        self.assertTrue(triggered, "test_burst_handled_in_one_cycle failed: not triggered")
+        triggered = trigger.wait_for_trigger(self.sock, 0.05)
+        self.assertFalse(triggered, "test_burst_handled_in_one_cycle failed: notifications left in the socket")
+
+    def test_debounce_is_bounded(self):
+        stop = threading.Event()
+
+        def _notify():
+            while not stop.is_set():
+                trigger.notify(self.path)
+                time.sleep(0.01)
+
+        thread = threading.Thread(target=_notify)
+        thread.start()
+        try:
+            start = time.time()
+            triggered = trigger.wait_for_trigger(self.sock, 1, debounce=0.05, max_debounce=0.2)
+            elapsed = time.time() - start
+        finally:
+            stop.set()
+            thread.join()
+        self.assertTrue(triggered, "test_debounce_is_bounded failed: not triggered")
+        self.assertTrue(elapsed < 0.5, "test_debounce_is_bounded failed: debounced for %.2f seconds" % elapsed)
+
+    def test_socket_permissions(self):
+        mode = stat.S_IMODE(os.stat(self.path).st_mode)
+        expected = stat.S_IRUSR | stat.S_IWUSR
+        self.assertEqual(mode, expected, "test_socket_permissions failed. Got %o; Expected: %o" % (mode, expected))
+        self.sock.close()
+        group = grp.getgrgid(os.getgid()).gr_name
+        self.sock = trigger.open_trigger_socket(self.path, group)
+        mode = stat.S_IMODE(os.stat(self.path).st_mode)
+        expected = stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IWGRP
+        self.assertEqual(mode, expected, "test_socket_permissions failed. Got %o; Expected: %o" % (mode, expected))
+
+    def test_notify_without_listener(self):
+        delivered = trigger.notify(os.path.join(self.directory, 'missing.sock'))
+        self.assertFalse(delivered, "test_notify_without_listener failed")
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,65 +1,353 @@
 import shlex
-import subprocess as sub
 import os
 import logging
+import math
+import re
+
+from common import scheduler_commands
 
 log = logging.getLogger(__name__)
 
 
 def run_command(command, env):
-    _command = shlex.split(command)
-    try:
-        DEV_NULL = open(os.devnull, "rb")
-        env.update(os.environ.copy())
-        process = sub.Popen(_command, env=env, stdout=sub.PIPE, stderr=sub.STDOUT, stdin=DEV_NULL)
-        _output = process.communicate()[0]
-        return _output
-    except sub.CalledProcessError:
-        log.error("Failed to run %s\n" % _command)
-        exit(1)
-    finally:
-        DEV_NULL.close()
+    # the exit code isn't checked, callers parse the output, stderr included
+    env.update(os.environ.copy())
+    return scheduler_commands.run_command(shlex.split(command), env=env, merge_stderr=True)
+
+
+# pending jobs that can't run, excluded from the demand by the last query of the pending jobs
+_filtered_demand = {'jobs': 0, 'slots': 0, 'reasons': {}}
+
+
+def set_filtered_jobs(filtered):
+    """
+    Record the pending jobs excluded from the demand because they can't run however many nodes are launched, e.g. jobs
+    held or waiting for a dependency.
+
+    :param filtered: list of (job id, reason, number of jobs, slots per job) of the excluded jobs
+    """
+    reasons = {}
+    slots = 0
+    for job_id, reason, count, job_slots in filtered:
+        log.debug("Job %s can't run (%s), not counted as demand" % (job_id, reason))
+        reasons[reason] = reasons.get(reason, 0) + count
+        slots += count * job_slots
+    jobs = sum(reasons.values())
+    if jobs:
+        log.info("%d pending jobs requesting %d slots can't run, not counted as demand: %s"
+                 % (jobs, slots, ', '.join("%s=%d" % item for item in sorted(reasons.items()))))
+    _filtered_demand.update(jobs=jobs, slots=slots, reasons=reasons)
 
 
-def get_optimal_nodes(nodes_requested, slots_requested, instance_properties):
+def get_filtered_demand():
+    """Get the number of jobs, slots and jobs per reason excluded from the demand by the last query."""
+    return dict(_filtered_demand)
+
+
+_memory_units = {'k': 1.0 / 1024, 'm': 1, 'g': 1024, 't': 1024 * 1024}
+
+
+def parse_memory(value, default_unit='m'):
     """
-    Get the optimal number of nodes required to satisfy the number of nodes and slots requested.
+    Parse a memory amount as printed by the schedulers, e.g. 4000M, 2G, 512mb or 1.5gb.
+
+    :param value: the memory amount
+    :param default_unit: unit of the amounts without suffix, one of b, k, m, g, t
+    :return: the amount in MiB, 0 if not set or not parsable
+    """
+    match = re.match(r'^([0-9]+(?:\.[0-9]+)?)([kmgt]?)i?(b?)$', value.strip().lower())
+    if not match:
+        return 0
+    amount, unit, in_bytes = match.groups()
+    if not unit:
+        if in_bytes or default_unit == 'b':
+            return int(math.ceil(float(amount) / (1024 * 1024)))
+        unit = default_unit
+    return int(math.ceil(float(amount) * _memory_units[unit]))
+
+
+def _get_node_capacity(instance_properties):
+    """
+    Get the capacity of a node, as a list of slots, memory in MiB and generic resources sorted by name.
+
+    Resources without capacity information, e.g. the memory of an instance type missing in the catalog, are unlimited.
+    """
+    memory = instance_properties.get('memory')
+    resources = instance_properties.get('resources') or {}
+    return [instance_properties.get('slots'), memory if memory else float('inf')] + \
+        [resources[name] for name in sorted(resources)]
+
+
+def _get_job_shape(nodes, slots, memory, resources, instance_properties, single_host=False):
+    """
+    Spread the slots, memory and generic resources of a job uniformly across its nodes, adding nodes until the share
+    of each node fits the node capacity.
+
+    :param nodes: number of nodes requested by the job
+    :param slots: number of slots requested by the job
+    :param memory: memory requested by the job in MiB, in total
+    :param resources: dictionary of the generic resources requested by the job, in total, e.g. {'gpu': 4}
+    :param instance_properties: properties of the nodes, i.e. slots, memory and resources available per node
+    :param single_host: True if all the slots of the job must be on the same node, e.g. SGE $pe_slots
+    :return: the number of nodes and the list of resources required per node, None if the job can't run on the nodes
+    """
+    resources = resources or {}
+    node_resources = instance_properties.get('resources') or {}
+    if [name for name in resources if resources[name] > 0 and name not in node_resources]:
+        return None
+    capacity = _get_node_capacity(instance_properties)
+    demand = [slots, memory or 0] + [resources.get(name, 0) for name in sorted(node_resources)]
+    if [i for i, total in enumerate(demand) if total > 0 and capacity[i] <= 0]:
+        return None
+
+    requested_nodes = max(nodes, 1)
+    nodes = requested_nodes
+    for total, available in zip(demand, capacity):
+        if total > 0 and available != float('inf'):
+            nodes = max(nodes, -(-total // available))
+    if nodes > max(requested_nodes, slots) or (single_host and nodes > 1):
+        # every node runs at least a slot of the job
+        return None
+    return nodes, [-(-total // nodes) for total in demand]
+
+
+def _copies(available, required):
+    # number of copies of the required resources fitting in the available ones, None if unbounded
+    copies = None
+    for free, amount in zip(available, required):
+        if amount > 0 and free != float('inf'):
+            fitting = int(free // amount)
+            copies = fitting if copies is None else min(copies, fitting)
+    return copies
+
+
+def _use(available, required, copies):
+    return [free - amount * copies for free, amount in zip(available, required)]
+
+
+def _place(groups, capacity, nodes, required, count):
+    """
+    Place count identical jobs first fit on the planned nodes, adding the nodes needed.
+
+    Identical planned nodes are grouped, so that the cost of placing the tasks of a job array doesn't depend on the
+    number of tasks.
+
+    :param groups: planned nodes, list of [free resources, number of nodes], left unchanged
+    :param capacity: resources of a node to add
+    :param nodes: number of nodes of each job
+    :param required: resources required per node by each job
+    :param count: number of identical jobs
+    :return: the new list of planned nodes and the number of nodes added
+    """
+    if nodes == 1:
+        # single node jobs, a node runs as many of them as its resources allow
+        result = []
+        for available, multiplicity in groups:
+            copies = _copies(available, required) if count > 0 else 0
+            copies = count if copies is None else copies
+            if copies > 0:
+                full_nodes = min(multiplicity, count // copies)
+                if full_nodes:
+                    result.append([_use(available, required, copies), full_nodes])
+                    multiplicity -= full_nodes
+                    count -= full_nodes * copies
+                if multiplicity and 0 < count < copies:
+                    result.append([_use(available, required, count), 1])
+                    multiplicity -= 1
+                    count = 0
+            if multiplicity:
+                result.append([available, multiplicity])
+        added = 0
+        if count > 0:
+            copies = _copies(capacity, required) or count
+            full_nodes, left = count // copies, count % copies
+            if full_nodes:
+                result.append([_use(capacity, required, copies), full_nodes])
+            if left:
+                result.append([_use(capacity, required, left), 1])
+            added = full_nodes + (1 if left else 0)
+        return result, added
+
+    # the nodes of a multi node job are distinct, each job takes the first nodes with room for its share: the jobs
+    # keep taking the same nodes until one of them is full, so they are placed in rounds on those nodes
+    added = 0
+    while count > 0:
+        needed = nodes
+        placed = count
+        chosen = {}
+        for index, (available, multiplicity) in enumerate(groups):
+            if needed == 0:
+                break
+            copies = _copies(available, required)
+            copies = count if copies is None else copies
+            if copies > 0:
+                chosen[index] = min(multiplicity, needed)
+                needed -= chosen[index]
+                placed = min(placed, copies)
+
+        if needed > 0:
+            copies = _copies(capacity, required) or count
+            if not chosen:
+                # only new nodes, all the rounds are identical
+                rounds, left = count // copies, count % copies
+                groups = list(groups)
+                if rounds:
+                    groups.append([_use(capacity, required, copies), nodes * rounds])
+                if left:
+                    groups.append([_use(capacity, required, left), nodes])
+                return groups, added + nodes * (rounds + (1 if left else 0))
+            placed = min(placed, copies)
+
+        result = []
+        for index, (available, multiplicity) in enumerate(groups):
+            used = chosen.get(index, 0)
+            if used:
+                result.append([_use(available, required, placed), used])
+            if multiplicity - used:
+                result.append([available, multiplicity - used])
+        if needed > 0:
+            result.append([_use(capacity, required, placed), needed])
+            added += needed
+        groups = result
+        count -= placed
+    return groups, added
+
+
+def _count_nodes(groups):
+    return sum(multiplicity for _, multiplicity in groups)
+
+
+def get_optimal_nodes(nodes_requested, slots_requested, instance_properties, memory_requested=None,
+                      resources_requested=None, counts_requested=None, single_host_requested=None):
+    """
+    Get the optimal number of nodes required to satisfy the number of nodes, slots, memory and resources requested.
 
     :param nodes_requested: Array containing the number of nodes requested by the ith job
     :param slots_requested: Array containing the number of slots requested by the ith job
-    :param instance_properties: instance properties, i.e. number of slots available per node
+    :param instance_properties: instance properties, i.e. number of slots, memory in MiB and generic resources, e.g.
+        {'gpu': 4}, available per node
+    :param memory_requested: Array containing the memory in MiB requested by the ith job, in total, None if unknown
+    :param resources_requested: Array containing the dictionary of generic resources requested by the ith job, in
+        total, None if unknown
+    :param counts_requested: Array containing the number of identical jobs represented by the ith job, e.g. the
+        pending tasks of a job array, None if each job is single
+    :param single_host_requested: Array containing True if the ith job must run on a single node, None if no job has
+        this constraint
     :return: The optimal number of nodes required to satisfy the input queue.
     """
-    vcpus = instance_properties.get('slots')
-    slots_remaining_per_node = []
+    capacity = _get_node_capacity(instance_properties)
+    planned_nodes = []
 
     for node_idx, num_of_nodes in enumerate(nodes_requested):
-        log.info("Requested %s nodes and %s slots" % (num_of_nodes, slots_requested[node_idx]))
-        # For simplicity, uniformly distribute the numbers of cpus requested across all the requested nodes
-        slots_required_per_node = -(-slots_requested[node_idx] // num_of_nodes)
-
-        if slots_required_per_node > vcpus:
-            # If slots required per node is greater than vcpus, add additional nodes
-            # and recalculate slots_required_per_node
-            log.info("Slots required per node is greater than vcpus, recalculating")
-            num_of_nodes = -(-slots_requested[node_idx] // vcpus)
-            slots_required_per_node = -(-slots_requested[node_idx] // num_of_nodes)
-            log.info("Recalculated: %s nodes and %s slots required per node" % (num_of_nodes, slots_required_per_node))
-
-        # Verify if there are enough available slots in the nodes allocated in the previous rounds
-        for slot_idx, slots_available in enumerate(slots_remaining_per_node):
-            if num_of_nodes > 0 and slots_available >= slots_required_per_node:
-                log.info("Slot available in existing node")
-                # The node represented by slot_idx can be used to run this job
-                slots_remaining_per_node[slot_idx] -= slots_required_per_node
-                num_of_nodes -= 1
-
-        log.info("After looking at already allocated nodes, %s more nodes are needed" % num_of_nodes)
-
-        # Since the number of available slots were unable to run this job entirely, only add the necessary nodes.
-        for i in range(num_of_nodes):
-            log.info("Adding node. Using %s slots" % slots_required_per_node)
-            slots_remaining_per_node.append(vcpus - slots_required_per_node)
+        memory = memory_requested[node_idx] if memory_requested else 0
+        resources = resources_requested[node_idx] if resources_requested else None
+        count = counts_requested[node_idx] if counts_requested else 1
+        single_host = single_host_requested[node_idx] if single_host_requested else False
+        log.info("Requested %s nodes, %s slots, %s MiB of memory and resources %s by %s jobs"
+                 % (num_of_nodes, slots_requested[node_idx], memory, resources or {}, count))
+        # For simplicity, uniformly distribute the resources requested across all the requested nodes, adding nodes
+        # if the share of a node is greater than its capacity
+        shape = _get_job_shape(num_of_nodes, slots_requested[node_idx], memory, resources, instance_properties,
+                               single_host)
+        if shape is None:
+            log.warning("Job requests resources not available on the compute nodes. Skipping")
+            continue
+        if shape[0] != num_of_nodes:
+            log.info("Resources required per node greater than node capacity, recalculated: %s nodes" % shape[0])
+        num_of_nodes, required_per_node = shape
+
+        # Use the available resources in the nodes allocated in the previous rounds, then add the necessary nodes
+        planned_nodes, added = _place(planned_nodes, capacity, num_of_nodes, required_per_node, count)
+        log.info("After looking at already allocated nodes, %s more nodes are needed" % added)
 
     # return the number of nodes added
-    return len(slots_remaining_per_node)
+    return _count_nodes(planned_nodes)
+
+
+def _job_resources(job):
+    """Unpack a (nodes, slots[, memory[, resources[, count[, single_host]]]]) job tuple."""
+    job = tuple(job) + (0, None, 1, False)[len(job) - 2:]
+    return job[:6]
+
+
+def _pack(jobs, instance_types, score):
+    """
+    Place the jobs first fit, each on the instance type with the lowest score of its additional nodes.
+
+    :param jobs: list of (nodes, slots[, memory[, resources[, count[, single_host]]]]) requested by the pending jobs
+    :param instance_types: candidate instance types
+    :param score: function of the instance type, of the number of additional nodes and of the slots per node, lower is
+        better
+    :return: dictionary instance_type -> planned nodes, as list of [free resources, number of nodes], and the number of
+        jobs that can't run on any of the instance types
+    """
+    free = dict((t['instance_type'], []) for t in instance_types)
+    unplaced = 0
+    for job in jobs:
+        nodes, slots, memory, resources, count, single_host = _job_resources(job)
+        best = None
+        for instance_type in instance_types:
+            shape = _get_job_shape(nodes, slots, memory, resources, instance_type, single_host)
+            if shape is None:
+                continue
+            job_nodes, required_per_node = shape
+            planned, new_nodes = _place(free[instance_type['instance_type']], _get_node_capacity(instance_type),
+                                        job_nodes, required_per_node, count)
+            job_score = score(instance_type, new_nodes, required_per_node[0])
+            if best is None or job_score < best[0]:
+                best = (job_score, instance_type, planned)
+
+        if best is None:
+            unplaced += count
+            continue
+        _, instance_type, planned = best
+        free[instance_type['instance_type']] = planned
+    return free, unplaced
+
+
+def plan_capacity(jobs, instance_types, objective='cost'):
+    """
+    Choose the instance type of the nodes to launch for the given pending jobs.
+
+    Jobs are placed first fit decreasing by slots per node, all the nodes of a job having the same instance type.
+    Several placements are computed, each instance type alone and mixed placements where each job goes to the instance
+    type that runs it with the lowest additional cost, and the one placing the most jobs with the lowest total cost, or
+    number of nodes, is returned.
+
+    :param jobs: list of (nodes, slots[, memory[, resources[, count[, single_host]]]]) requested by the pending jobs,
+        memory in MiB and resources as a dictionary, both in total for the job, count the number of identical jobs,
+        e.g. the pending tasks of a job array, and single_host True if all the slots of the job must be on one node
+    :param instance_types: list of candidate instance types, dictionaries with instance_type, slots and cost keys and
+        optionally memory and resources, as the instance properties
+    :param objective: 'cost' to minimize the cost of the nodes, 'nodes' to minimize their number
+    :return: dictionary instance_type -> number of nodes to launch
+    """
+    if objective not in ('cost', 'nodes'):
+        raise ValueError("Unknown planning objective %s, must be cost or nodes" % objective)
+    instance_types = [t for t in instance_types if t.get('slots') > 0]
+    if not instance_types:
+        return {}
+    jobs = sorted(jobs, key=lambda job: -(-job[1] // max(job[0], 1)), reverse=True)
+
+    def _total(placement):
+        plan, unplaced = placement
+        nodes = sum(_count_nodes(planned) for planned in plan.values())
+        cost = sum(_count_nodes(plan.get(t['instance_type'], [])) * t['cost'] for t in instance_types)
+        return (unplaced, cost, nodes) if objective == 'cost' else (unplaced, nodes, cost)
+
+    placements = [_pack(jobs, [t], lambda t, new_nodes, slots_per_node: 0) for t in instance_types]
+    # additional nodes cost
+    placements.append(_pack(jobs, instance_types, lambda t, new_nodes, slots_per_node: (
+        (new_nodes * t['cost'], new_nodes) if objective == 'cost' else (new_nodes, new_nodes * t['cost'])
+    )))
+    # cost of the slots used on the additional nodes, favoring the cheapest slots for the jobs to come
+    placements.append(_pack(jobs, instance_types, lambda t, new_nodes, slots_per_node: (
+        new_nodes * slots_per_node * float(t['cost']) / t['slots'], new_nodes
+    )))
+    best, unplaced = min(placements, key=_total)
+    if unplaced:
+        log.warning("%d jobs request resources not available on any candidate instance type" % unplaced)
+
+    plan = dict((t['instance_type'], _count_nodes(best.get(t['instance_type'], []))) for t in instance_types)
+    log.info("Planned nodes per instance type: %s" % ', '.join("%s=%d" % item for item in sorted(plan.items())))
+    return plan
@@ -0,0 +1,121 @@
+# Copyright 2013-2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You may not use this file except in compliance with the
+# License. A copy of the License is located at
+#
+# http://aws.amazon.com/apache2.0/
+#
+# or in the "LICENSE.txt" file accompanying this file. This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+# OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import time
+
+from botocore.exceptions import ClientError
+from common.cluster_state import get_scalein_delay
+from common.idle_reports import read_idle_reports, remove_idle_report
+
+log = logging.getLogger(__name__)
+
+
+class IdleNodesReaper(object):
+    """
+    Release idle compute nodes from the master node, in batches.
+
+    Compute nodes report themselves as idle on the shared filesystem. At every cycle the reaper picks the longest idle
+    nodes that can be released without going below the ASG MinSize or the nodes required by the pending demand,
+    drains them with a single scheduler operation and terminates them at a controlled rate. A cycle spends at most
+    max_duration seconds terminating nodes, the nodes left are put back in service and released by the next cycles.
+
+    No node is released for scalein_cooldown seconds after a scale-out, and a node is kept for at least
+    min_node_lifetime seconds after its launch, so that the nodes are not released right before the next wave of jobs.
+    """
+
+    def __init__(self, scheduler_module, asg_cache, reports_dir, batch_size=50, terminate_interval=0.5,
+                 max_report_age=180, scalein_cooldown=0, min_node_lifetime=0, max_duration=10):
+        """
+        :param scheduler_module: jobwatcher scheduler plugin
+        :param asg_cache: AsgStateCache of the compute fleet ASG
+        :param reports_dir: shared directory containing the idle reports
+        :param batch_size: maximum number of nodes released per cycle
+        :param terminate_interval: pause between two termination requests, in seconds
+        :param max_report_age: ignore reports not refreshed in the last max_report_age seconds
+        :param scalein_cooldown: seconds after a scale-out during which no node is released
+        :param min_node_lifetime: seconds after its launch during which a node is not released
+        :param max_duration: maximum time spent terminating nodes in a cycle, in seconds
+        """
+        self.scheduler_module = scheduler_module
+        self.asg_cache = asg_cache
+        self.reports_dir = reports_dir
+        self.batch_size = batch_size
+        self.terminate_interval = terminate_interval
+        self.max_report_age = max_report_age
+        self.scalein_cooldown = scalein_cooldown
+        self.min_node_lifetime = min_node_lifetime
+        self.max_duration = max_duration
+
+    def reap(self, required, last_scale_out=None):
+        """
+        Release idle nodes exceeding the required capacity.
+
+        :param required: number of nodes to keep for the running and pending demand
+        :param last_scale_out: time of the last scale-out decision of jobwatcher, None if unknown
+        :return: the number of terminated nodes
+        """
+        delay = get_scalein_delay(last_scale_out, self.scalein_cooldown)
+        if delay > 0:
+            log.info("Scaled out recently, not releasing idle nodes for %d more seconds" % delay)
+            return 0
+        reports = [
+            report for report in read_idle_reports(self.reports_dir, self.max_report_age)
+            if get_scalein_delay(None, 0, report.get('launch_time'), self.min_node_lifetime) <= 0
+        ]
+        if not reports:
+            return 0
+
+        asg = self.asg_cache.get(force_refresh=True)
+        releasable = asg.get('DesiredCapacity') - max(asg.get('MinSize'), required)
+        log.info("%d idle nodes reported, %d nodes can be released" % (len(reports), max(releasable, 0)))
+        candidates = reports[:min(releasable, self.batch_size)]
+        if not candidates:
+            return 0
+
+        hostnames = [report.get('hostname') for report in candidates]
+        self.scheduler_module.drain_nodes(hostnames)
+        busy = self.scheduler_module.get_nodes_with_jobs(hostnames)
+        if busy:
+            log.info("Nodes %s received jobs in the meantime, putting them back in service" % ', '.join(busy))
+            self.scheduler_module.resume_nodes(busy)
+
+        terminated = 0
+        failed = []
+        left = []
+        deadline = time.time() + self.max_duration
+        candidates = [candidate for candidate in candidates if candidate.get('hostname') not in busy]
+        for index, report in enumerate(candidates):
+            if index > 0:
+                if time.time() + self.terminate_interval > deadline:
+                    # don't hold the jobwatcher cycle, the nodes left are released by the next cycles
+                    left = [candidate.get('hostname') for candidate in candidates[index:]]
+                    log.info("Reaping time exceeded, putting %d nodes back in service" % len(left))
+                    break
+                time.sleep(self.terminate_interval)
+            instance_id = report.get('instance_id')
+            try:
+                log.info("Terminating idle instance %s (%s)" % (instance_id, report.get('hostname')))
+                self.asg_cache.asg_client.terminate_instance_in_auto_scaling_group(
+                    InstanceId=instance_id, ShouldDecrementDesiredCapacity=True
+                )
+                remove_idle_report(self.reports_dir, instance_id)
+                terminated += 1
+            except ClientError as e:
+                log.error("Failed to terminate instance %s with exception %s" % (instance_id, e))
+                failed.append(report.get('hostname'))
+
+        if failed or left:
+            self.scheduler_module.resume_nodes(failed + left)
+        if terminated:
+            self.asg_cache.invalidate()
+        log.info("Terminated %d idle nodes" % terminated)
+        return terminated
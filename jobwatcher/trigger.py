@@ -0,0 +1,168 @@
+# Copyright 2013-2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You may not use this file except in compliance with the
+# License. A copy of the License is located at
+#
+# http://aws.amazon.com/apache2.0/
+#
+# or in the "LICENSE.txt" file accompanying this file. This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+# OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Scale-up triggers for jobwatcher.
+
+jobwatcher listens on a local Unix datagram socket and wakes up as soon as a scheduler hook notifies it of a job
+submission, instead of waiting for the next polling cycle. Hooks notify jobwatcher by running jobwatcher-notify, e.g.:
+
+- Slurm: os.execute("/usr/bin/jobwatcher-notify") from the slurm_job_submit function of job_submit.lua
+- SGE: a server side JSV script calling jobwatcher-notify before accepting the job
+- Torque: a qsub submit filter (SUBMITFILTER in torque.cfg) calling jobwatcher-notify
+
+Only the owner of the socket and the members of its group can notify jobwatcher: the group, set with the
+trigger_socket_group option, must include the users running the hooks, i.e. SlurmUser, the SGE admin user, or the
+users submitting jobs for Torque.
+
+Notifications are best effort: if jobwatcher is not listening, the job is caught by the next polling cycle.
+"""
+
+import argparse
+import errno
+import grp
+import logging
+import os
+import select
+import socket
+import stat
+import time
+
+log = logging.getLogger(__name__)
+trigger_socket = '/var/run/jobwatcher/trigger.sock'
+
+
+def open_trigger_socket(path, group=None):
+    """
+    Bind the Unix datagram socket used by the scheduler hooks to notify new submissions.
+
+    :param path: path of the socket file
+    :param group: name of the group allowed to notify, None to allow the owner only
+    :return: the bound socket
+    """
+    socket_dir = os.path.dirname(path)
+    if not os.path.isdir(socket_dir):
+        os.makedirs(socket_dir)
+    if os.path.exists(path):
+        os.remove(path)
+
+    gid = None
+    if group:
+        try:
+            gid = grp.getgrnam(group).gr_gid
+        except KeyError:
+            log.error("Unknown trigger socket group %s, only the owner of %s can notify jobwatcher" % (group, path))
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.bind(path)
+    if gid is not None:
+        # hooks run as the scheduler or the submitting user
+        os.chown(path, -1, gid)
+        os.chmod(path, stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IWGRP)
+    else:
+        os.chmod(path, stat.S_IRUSR | stat.S_IWUSR)
+    sock.setblocking(0)
+    log.info("Listening for scale-up triggers on %s" % path)
+    return sock
+
+
+def _drain(sock):
+    """
+    Read all the notifications queued in the socket.
+
+    :param sock: the trigger socket
+    :return: the number of notifications read
+    """
+    count = 0
+    while True:
+        try:
+            sock.recv(512)
+            count += 1
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return count
+            raise
+
+
+def wait_for_trigger(sock, timeout, debounce=2, max_debounce=10):
+    """
+    Wait for a scale-up trigger or for the given timeout to expire, whichever comes first.
+
+    Bursts of submissions are debounced: after the first notification, wait until no new notification arrives for
+    debounce seconds (but no longer than max_debounce seconds), so that a whole burst is handled in one cycle.
+
+    :param sock: the trigger socket, None to just sleep for timeout seconds
+    :param timeout: maximum time to wait in seconds
+    :param debounce: quiet period that ends a burst of notifications, in seconds
+    :param max_debounce: maximum time spent debouncing a burst, in seconds
+    :return: True if the wait was interrupted by a trigger
+    """
+    if sock is None:
+        time.sleep(timeout)
+        return False
+
+    readable = select.select([sock], [], [], timeout)[0]
+    if not readable:
+        return False
+
+    notifications = _drain(sock)
+    deadline = time.time() + max_debounce
+    while time.time() < deadline and select.select([sock], [], [], min(debounce, deadline - time.time()))[0]:
+        notifications += _drain(sock)
+
+    log.info("Woken up by %d scale-up trigger(s)" % notifications)
+    return True
+
+
+def next_poll_interval(interval, has_pending, min_interval, max_interval):
+    """
+    Compute the time to wait before the next cycle when no trigger arrives.
+
+    Poll at min_interval while there is pending demand, then back off exponentially up to max_interval while idle.
+
+    :param interval: the interval used for the previous cycle
+    :param has_pending: True if the last cycle found pending jobs
+    :param min_interval: minimum polling interval in seconds
+    :param max_interval: maximum polling interval in seconds
+    :return: the interval for the next cycle, in seconds
+    """
+    if has_pending:
+        return min_interval
+    return max(min_interval, min(interval * 2, max_interval))
+
+
+def notify(path=trigger_socket):
+    """
+    Notify jobwatcher of a new submission.
+
+    :param path: path of the jobwatcher trigger socket
+    :return: True if the notification has been delivered
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        sock.sendto(b"submit", path)
+        return True
+    except socket.error:
+        # jobwatcher not running or socket queue full, the next polling cycle will catch the job
+        return False
+    finally:
+        sock.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Notify jobwatcher of a new job submission.")
+    parser.add_argument("--socket", default=trigger_socket, help="path of the jobwatcher trigger socket")
+    args = parser.parse_args()
+    # never fail the hook that invoked us
+    notify(args.socket)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,303 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from common.asg import AsgStateCache
+from forecast import (DemandForecaster, DemandHistory, arrival_rate, ewma_forecast, parse_reserve_schedule,
+                      scheduled_reserve, seasonal_forecast)
+
+try:
+    import jobwatcher
+except ImportError:
+    # boto3 not installed, or Python 3 which jobwatcher doesn't support yet
+    jobwatcher = None
+
+try:
+    from common.idle_reports import read_idle_reports, write_idle_report
+    from reaper import IdleNodesReaper
+except ImportError:
+    # boto3 not installed
+    IdleNodesReaper = None
+
+
+class demand_history_tests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'demand.history')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_ring_wraparound_and_reload(self):
+        history = DemandHistory(self.path, capacity=5)
+        for minute in range(1, 9):
+            history.add(minute * 60, minute, 0)
+        expected = [(minute * 60, minute, 0) for minute in range(4, 9)]
+        self.assertEqual(history.samples, expected, "test_ring_wraparound_and_reload failed. Got %s; Expected: %s"
+                         % (history.samples, expected))
+        samples = DemandHistory(self.path, capacity=5).samples
+        self.assertEqual(samples, expected, "test_ring_wraparound_and_reload failed. Got %s; Expected: %s"
+                         % (samples, expected))
+
+    def test_partial_ring_reload(self):
+        history = DemandHistory(self.path, capacity=5)
+        for minute in range(1, 4):
+            history.add(minute * 60, 0, minute)
+        history = DemandHistory(self.path, capacity=5)
+        history.add(4 * 60, 0, 4)
+        samples = DemandHistory(self.path, capacity=5).samples
+        expected = [(minute * 60, 0, minute) for minute in range(1, 5)]
+        self.assertEqual(samples, expected, "test_partial_ring_reload failed. Got %s; Expected: %s"
+                         % (samples, expected))
+
+    def test_samples_merged_per_minute(self):
+        history = DemandHistory(self.path, capacity=5)
+        history.add(60, 1, 1)
+        history.add(70, 3, 0)
+        history.add(80, 1, 0)
+        history.add(120, 0, 1)
+        expected = [(60, 3, 0), (120, 0, 1)]
+        samples = DemandHistory(self.path, capacity=5).samples
+        self.assertEqual(samples, expected, "test_samples_merged_per_minute failed. Got %s; Expected: %s"
+                         % (samples, expected))
+
+    def test_incompatible_history_reset(self):
+        DemandHistory(self.path, capacity=5).add(60, 1, 0)
+        samples = DemandHistory(self.path, capacity=10).samples
+        self.assertEqual(samples, [], "test_incompatible_history_reset failed. Got %s" % samples)
+
+
+class forecast_tests(unittest.TestCase):
+    def test_ewma_forecast(self):
+        samples = [(0, 0, 0), (60, 4, 2)]
+        predicted = ewma_forecast(samples, 60, 1.0)
+        self.assertEqual(predicted, 12, "test_ewma_forecast failed. Got %s; Expected: 12" % predicted)
+        predicted = ewma_forecast([], 60, 0.3)
+        self.assertEqual(predicted, 0, "test_ewma_forecast failed. Got %s; Expected: 0" % predicted)
+
+    def test_ewma_forecast_ignores_decreases(self):
+        samples = [(0, 10, 0), (60, 2, 0), (120, 2, 0)]
+        predicted = ewma_forecast(samples, 600, 0.5)
+        self.assertEqual(predicted, 2, "test_ewma_forecast_ignores_decreases failed. Got %s; Expected: 2" % predicted)
+
+    def test_seasonal_forecast(self):
+        day = 24 * 60 * 60
+        now = 10 * day
+        samples = [
+            (now - 2 * day + 200, 6, 2),
+            # outside the horizon of its season
+            (now - day - 60, 100, 0),
+            (now - day + 100, 4, 0),
+            (now - day + 5000, 100, 0),
+            # today
+            (now - 60, 100, 0),
+        ]
+        predicted = seasonal_forecast(samples, now, 600)
+        self.assertEqual(predicted, 6.0, "test_seasonal_forecast failed. Got %s; Expected: 6.0" % predicted)
+        predicted = seasonal_forecast(samples[-1:], now, 600)
+        self.assertEqual(predicted, 0, "test_seasonal_forecast failed. Got %s; Expected: 0" % predicted)
+
+class forecaster_config_tests(unittest.TestCase):
+    def setUp(self):
+        if jobwatcher is None:
+            return
+        self.directory = tempfile.mkdtemp()
+        self.config = jobwatcher.ConfigParser.RawConfigParser()
+        self.config.add_section('jobwatcher')
+        self.config.set('jobwatcher', 'forecast_model', 'ewma')
+
+    def tearDown(self):
+        if jobwatcher is None:
+            return
+        shutil.rmtree(self.directory)
+
+    def test_invalid_alpha_replaced_by_default(self):
+        if jobwatcher is None:
+            return
+        for value in ['0', '-0.5', '1.5']:
+            self.config.set('jobwatcher', 'forecast_ewma_alpha', value)
+            alpha = jobwatcher._get_forecaster(self.config, self.directory).alpha
+            self.assertEqual(alpha, 0.3, "test_invalid_alpha_replaced_by_default failed for %s. Got %s; Expected: 0.3"
+                             % (value, alpha))
+
+    def test_valid_alpha(self):
+        if jobwatcher is None:
+            return
+        self.config.set('jobwatcher', 'forecast_ewma_alpha', '1')
+        alpha = jobwatcher._get_forecaster(self.config, self.directory).alpha
+        self.assertEqual(alpha, 1.0, "test_valid_alpha failed. Got %s; Expected: 1.0" % alpha)
+
+    def test_invalid_alpha_rejected_by_forecaster(self):
+        for alpha in [0, -0.5, 1.5]:
+            self.assertRaises(ValueError, DemandForecaster, None, 'ewma', 600, 10, alpha=alpha)
+
+
+def _local_time(day, hour, minute):
+    # January 7th 2019 is a Monday
+    return time.mktime((2019, 1, 7 + day, hour, minute, 0, 0, 0, -1))
+
+
+class warm_reserve_tests(unittest.TestCase):
+    def test_parse_reserve_schedule(self):
+        schedule = parse_reserve_schedule('mon-fri 08:00-18:00=4; sat,sun 10:00-14:00=1;')
+        expected = [(set([0, 1, 2, 3, 4]), 480, 1080, 4), (set([5, 6]), 600, 840, 1)]
+        self.assertEqual(schedule, expected, "test_parse_reserve_schedule failed. Got %s; Expected: %s"
+                         % (schedule, expected))
+
+    def test_parse_wrapping_day_range(self):
+        schedule = parse_reserve_schedule('Fri-Mon 00:00-24:00=2')
+        expected = [(set([4, 5, 6, 0]), 0, 1440, 2)]
+        self.assertEqual(schedule, expected, "test_parse_wrapping_day_range failed. Got %s; Expected: %s"
+                         % (schedule, expected))
+
+    def test_parse_invalid_schedule(self):
+        for value in ['mon-fri 08:00-18:00', 'mon-fry 08:00-18:00=4', 'mon 08:00=4', 'mon 08:00-25:00=4',
+                      'mon 08:60-09:00=4', 'mon 08:00-09:00=four', '08:00-09:00=4']:
+            self.assertRaises(ValueError, parse_reserve_schedule, value)
+
+    def test_scheduled_reserve(self):
+        schedule = parse_reserve_schedule('mon-fri 08:00-18:00=4; mon 12:00-13:00=6; sat,sun 10:00-14:00=1')
+        for now, expected in [(_local_time(0, 7, 59), 0), (_local_time(0, 8, 0), 4), (_local_time(0, 12, 30), 6),
+                              (_local_time(1, 12, 30), 4), (_local_time(4, 18, 0), 0), (_local_time(5, 11, 0), 1),
+                              (_local_time(6, 14, 0), 0)]:
+            reserve = scheduled_reserve(schedule, now)
+            self.assertEqual(reserve, expected, "test_scheduled_reserve failed for %s. Got %s; Expected: %s"
+                             % (time.ctime(now), reserve, expected))
+
+    def test_arrival_rate(self):
+        samples = [(0, 10, 0), (600, 2, 8), (1200, 6, 8), (1800, 0, 4), (2400, 3, 4)]
+        # only the increases of the demand count, the first sample is out of the window
+        rate = arrival_rate(samples, 2400, 1800)
+        expected = 7 / 1800.0
+        self.assertEqual(rate, expected, "test_arrival_rate failed. Got %s; Expected: %s" % (rate, expected))
+        rate = arrival_rate([], 2400, 1800)
+        self.assertEqual(rate, 0, "test_arrival_rate failed. Got %s; Expected: 0" % rate)
+
+
+
+class _ReaperAsgClient(object):
+    def __init__(self, min_size, desired):
+        self.asg = {'MinSize': min_size, 'DesiredCapacity': desired, 'MaxSize': 100}
+        self.terminated = []
+
+    def describe_auto_scaling_groups(self, AutoScalingGroupNames):
+        return {'AutoScalingGroups': [dict(self.asg)]}
+
+    def terminate_instance_in_auto_scaling_group(self, InstanceId, ShouldDecrementDesiredCapacity):
+        self.terminated.append(InstanceId)
+        self.asg['DesiredCapacity'] -= 1
+
+
+class _ReaperScheduler(object):
+    """Scheduler plugin recording the drained and resumed nodes."""
+
+    def __init__(self, busy=None):
+        self.busy = busy or []
+        self.drained = []
+        self.resumed = []
+
+    def drain_nodes(self, hostnames):
+        self.drained.extend(hostnames)
+
+    def get_nodes_with_jobs(self, hostnames):
+        return [hostname for hostname in hostnames if hostname in self.busy]
+
+    def resume_nodes(self, hostnames):
+        self.resumed.extend(hostnames)
+
+
+class reaper_tests(unittest.TestCase):
+    def setUp(self):
+        if IdleNodesReaper is None:
+            return
+        self.directory = tempfile.mkdtemp()
+        # ip-0 is the longest idle node
+        for i in range(8):
+            write_idle_report(self.directory, 'i-%d' % i, 'ip-%d' % i, 1000 - i)
+
+    def tearDown(self):
+        if IdleNodesReaper is None:
+            return
+        shutil.rmtree(self.directory)
+
+    def _reap(self, min_size, desired, required, scheduler=None, **kwargs):
+        self.client = _ReaperAsgClient(min_size, desired)
+        self.scheduler = scheduler or _ReaperScheduler()
+        kwargs.setdefault('terminate_interval', 0)
+        reaper = IdleNodesReaper(self.scheduler, AsgStateCache(self.client, 'asg'), self.directory, **kwargs)
+        return reaper.reap(required)
+
+    def test_nodes_above_the_demand_released(self):
+        if IdleNodesReaper is None:
+            return
+        terminated = self._reap(min_size=2, desired=10, required=5)
+        expected = ['i-0', 'i-1', 'i-2', 'i-3', 'i-4']
+        self.assertEqual(self.client.terminated, expected, "test_nodes_above_the_demand_released failed: Got %s; "
+                         "Expected: %s" % (self.client.terminated, expected))
+        self.assertEqual(terminated, 5, "test_nodes_above_the_demand_released failed: Got %s" % terminated)
+        reports = [report.get('instance_id') for report in read_idle_reports(self.directory, 60)]
+        expected = ['i-5', 'i-6', 'i-7']
+        self.assertEqual(reports, expected, "test_nodes_above_the_demand_released failed: Got %s; Expected: %s"
+                         % (reports, expected))
+
+    def test_min_size_floor(self):
+        if IdleNodesReaper is None:
+            return
+        self._reap(min_size=6, desired=8, required=0)
+        expected = ['i-0', 'i-1']
+        self.assertEqual(self.client.terminated, expected, "test_min_size_floor failed: Got %s; Expected: %s"
+                         % (self.client.terminated, expected))
+
+    def test_nothing_releasable(self):
+        if IdleNodesReaper is None:
+            return
+        terminated = self._reap(min_size=0, desired=8, required=8)
+        self.assertEqual(terminated, 0, "test_nothing_releasable failed: Got %s" % terminated)
+        self.assertEqual(self.scheduler.drained, [], "test_nothing_releasable failed: Got %s" % self.scheduler.drained)
+
+    def test_busy_nodes_skipped(self):
+        if IdleNodesReaper is None:
+            return
+        scheduler = _ReaperScheduler(busy=['ip-1'])
+        self._reap(min_size=0, desired=10, required=7, scheduler=scheduler)
+        expected = ['i-0', 'i-2']
+        self.assertEqual(self.client.terminated, expected, "test_busy_nodes_skipped failed: Got %s; Expected: %s"
+                         % (self.client.terminated, expected))
+        self.assertEqual(scheduler.resumed, ['ip-1'], "test_busy_nodes_skipped failed: Got %s" % scheduler.resumed)
+
+    def test_batch_size(self):
+        if IdleNodesReaper is None:
+            return
+        self._reap(min_size=0, desired=10, required=0, batch_size=3)
+        expected = ['i-0', 'i-1', 'i-2']
+        self.assertEqual(self.client.terminated, expected, "test_batch_size failed: Got %s; Expected: %s"
+                         % (self.client.terminated, expected))
+
+    def test_reaping_time_bounded(self):
+        if IdleNodesReaper is None:
+            return
+        start = time.time()
+        self._reap(min_size=0, desired=10, required=0, terminate_interval=0.1, max_duration=0.25)
+        elapsed = time.time() - start
+        expected = ['i-0', 'i-1', 'i-2']
+        self.assertEqual(self.client.terminated, expected, "test_reaping_time_bounded failed: Got %s; Expected: %s"
+                         % (self.client.terminated, expected))
+        self.assertTrue(elapsed < 0.5, "test_reaping_time_bounded failed: reaped for %.2f seconds" % elapsed)
+        expected = ['ip-3', 'ip-4', 'ip-5', 'ip-6', 'ip-7']
+        self.assertEqual(self.scheduler.resumed, expected, "test_reaping_time_bounded failed: Got %s; Expected: %s"
+                         % (self.scheduler.resumed, expected))
+
+    def test_no_release_after_scale_out(self):
+        if IdleNodesReaper is None:
+            return
+        self.client = _ReaperAsgClient(0, 10)
+        reaper = IdleNodesReaper(_ReaperScheduler(), AsgStateCache(self.client, 'asg'), self.directory,
+                                 terminate_interval=0, scalein_cooldown=600)
+        terminated = reaper.reap(0, last_scale_out=time.time() - 60)
+        self.assertEqual(terminated, 0, "test_no_release_after_scale_out failed: Got %s" % terminated)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -11,28 +11,45 @@
 # OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
 import ConfigParser
 import json
 import logging
 import os
+import random
 import sys
-import tempfile
 import time
 import urllib2
 
 import boto3
 from botocore.config import Config
 from botocore.exceptions import ClientError
+from common.asg import AsgStateCache
+from common.cluster_state import get_scalein_delay, read_cluster_state
+from common.idle_reports import remove_idle_report, write_idle_report
+from common.latency import get_latency_log
+from common.time_utils import monotonic
+from common.utils import StackStatus, atomic_write
 
 log = logging.getLogger(__name__)
 
+NodewatcherConfig = collections.namedtuple(
+    'NodewatcherConfig',
+    [
+        'region', 'asg', 'scheduler', 'proxy_config', 'scaledown_idletime', 'stack_name', 'asg_cache_ttl',
+        'cluster_state_file', 'idle_reports_dir', 'idle_check_interval', 'drain_timeout', 'job_detection',
+        'pending_jobs_max_age', 'latency_dir', 'scalein_cooldown', 'min_node_lifetime',
+    ]
+)
 
-def _get_config(instance_id):
+
+def _get_config(instance_id, asg=None):
     """
     Get configuration from config file.
 
     :param instance_id: instance id used to retrieve ASG group name
-    :return: configuration parameters
+    :param asg: ASG name discovered by a previous run, used if not set in the config file
+    :return: a NodewatcherConfig with the configuration parameters
     """
     config_file = "/etc/nodewatcher.cfg"
     log.debug("Reading %s", config_file)
@@ -55,27 +72,42 @@ def _get_config(instance_id):
     try:
         _asg = config.get('nodewatcher', 'asg')
     except ConfigParser.NoOptionError:
+        _asg = asg
+    if not _asg:
         ec2 = boto3.resource('ec2', region_name=_region, config=proxy_config)
 
         instances = ec2.instances.filter(InstanceIds=[instance_id])
         instance = next(iter(instances or []), None)
         _asg = filter(lambda tag: tag.get('Key') == 'aws:autoscaling:groupName', instance.tags)[0].get('Value')
         log.debug("Discovered asg: %s" % _asg)
-        config.set('nodewatcher', 'asg', _asg)
-
-        tup = tempfile.mkstemp(dir=os.getcwd())
-        fd = os.fdopen(tup[0], 'w')
-        config.write(fd)
-        fd.close
-
-        os.rename(tup[1], 'nodewatcher.cfg')
 
     log.debug(
         "region=%s asg=%s scheduler=%s prox_config=%s idle_time=%s" % (
             _region, _asg, _scheduler, proxy_config, _scaledown_idletime
         )
     )
-    return _region, _asg, _scheduler, proxy_config, _scaledown_idletime, _stack_name
+
+    def _get_option(option, default, getter=config.get):
+        return getter('nodewatcher', option) if config.has_option('nodewatcher', option) else default
+
+    return NodewatcherConfig(
+        region=_region,
+        asg=_asg,
+        scheduler=_scheduler,
+        proxy_config=proxy_config,
+        scaledown_idletime=_scaledown_idletime,
+        stack_name=_stack_name,
+        asg_cache_ttl=_get_option('asg_cache_ttl', 300, config.getint),
+        cluster_state_file=_get_option('cluster_state_file', None),
+        idle_reports_dir=_get_option('idle_reports_dir', None),
+        idle_check_interval=_get_option('idle_check_interval', 60, config.getint),
+        drain_timeout=_get_option('drain_timeout', 60, config.getint),
+        job_detection=_get_option('job_detection', 'scheduler'),
+        pending_jobs_max_age=_get_option('pending_jobs_max_age', 90, config.getint),
+        latency_dir=_get_option('latency_dir', None),
+        scalein_cooldown=_get_option('scalein_cooldown', 0, config.getint),
+        min_node_lifetime=_get_option('min_node_lifetime', 0, config.getint),
+    )
 
 
 def _get_metadata(metadata_path):
@@ -124,53 +156,125 @@ def _has_jobs(scheduler_module, hostname):
     return _jobs
 
 
-def _has_pending_jobs(scheduler_module):
+def _has_local_jobs(scheduler_module):
+    """
+    Verify if there are running jobs in the local host, without querying the scheduler controller.
+
+    :param scheduler_module: scheduler specific module to use
+    :return: true if the local host has running jobs
+    """
+    _jobs = scheduler_module.hasLocalJobs()
+    log.debug("local jobs=%s" % _jobs)
+    return _jobs
+
+
+def _record_first_job(latency_log, scheduler_module, instance_id, hostname):
+    """
+    Record the first job seen on the node, with the submission time of its jobs if the scheduler reports them.
+
+    :param latency_log: LatencyLog of the node
+    :param scheduler_module: scheduler specific module to use
+    :param instance_id: the instance id of the node
+    :param hostname: the hostname of the node
+    """
+    submit_times = None
+    if hasattr(scheduler_module, 'getJobs'):
+        try:
+            submit_times = scheduler_module.getJobs(hostname)
+        except Exception as e:
+            log.warning("Unable to get the jobs running on %s: %s" % (hostname, e))
+    latency_log.record(
+        'first_job', instance_id, job_ids=sorted(submit_times or []), hostname=hostname, submit_times=submit_times
+    )
+
+
+def _has_pending_jobs(scheduler_module, cluster_state=None, max_age=90):
     """
     Verify if there are penging jobs in the cluster.
 
+    Use the pending jobs summary published by the master node if recent enough, query the scheduler otherwise.
+    The published demand excludes the jobs that can't run, e.g. held or waiting for a dependency: they are counted
+    from the published filtered demand, so that both sources keep the node for any pending job.
+
     :param scheduler_module: scheduler specific module to use
+    :param cluster_state: cluster state published by the master node, if any
+    :param max_age: maximum age of the published summary, in seconds
     :return: true if there are pending jobs and the error code
     """
+    if cluster_state and cluster_state.get('pending_nodes') is not None:
+        age = time.time() - cluster_state.get('timestamp')
+        if age <= max_age:
+            _filtered_jobs = (cluster_state.get('filtered_demand') or {}).get('jobs', 0)
+            _has_pending_jobs = cluster_state.get('pending_nodes') > 0 or _filtered_jobs > 0
+            log.debug("has_pending_jobs=%s, published %d seconds ago" % (_has_pending_jobs, age))
+            return _has_pending_jobs, False
+
     _has_pending_jobs, _error = scheduler_module.hasPendingJobs()
     log.debug("has_pending_jobs=%s, error=%s" % (_has_pending_jobs, _error))
     return _has_pending_jobs, _error
 
 
-def _lock_host(scheduler_module, hostname, unlock=False):
+def _lock_host(scheduler_module, hostname, unlock=False, drain_timeout=60, poll_interval=2):
     """
     Lock/Unlock the given host (e.g. before termination).
 
+    When locking, wait until the scheduler confirms that the host is drained, i.e. it won't receive new jobs, and that
+    no job is running on it.
+
     :param scheduler_module: scheduler specific module to use
     :param hostname: host to lock
     :param unlock: False to lock the host, True to unlock
+    :param drain_timeout: maximum time to wait for the host to be drained, in seconds
+    :param poll_interval: time between two checks of the host state, in seconds
+    :return: True if the host has been unlocked or is drained and without jobs
     """
     log.debug("%s %s" % (unlock and "unlocking" or "locking", hostname))
     scheduler_module.lockHost(hostname, unlock)
-    time.sleep(15)  # allow for some settling
+    if unlock:
+        return True
+
+    deadline = monotonic() + drain_timeout
+    while True:
+        drained = scheduler_module.isHostDrained(hostname)
+        has_jobs = _has_jobs(scheduler_module, hostname)
+        if drained and not has_jobs:
+            log.info("Host %s is drained" % hostname)
+            return True
+        if has_jobs:
+            # a job raced with the lock, give up instead of waiting for it to complete
+            log.info("Host %s received jobs while being drained" % hostname)
+            return False
+        if monotonic() >= deadline:
+            log.warning("Host %s not drained after %d seconds" % (hostname, drain_timeout))
+            return False
+        time.sleep(poll_interval)
 
 
-def _self_terminate(asg_name, asg_client, instance_id):
+def _self_terminate(asg_cache, instance_id):
     """
     Terminate the given instance and decrease ASG desired capacity.
 
-    :param asg_name: ASG name
-    :param asg_client: ASG boto3 client
+    :param asg_cache: AsgStateCache of the compute fleet ASG
     :param instance_id: the instnace to terminate
     """
-    if not _maintain_size(asg_name, asg_client):
+    # always check the real ASG state before terminating
+    if not _maintain_size(asg_cache, force_refresh=True):
         log.info("Self terminating %s" % instance_id)
-        asg_client.terminate_instance_in_auto_scaling_group(InstanceId=instance_id, ShouldDecrementDesiredCapacity=True)
+        asg_cache.asg_client.terminate_instance_in_auto_scaling_group(
+            InstanceId=instance_id, ShouldDecrementDesiredCapacity=True
+        )
+        asg_cache.invalidate()
 
 
-def _maintain_size(asg_name, asg_client):
+def _maintain_size(asg_cache, force_refresh=False):
     """
     Verify if the desired capacity is lower than the configured min size.
-    
-    :param asg_name: the ASG to query for
-    :param asg_client: ASG boto3 client
+
+    :param asg_cache: AsgStateCache of the compute fleet ASG
+    :param force_refresh: True to query the ASG regardless of the cached state
     :return: True if the desired capacity is lower than the configured min size.
     """
-    asg = asg_client.describe_auto_scaling_groups(AutoScalingGroupNames=[asg_name]).get('AutoScalingGroups')[0]
+    asg = asg_cache.get(force_refresh)
     _capacity = asg.get('DesiredCapacity')
     _min_size = asg.get('MinSize')
     log.info("DesiredCapacity is %d, MinSize is %d" % (_capacity, _min_size))
@@ -182,19 +286,157 @@ def _maintain_size(asg_name, asg_client):
         return True
 
 
-def _is_stack_ready(stack_name, region, proxy_config):
+def _maintain_reserve(asg_cache, cluster_state):
+    """
+    Verify if the idle nodes are not more than the warm reserve published by the master node.
+
+    :param asg_cache: AsgStateCache of the compute fleet ASG
+    :param cluster_state: cluster state published by the master node, if any
+    :return: True if the node is needed by the warm reserve
+    """
+    if not cluster_state or not cluster_state.get('warm_reserve') or cluster_state.get('busy_nodes') is None:
+        return False
+    _capacity = asg_cache.get().get('DesiredCapacity')
+    _kept = cluster_state.get('busy_nodes') + (cluster_state.get('pending_nodes') or 0) + \
+        cluster_state.get('warm_reserve')
+    log.info("DesiredCapacity is %d, %d nodes kept for the demand and the warm reserve" % (_capacity, _kept))
+    return _capacity <= _kept
+
+
+def _read_shared_state(cluster_state_file, asg_cache, stack_status):
+    """
+    Load the ASG limits and the stack readiness published by the master node, if available and fresh.
+
+    :param cluster_state_file: path of the state file on the shared filesystem, None if not configured
+    :param asg_cache: AsgStateCache to seed with the published ASG state
+    :param stack_status: StackStatus to mark as ready if the master found the stack ready
+    :return: the published state, None if not available
+    """
+    if not cluster_state_file:
+        return None
+    state = read_cluster_state(cluster_state_file, max_age=180)
+    if state:
+        if state.get('asg'):
+            asg_cache.set(state.get('asg'))
+        if state.get('stack_ready'):
+            stack_status.set_ready()
+    return state
+
+
+def _load_bootstrap_state(bootstrap_file):
+    """
+    Load the instance identity, ASG and stack readiness discovered by a previous run.
+
+    :param bootstrap_file: file where the bootstrap state is persisted
+    :return: the bootstrap state, empty if not available
+    """
+    try:
+        with open(bootstrap_file) as f:
+            bootstrap = json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+    if not bootstrap.get('instance_id') or not bootstrap.get('hostname'):
+        return {}
+    log.info("Loaded bootstrap state from %s" % bootstrap_file)
+    return bootstrap
+
+
+def _store_bootstrap_state(bootstrap_file, bootstrap):
+    """
+    Persist the bootstrap state, so that restarts skip the discovery.
+
+    :param bootstrap_file: file where the bootstrap state is persisted
+    :param bootstrap: the state to persist
+    """
+    try:
+        atomic_write(bootstrap_file, json.dumps(bootstrap))
+    except (IOError, OSError) as e:
+        log.warning("Unable to persist bootstrap state to %s: %s" % (bootstrap_file, e))
+
+
+def _get_startup_delay(idle_check_interval):
+    """
+    Get a random delay before the first check, to spread the scheduler queries of the nodes started together.
+
+    :param idle_check_interval: time between two checks, in seconds
+    :return: the delay in seconds, between 0 and idle_check_interval
+    """
+    return random.uniform(0, idle_check_interval)
+
+
+def _load_idle_since(idletime_file):
+    """
+    Load the time since when the node has been idle, persisted by a previous run.
+
+    :param idletime_file: file where the idle state is persisted
+    :return: the monotonic time since when the node has been idle, None if the node was not idle
+    """
+    try:
+        with open(idletime_file) as f:
+            data = json.loads(f.read())
+    except (IOError, ValueError):
+        return None
+
+    if "idle_since" in data:
+        idle_since = data["idle_since"]
+    else:
+        # file written by an older version, counting idle minutes
+        idle_since = monotonic() - data.get("current_idletime", 0) * 60
+    if idle_since is not None and idle_since > monotonic():
+        # persisted before a reboot
+        return None
+    return idle_since
+
+
+def _store_idle_since(idletime_file, idle_since):
     """
-    Verify if the Stack is in one of the *_COMPLETE states.
+    Persist the time since when the node has been idle, to survive restarts of the daemon.
 
-    :param stack_name: Stack to query for
-    :param region: AWS region
-    :param proxy_config: Proxy configuration
-    :return: true if the stack is in the *_COMPLETE status
+    :param idletime_file: file where the idle state is persisted
+    :param idle_since: the monotonic time since when the node has been idle, None if the node is not idle
     """
-    log.info('Checking for status of the stack %s' % stack_name)
-    cfn_client = boto3.client('cloudformation', region_name=region, config=proxy_config)
-    stacks = cfn_client.describe_stacks(StackName=stack_name)
-    return stacks['Stacks'][0]['StackStatus'] in ['CREATE_COMPLETE', 'UPDATE_COMPLETE', 'UPDATE_ROLLBACK_COMPLETE']
+    with open(idletime_file, 'w') as outfile:
+        json.dump({"idle_since": idle_since}, outfile)
+
+
+def _reset_idle_since(idletime_file, idle_since):
+    """
+    Mark the node as busy, persisting the change only if the node was idle.
+
+    :param idletime_file: file where the idle state is persisted
+    :param idle_since: the current idle state
+    :return: the new idle state, i.e. None
+    """
+    if idle_since is not None:
+        _store_idle_since(idletime_file, None)
+    return None
+
+
+def _update_idle_since(idletime_file, idle_since, held_since, held):
+    """
+    Track the idle time of a node without jobs, the idle time doesn't increase while the node can't be released.
+
+    :param idletime_file: file where the idle state is persisted
+    :param idle_since: the monotonic time since when the node has been idle, None if the node was busy
+    :param held_since: the monotonic time since when the node can't be released, None if it could be released
+    :param held: True if the node can't be released now, e.g. needed to keep the ASG min size
+    :return: the new idle_since and held_since
+    """
+    if held:
+        if held_since is None:
+            held_since = monotonic()
+        return idle_since, held_since
+
+    if held_since is not None:
+        if idle_since is not None:
+            idle_since += monotonic() - held_since
+            _store_idle_since(idletime_file, idle_since)
+        held_since = None
+    if idle_since is None:
+        idle_since = monotonic()
+        _store_idle_since(idletime_file, idle_since)
+    return idle_since, held_since
 
 
 def main():
@@ -203,69 +445,131 @@ def main():
         format='%(asctime)s %(levelname)s [%(module)s:%(funcName)s] %(message)s'
     )
     log.info('nodewatcher startup')
-    instance_id = _get_metadata("instance-id")
-    hostname = _get_metadata("local-hostname")
-    log.info('Instance id is %s, hostname is %s' % (instance_id, hostname))
-    region, asg_name, scheduler, proxy_config, idle_time, stack_name = _get_config(instance_id)
-
-    scheduler_module = _load_scheduler_module(scheduler)
 
+    # the idle time is reset by a reboot, the bootstrap state (e.g. the launch time) must survive it
     data_dir = "/var/run/nodewatcher/"
-    try:
-        if not os.path.exists(data_dir):
-            os.makedirs(data_dir)
-    except OSError as ex:
-        log.critical('Creating directory %s to persist current idle time failed with exception: %s ' % (data_dir, ex))
-        raise
-
-    idletime_file = data_dir + "node_idletime.json"
-    if os.path.isfile(idletime_file):
-        with open(idletime_file) as f:
-            data = json.loads(f.read())
+    state_dir = "/var/lib/nodewatcher/"
+    for directory in (data_dir, state_dir):
+        try:
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+        except OSError as ex:
+            log.critical('Creating directory %s to persist the node state failed with exception: %s ' % (directory, ex))
+            raise
+
+    # resume from the state discovered by a previous run, if any
+    bootstrap_file = state_dir + "bootstrap.json"
+    bootstrap = _load_bootstrap_state(bootstrap_file)
+    if bootstrap:
+        instance_id = bootstrap.get('instance_id')
+        hostname = bootstrap.get('hostname')
     else:
-        data = {"current_idletime": 0}
+        instance_id = _get_metadata("instance-id")
+        hostname = _get_metadata("local-hostname")
+    log.info('Instance id is %s, hostname is %s' % (instance_id, hostname))
+    config = _get_config(instance_id, bootstrap.get('asg'))
+    if not bootstrap:
+        bootstrap = {'instance_id': instance_id, 'hostname': hostname, 'asg': config.asg, 'stack_ready': False}
+    if not bootstrap.get('launch_time'):
+        # the first start of the daemon, shortly after the launch of the node
+        bootstrap['launch_time'] = time.time()
+        _store_bootstrap_state(bootstrap_file, bootstrap)
+
+    scheduler_module = _load_scheduler_module(config.scheduler)
+    local_job_detection = config.job_detection == 'local'
+    if local_job_detection and not hasattr(scheduler_module, 'hasLocalJobs'):
+        log.warning("Local job detection not supported by scheduler %s, querying the scheduler" % config.scheduler)
+        local_job_detection = False
 
-    stack_ready = False
+    idletime_file = data_dir + "node_idletime.json"
+    idle_since = _load_idle_since(idletime_file)
+    # monotonic time since when the idle node can't be released, the idle time doesn't increase meanwhile
+    held_since = None
+    # shared by all the nodes, each node writes its own file
+    latency_log = get_latency_log(config.latency_dir, 'nodewatcher-%s' % instance_id)
+
+    stack_status = StackStatus(config.stack_name, config.region, config.proxy_config)
+    if bootstrap.get('stack_ready'):
+        stack_status.set_ready()
+    asg_cache = AsgStateCache(
+        boto3.client('autoscaling', region_name=config.region, config=config.proxy_config),
+        config.asg,
+        ttl=config.asg_cache_ttl,
+        ttl_jitter=0.2,
+    )
     termination_in_progress = False
+    # spread the scheduler queries of nodes started together
+    time.sleep(_get_startup_delay(config.idle_check_interval))
     while True:
         # if this node is terminating sleep for a long time and wait for termination
         if termination_in_progress:
             time.sleep(300)
             log.info('Instance is still terminating')
             continue
-        time.sleep(60)
-        if not stack_ready:
-            stack_ready = _is_stack_ready(stack_name, region, proxy_config)
-            log.info('Stack %s ready: %s' % (stack_name, stack_ready))
+        time.sleep(config.idle_check_interval)
+        cluster_state = _read_shared_state(config.cluster_state_file, asg_cache, stack_status)
+        if not stack_status.is_ready():
             continue
-        asg_conn = boto3.client('autoscaling', region_name=region, config=proxy_config)
+        if not bootstrap.get('stack_ready'):
+            bootstrap['stack_ready'] = True
+            _store_bootstrap_state(bootstrap_file, bootstrap)
 
-        has_jobs = _has_jobs(scheduler_module, hostname)
+        # with local detection the scheduler is queried only to confirm the host is empty before termination
+        if local_job_detection:
+            has_jobs = _has_local_jobs(scheduler_module)
+        else:
+            has_jobs = _has_jobs(scheduler_module, hostname)
         if has_jobs:
             log.info('Instance has active jobs.')
-            data["current_idletime"] = 0
+            if latency_log and not bootstrap.get('first_job_seen'):
+                _record_first_job(latency_log, scheduler_module, instance_id, hostname)
+                bootstrap['first_job_seen'] = True
+                _store_bootstrap_state(bootstrap_file, bootstrap)
+            idle_since = _reset_idle_since(idletime_file, idle_since)
+            held_since = None
+            if config.idle_reports_dir:
+                remove_idle_report(config.idle_reports_dir, instance_id)
         else:
-            if _maintain_size(asg_name, asg_conn):
+            held = _maintain_size(asg_cache) or _maintain_reserve(asg_cache, cluster_state)
+            idle_since, held_since = _update_idle_since(idletime_file, idle_since, held_since, held)
+            if held:
+                # the node can't be released, the idle time is frozen until it can
                 continue
             else:
-                data["current_idletime"] += 1
-                log.info('Instance had no job for the past %s minute(s)' % data["current_idletime"])
-                with open(idletime_file, 'w') as outfile:
-                    json.dump(data, outfile)
-
-                if data["current_idletime"] >= idle_time:
-                    _lock_host(scheduler_module, hostname)
-                    has_jobs = _has_jobs(scheduler_module, hostname)
-                    if has_jobs:
-                        log.info('Instance has active jobs.')
-                        data["current_idletime"] = 0
+                idle_time = monotonic() - idle_since
+                log.info('Instance had no job for the past %d second(s)' % idle_time)
+
+                if idle_time >= config.scaledown_idletime * 60:
+                    # keep the node after a recent scale-out, the next wave of jobs is likely to need it
+                    last_scale_out = cluster_state.get('last_scale_out') if cluster_state else None
+                    delay = get_scalein_delay(
+                        last_scale_out, config.scalein_cooldown * 60, bootstrap.get('launch_time'),
+                        config.min_node_lifetime * 60
+                    )
+                    if delay > 0:
+                        log.info('Scale-in on hold for %d more second(s)' % delay)
+                        if config.idle_reports_dir:
+                            remove_idle_report(config.idle_reports_dir, instance_id)
+                        continue
+
+                if idle_time >= config.scaledown_idletime * 60 and config.idle_reports_dir:
+                    # the master node decides which idle nodes to release
+                    write_idle_report(
+                        config.idle_reports_dir, instance_id, hostname, idle_time, bootstrap.get('launch_time')
+                    )
+                elif idle_time >= config.scaledown_idletime * 60:
+                    if not _lock_host(scheduler_module, hostname, drain_timeout=config.drain_timeout):
+                        log.info('Instance has active jobs or could not be drained.')
+                        idle_since = _reset_idle_since(idletime_file, idle_since)
                         _lock_host(scheduler_module, hostname, unlock=True)
                     else:
-                        has_pending_jobs, error = _has_pending_jobs(scheduler_module)
+                        has_pending_jobs, error = _has_pending_jobs(
+                            scheduler_module, cluster_state, config.pending_jobs_max_age
+                        )
                         if not error and not has_pending_jobs:
                             os.remove(idletime_file)
                             try:
-                                _self_terminate(asg_name, asg_conn, instance_id)
+                                _self_terminate(asg_cache, instance_id)
                                 termination_in_progress = True
                             except ClientError as ex:
                                 log.error('Failed to terminate instance with exception %s' % ex)
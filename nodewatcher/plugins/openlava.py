@@ -15,13 +15,15 @@ import subprocess
 import os
 import logging
 
+from common.scheduler_commands import check_command, run_command
+
 log = logging.getLogger(__name__)
 
-def getJobs(hostname):
+def hasJobs(hostname):
     # Checking for running jobs on the node
     command = ['/opt/openlava/bin/bjobs', '-m', hostname, '-u', 'all']
     try:
-       output = subprocess.Popen(command, stdout=subprocess.PIPE).communicate()[0]
+       output = run_command(command)
     except subprocess.CalledProcessError:
         log.error("Failed to run %s\n" % _command)
 
@@ -37,7 +39,27 @@ def lockHost(hostname, unlock=False):
     _mod = unlock and 'hopen' or 'hclose'
     command = ['/opt/openlava/bin/badmin', _mod, hostname]
     try:
-        subprocess.check_call(command)
+        check_command(command)
     except subprocess.CalledProcessError:
         log.error("Failed to run %s\n" % command)
 
+
+def isHostDrained(hostname):
+    # The host status is closed_Adm once closed by badmin hclose
+    command = ['/opt/openlava/bin/bhosts', hostname]
+
+    # Command output
+    # HOST_NAME          STATUS       JL/U    MAX  NJOBS    RUN  SSUSP  USUSP    RSV
+    # ip-172-31-68-26    closed_Adm      -      4      0      0      0      0      0
+    try:
+        output = run_command(command)
+    except OSError:
+        log.error("Failed to run %s\n" % command)
+        return False
+
+    lines = output.split("\n")
+    for line in lines[1:]:
+        line_arr = line.split()
+        if len(line_arr) >= 2:
+            return line_arr[1].startswith('closed')
+    return False
@@ -14,6 +14,9 @@ import os
 import shlex
 import subprocess
 
+from common.scheduler_commands import check_command, run_command
+from utils import is_process_running
+
 log = logging.getLogger(__name__)
 
 
@@ -32,14 +35,11 @@ def hasJobs(hostname):
     # 17 0.50500 STDIN      ec2-user     r     02/06/2019 11:06:30 all.q@ip-172-31-68-26.ec2.inte MASTER 2
 
     try:
-        _output = subprocess.Popen(_command,
-                                  stdout=subprocess.PIPE,
-                                  env=dict(
-                                      os.environ,
-                                      SGE_ROOT='/opt/sge',
-                                      PATH='/opt/sge/bin:/opt/sge/bin/lx-amd64:/bin:/usr/bin',
-                                  ),
-                                  ).communicate()[0]
+        _output = run_command(_command, env=dict(
+            os.environ,
+            SGE_ROOT='/opt/sge',
+            PATH='/opt/sge/bin:/opt/sge/bin/lx-amd64:/bin:/usr/bin',
+        ))
     except subprocess.CalledProcessError:
         print ("Failed to run %s\n" % _command)
         _output = ""
@@ -52,6 +52,11 @@ def hasJobs(hostname):
     return _jobs
 
 
+def hasLocalJobs():
+    # Every job, and every task of parallel jobs, runs under a sge_shepherd process
+    return is_process_running(['sge_shepherd'])
+
+
 def hasPendingJobs():
     command = "/opt/sge/bin/lx-amd64/qstat -g d -s p -u '*'"
 
@@ -68,13 +73,10 @@ def hasPendingJobs():
     has_pending = False
 
     try:
-        process = subprocess.Popen(_command, env=dict(os.environ),
-                                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = run_command(_command, env=dict(os.environ), merge_stderr=True)
     except subprocess.CalledProcessError:
         log.error("Failed to run %s\n" % command)
         error = True
-
-    output = process.communicate()[0]
     lines = filter(None, output.split("\n"))
 
     if len(lines) > 1:
@@ -86,10 +88,34 @@ def lockHost(hostname, unlock=False):
     _mod = unlock and '-e' or '-d'
     command = ['/opt/sge/bin/lx-amd64/qmod', _mod, 'all.q@%s' % hostname]
     try:
-        subprocess.check_call(
+        check_command(
             command,
             env=dict(os.environ, SGE_ROOT='/opt/sge',
                      PATH='/opt/sge/bin:/opt/sge/bin/lx-amd64:/bin:/usr/bin'))
     except subprocess.CalledProcessError:
         log.error("Failed to run %s\n" % command)
 
+
+def isHostDrained(hostname):
+    # The queue instance shows the "d" (disabled) state once locked
+    _command = ['/opt/sge/bin/lx-amd64/qstat', '-f', '-q', 'all.q@%s' % hostname, '-u', '*']
+
+    # Command output
+    # queuename                      qtype resv/used/tot. load_avg arch          states
+    # ---------------------------------------------------------------------------------
+    # all.q@ip-172-31-68-26.ec2.inte BIP   0/0/4          0.01     lx-amd64      d
+    try:
+        output = run_command(_command, env=dict(
+            os.environ,
+            SGE_ROOT='/opt/sge',
+            PATH='/opt/sge/bin:/opt/sge/bin/lx-amd64:/bin:/usr/bin',
+        ))
+    except OSError:
+        log.error("Failed to run %s\n" % _command)
+        return False
+
+    for line in output.split("\n"):
+        line_arr = line.split()
+        if len(line_arr) >= 6 and line_arr[0].startswith('all.q@'):
+            return 'd' in line_arr[5]
+    return False
@@ -13,17 +13,44 @@ import subprocess
 import logging
 import shlex
 import os
+import time
+
+from common.scheduler_commands import check_command, run_command
+from utils import has_matching_paths, is_process_running
 
 log = logging.getLogger(__name__)
+# Slurm node name of the host, by hostname, resolved once since the binding never changes while the host is running
+_node_names = {}
 
 
-def hasJobs(hostname):
+def _getNodeName(hostname):
+    if hostname in _node_names:
+        return _node_names[hostname]
+
     # Slurm won't use FQDN
     short_name = hostname.split('.')[0]
+    # Nodes of a pre-provisioned pool are bound to the instance through their NodeHostname
+    _command = ['/opt/slurm/bin/sinfo', '-h', '-N', '-o', '%N %n']
+    try:
+        output = run_command(_command)
+    except OSError:
+        log.error("Failed to run %s\n" % _command)
+        return short_name
+
+    for line in output.split("\n"):
+        line_arr = line.split()
+        if len(line_arr) == 2 and short_name in (line_arr[0], line_arr[1]):
+            _node_names[hostname] = line_arr[0]
+            return line_arr[0]
+    # not added to the cluster yet, resolved again on the next call
+    return short_name
+
+def hasJobs(hostname):
+    node_name = _getNodeName(hostname)
     # Checking for running jobs on the node
-    _command = ['/opt/slurm/bin/squeue', '-w', short_name, '-h']
+    _command = ['/opt/slurm/bin/squeue', '-w', node_name, '-h']
     try:
-        output = subprocess.Popen(_command, stdout=subprocess.PIPE).communicate()[0]
+        output = run_command(_command)
     except subprocess.CalledProcessError:
         log.error("Failed to run %s\n" % _command)
         _output = ""
@@ -35,26 +62,52 @@ def hasJobs(hostname):
 
     return _jobs
 
+def getJobs(hostname):
+    # Submission time of the jobs running on the node, by job id
+    node_name = _getNodeName(hostname)
+    _command = ['/opt/slurm/bin/squeue', '-w', node_name, '-h', '-o', '%i %V']
+    # Sample output, the submission time is in the local timezone:
+    # 72 2019-01-01T10:30:00
+    # 73_1 2019-01-01T10:30:05
+    try:
+        output = run_command(_command)
+    except OSError:
+        log.error("Failed to run %s\n" % _command)
+        return {}
+
+    jobs = {}
+    for line in output.split("\n"):
+        line_arr = line.split()
+        if len(line_arr) == 2:
+            try:
+                jobs[line_arr[0]] = time.mktime(time.strptime(line_arr[1], '%Y-%m-%dT%H:%M:%S'))
+            except ValueError:
+                log.warning("Unable to parse the submission time of job %s: %s" % (line_arr[0], line_arr[1]))
+    return jobs
+
+def hasLocalJobs():
+    # Every job step runs under a slurmstepd process, job cgroups are created when the cgroup plugins are enabled
+    return is_process_running(['slurmstepd']) or has_matching_paths(
+        ['/sys/fs/cgroup/*/slurm/uid_*/job_*', '/sys/fs/cgroup/*/slurm_*/uid_*/job_*']
+    )
+
 def hasPendingJobs():
-    command = "/opt/slurm/bin/squeue -t PD --noheader"
+    command = "/opt/slurm/bin/squeue -t PD --noheader -o '%i'"
 
-    # Command outputs the pending jobs in the queue in the following format
-    #  71   compute   job.sh ec2-user PD       0:00      1 (Resources)
-    #  72   compute   job.sh ec2-user PD       0:00      1 (Priority)
-    #  73   compute   job.sh ec2-user PD       0:00      1 (Priority)
+    # Command outputs only the ids of the pending jobs, array jobs are not expanded
+    # 71
+    # 72
+    # 73_[1-100]
 
     _command = shlex.split(command)
     error = False
     has_pending = False
 
     try:
-        process = subprocess.Popen(_command, env=dict(os.environ),
-                                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = run_command(_command, env=dict(os.environ), merge_stderr=True)
     except subprocess.CalledProcessError:
         log.error("Failed to run %s\n" % command)
         error = True
-
-    output = process.communicate()[0]
     lines = filter(None, output.split("\n"))
 
     if len(lines) > 0:
@@ -63,4 +116,28 @@ def hasPendingJobs():
     return has_pending, error
 
 def lockHost(hostname, unlock=False):
-    pass
+    # Drain the node so that no new job is scheduled on it, running jobs are not affected
+    node_name = _getNodeName(hostname)
+    if unlock:
+        _command = ['/opt/slurm/bin/scontrol', 'update', 'nodename=%s' % node_name, 'state=resume']
+    else:
+        _command = ['/opt/slurm/bin/scontrol', 'update', 'nodename=%s' % node_name, 'state=drain',
+                    'reason=nodewatcher: scaling down idle node']
+    try:
+        check_command(_command)
+    except subprocess.CalledProcessError:
+        log.error("Failed to run %s\n" % _command)
+
+
+def isHostDrained(hostname):
+    # The node state is "draining" while jobs are still running, "drained" when no job is left
+    node_name = _getNodeName(hostname)
+    _command = ['/opt/slurm/bin/sinfo', '-h', '-N', '-n', node_name, '-o', '%T']
+    try:
+        output = run_command(_command)
+    except OSError:
+        log.error("Failed to run %s\n" % _command)
+        return False
+
+    # strip the not responding and power saving flags, e.g. drained*
+    return output.strip().rstrip('*~#%$@') in ('drained', 'draining')
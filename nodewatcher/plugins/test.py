@@ -17,9 +17,16 @@ def hasJobs(hostname):
 
     return _jobs
 
+def hasLocalJobs():
+    # Test function. Change as needed.
+    return False
+
 def hasPendingJobs():
     return False, False
 
 def lockHost(hostname, unlock=False):
     pass
 
+def isHostDrained(hostname):
+    return True
+
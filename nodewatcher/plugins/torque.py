@@ -15,20 +15,23 @@ import subprocess
 import os
 import logging
 import shlex
+import xml.etree.ElementTree as xmltree
+
+from common.scheduler_commands import check_command, executor, run_command
+from utils import has_matching_paths
 
 log = logging.getLogger(__name__)
 
 def runPipe(cmds):
     try:
-        p1 = subprocess.Popen(cmds[0].split(' '), stdin = None, stdout = subprocess.PIPE, stderr = subprocess.PIPE)
-        prev = p1
+        # the scheduler query goes through the shared executor, its output is then fed to the filters
+        result = executor.run(cmds[0].split(' '))
+        stdout, stderr, returncode = result.output, '', result.returncode
         for cmd in cmds[1:]:
-            p = subprocess.Popen(cmd.split(' '), stdin = prev.stdout, stdout = subprocess.PIPE, stderr = subprocess.PIPE)
-            prev = p
-        stdout, stderr = p.communicate()
-        p.wait()
-        returncode = p.returncode
-    except Exception, e:
+            p = subprocess.Popen(cmd.split(' '), stdin = subprocess.PIPE, stdout = subprocess.PIPE, stderr = subprocess.PIPE)
+            stdout, stderr = p.communicate(stdout)
+            returncode = p.returncode
+    except Exception as e:
         stderr = str(e)
         returncode = -1
     if returncode == 0:
@@ -52,6 +55,10 @@ def hasJobs(hostname):
 
     return _jobs
 
+def hasLocalJobs():
+    # pbs_mom keeps a .JB file in its spool for every job assigned to the node
+    return has_matching_paths(['/var/spool/torque/mom_priv/jobs/*.JB'])
+
 def hasPendingJobs():
     command = "/opt/torque/bin/qstat -Q"
 
@@ -65,14 +72,11 @@ def hasPendingJobs():
     error = False
     has_pending = False
     try:
-        process = subprocess.Popen(_command, env=dict(os.environ),
-                                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = run_command(_command, env=dict(os.environ), merge_stderr=True)
     except subprocess.CalledProcessError:
         log.error("Failed to run %s\n" % command)
         error = True
 
-    output = process.communicate()[0]
-
     lines = filter(None, output.split("\n"))
     if len(lines) < 3:
         error = True
@@ -93,7 +97,19 @@ def lockHost(hostname, unlock=False):
     _mod = unlock and '-c' or '-o'
     command = ['/opt/torque/bin/pbsnodes', _mod, hostname]
     try:
-        subprocess.check_call(command)
+        check_command(command)
     except subprocess.CalledProcessError:
         log.error("Failed to run %s\n" % command)
 
+
+def isHostDrained(hostname):
+    # The node state includes "offline" once locked
+    command = ['/opt/torque/bin/pbsnodes', '-x', hostname.split('.')[0]]
+    try:
+        output = run_command(command)
+        state = xmltree.XML(output).findtext("./Node/state")
+    except Exception:
+        log.error("Failed to get state of host %s\n" % hostname)
+        return False
+
+    return state is not None and 'offline' in state.split(',')
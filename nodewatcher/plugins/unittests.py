@@ -0,0 +1,283 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import openlava
+import sge
+import slurm
+import torque
+import utils
+
+
+class _Commands(object):
+    """Stand-in for run_command, returning the given output for each command name."""
+
+    def __init__(self, outputs):
+        self.outputs = outputs
+        self.calls = []
+
+    def __call__(self, args, env=None, merge_stderr=False):
+        self.calls.append(args)
+        return self.outputs[os.path.basename(args[0])]
+
+
+class _PluginTest(unittest.TestCase):
+    module = None
+
+    def setUp(self):
+        self.saved_run_command = self.module.run_command
+
+    def tearDown(self):
+        self.module.run_command = self.saved_run_command
+
+    def _is_host_drained(self, outputs, hostname='ip-172-31-68-26.ec2.internal'):
+        self.commands = _Commands(outputs)
+        self.module.run_command = self.commands
+        return self.module.isHostDrained(hostname)
+
+
+class slurm_drain_tests(_PluginTest):
+    module = slurm
+
+    def setUp(self):
+        _PluginTest.setUp(self)
+        slurm._node_names.clear()
+
+    def tearDown(self):
+        _PluginTest.tearDown(self)
+        slurm._node_names.clear()
+
+    def _sinfo(self, state):
+        outputs = {
+            '%N %n': 'compute-1 ip-172-31-68-26\ncompute-2 ip-172-31-68-27\n',
+            '%T': state,
+        }
+        return lambda args, env=None, merge_stderr=False: outputs[args[-1]]
+
+    def test_drained(self):
+        for state in ['drained\n', 'drained*\n', 'draining\n']:
+            slurm.run_command = self._sinfo(state)
+            drained = slurm.isHostDrained('ip-172-31-68-26.ec2.internal')
+            self.assertTrue(drained, "test_drained failed: %s not drained" % state.strip())
+
+    def test_busy(self):
+        for state in ['idle\n', 'allocated\n', 'mixed\n', 'down*\n', '']:
+            slurm.run_command = self._sinfo(state)
+            drained = slurm.isHostDrained('ip-172-31-68-26.ec2.internal')
+            self.assertFalse(drained, "test_busy failed: %s drained" % state.strip())
+
+    def test_pool_node_name(self):
+        commands = []
+
+        def run_command(args, env=None, merge_stderr=False):
+            commands.append(args)
+            return self._sinfo('drained\n')(args)
+        slurm.run_command = run_command
+        slurm.isHostDrained('ip-172-31-68-27.ec2.internal')
+        expected = ['/opt/slurm/bin/sinfo', '-h', '-N', '-n', 'compute-2', '-o', '%T']
+        self.assertEqual(commands[-1], expected, "test_pool_node_name failed: Got %s; Expected: %s"
+                         % (commands[-1], expected))
+
+    def test_command_failure(self):
+        def run_command(args, env=None, merge_stderr=False):
+            raise OSError('sinfo not found')
+        slurm.run_command = run_command
+        drained = slurm.isHostDrained('ip-172-31-68-26.ec2.internal')
+        self.assertFalse(drained, "test_command_failure failed: host drained")
+
+
+class sge_drain_tests(_PluginTest):
+    module = sge
+    header = ('queuename                      qtype resv/used/tot. load_avg arch          states\n'
+              '---------------------------------------------------------------------------------\n')
+
+    def test_drained(self):
+        drained = self._is_host_drained({
+            'qstat': self.header + 'all.q@ip-172-31-68-26.ec2.inte BIP   0/0/4          0.01     lx-amd64      d\n'
+        })
+        self.assertTrue(drained, "test_drained failed: host not drained")
+        expected = ['/opt/sge/bin/lx-amd64/qstat', '-f', '-q', 'all.q@ip-172-31-68-26.ec2.internal', '-u', '*']
+        self.assertEqual(self.commands.calls, [expected], "test_drained failed: Got %s; Expected: %s"
+                         % (self.commands.calls, [expected]))
+
+    def test_drained_with_other_states(self):
+        drained = self._is_host_drained({
+            'qstat': self.header + 'all.q@ip-172-31-68-26.ec2.inte BIP   0/0/4          0.01     lx-amd64      adu\n'
+        })
+        self.assertTrue(drained, "test_drained_with_other_states failed: host not drained")
+
+    def test_busy(self):
+        drained = self._is_host_drained({
+            'qstat': self.header + 'all.q@ip-172-31-68-26.ec2.inte BIP   0/2/4          0.01     lx-amd64\n'
+                                   '    16 0.55500 job.sh     ec2-user     r     02/06/2019 11:06:30     2\n'
+        })
+        self.assertFalse(drained, "test_busy failed: host drained")
+
+    def test_unknown_host(self):
+        drained = self._is_host_drained({'qstat': ''})
+        self.assertFalse(drained, "test_unknown_host failed: host drained")
+
+
+class torque_drain_tests(_PluginTest):
+    module = torque
+    node = ('<Data><Node><name>ip-172-31-68-26</name><state>%s</state><np>4</np>'
+            '<ntype>cluster</ntype></Node></Data>')
+
+    def test_drained(self):
+        for state in ['offline', 'offline,job-exclusive']:
+            drained = self._is_host_drained({'pbsnodes': self.node % state})
+            self.assertTrue(drained, "test_drained failed: %s not drained" % state)
+        expected = ['/opt/torque/bin/pbsnodes', '-x', 'ip-172-31-68-26']
+        self.assertEqual(self.commands.calls, [expected], "test_drained failed: Got %s; Expected: %s"
+                         % (self.commands.calls, [expected]))
+
+    def test_busy(self):
+        for state in ['free', 'job-exclusive', 'down']:
+            drained = self._is_host_drained({'pbsnodes': self.node % state})
+            self.assertFalse(drained, "test_busy failed: %s drained" % state)
+
+    def test_invalid_output(self):
+        drained = self._is_host_drained({'pbsnodes': 'pbsnodes: Unknown node  MSG=cannot locate specified node'})
+        self.assertFalse(drained, "test_invalid_output failed: host drained")
+
+
+class openlava_drain_tests(_PluginTest):
+    module = openlava
+    header = 'HOST_NAME          STATUS       JL/U    MAX  NJOBS    RUN  SSUSP  USUSP    RSV\n'
+
+    def test_drained(self):
+        for status in ['closed_Adm', 'closed_Full']:
+            drained = self._is_host_drained({
+                'bhosts': self.header + 'ip-172-31-68-26    %s      -      4      0      0      0      0      0\n'
+                                        % status
+            })
+            self.assertTrue(drained, "test_drained failed: %s not drained" % status)
+
+    def test_busy(self):
+        for status in ['ok', 'unavail']:
+            drained = self._is_host_drained({
+                'bhosts': self.header + 'ip-172-31-68-26    %s      -      4      2      2      0      0      0\n'
+                                        % status
+            })
+            self.assertFalse(drained, "test_busy failed: %s drained" % status)
+
+    def test_has_jobs(self):
+        self.commands = _Commands({'bjobs': ''})
+        openlava.run_command = self.commands
+        self.assertFalse(openlava.hasJobs('ip-172-31-68-26'), "test_has_jobs failed: jobs found")
+        self.commands.outputs['bjobs'] = ('JOBID   USER    STAT  QUEUE      FROM_HOST   EXEC_HOST   JOB_NAME\n'
+                                          '101     alice   RUN   normal     master      ip-172-31-6 job.sh\n')
+        self.assertTrue(openlava.hasJobs('ip-172-31-68-26'), "test_has_jobs failed: no job found")
+
+
+class _LocalJobsTest(unittest.TestCase):
+    """Run the local job detection of the plugins against a fake /proc and spool tree."""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.proc_dir = os.path.join(self.root, 'proc')
+        os.makedirs(self.proc_dir)
+        self._add_process(1, 'systemd')
+        self._add_process(880, 'sshd')
+        os.makedirs(os.path.join(self.proc_dir, 'self'))
+        self.saved = {}
+        for module in (slurm, sge, torque):
+            for name in ('is_process_running', 'has_matching_paths'):
+                if hasattr(module, name):
+                    self.saved[(module, name)] = getattr(module, name)
+            if hasattr(module, 'is_process_running'):
+                module.is_process_running = lambda names: utils.is_process_running(names, proc_dir=self.proc_dir)
+            if hasattr(module, 'has_matching_paths'):
+                module.has_matching_paths = lambda patterns: utils.has_matching_paths(
+                    [self.root + pattern for pattern in patterns]
+                )
+
+    def tearDown(self):
+        for (module, name), value in self.saved.items():
+            setattr(module, name, value)
+        shutil.rmtree(self.root)
+
+    def _add_process(self, pid, name):
+        os.makedirs(os.path.join(self.proc_dir, str(pid)))
+        with open(os.path.join(self.proc_dir, str(pid), 'comm'), 'w') as comm:
+            comm.write(name + '\n')
+
+    def _add_path(self, path, directory=False):
+        path = self.root + path
+        os.makedirs(path if directory else os.path.dirname(path))
+        if not directory:
+            open(path, 'w').close()
+
+
+class process_detection_tests(_LocalJobsTest):
+    def test_process_running(self):
+        self._add_process(4242, 'slurmstepd')
+        found = utils.is_process_running(['slurmstepd'], proc_dir=self.proc_dir)
+        self.assertTrue(found, "test_process_running failed: slurmstepd not found")
+
+    def test_process_not_running(self):
+        # the name must match exactly, e.g. not the slurmd daemon
+        self._add_process(4242, 'slurmd')
+        found = utils.is_process_running(['slurmstepd'], proc_dir=self.proc_dir)
+        self.assertFalse(found, "test_process_not_running failed: slurmstepd found")
+
+    def test_exited_process(self):
+        # the process exited between the listing of /proc and the read of its name
+        os.makedirs(os.path.join(self.proc_dir, '4242'))
+        found = utils.is_process_running(['slurmstepd'], proc_dir=self.proc_dir)
+        self.assertFalse(found, "test_exited_process failed: slurmstepd found")
+
+    def test_matching_paths(self):
+        self._add_path('/var/spool/jobs/12.JB')
+        found = utils.has_matching_paths([self.root + '/var/spool/jobs/*.SC', self.root + '/var/spool/jobs/*.JB'])
+        self.assertTrue(found, "test_matching_paths failed: job file not found")
+        found = utils.has_matching_paths([self.root + '/var/spool/jobs/*.SC'])
+        self.assertFalse(found, "test_matching_paths failed: job script found")
+
+
+class slurm_local_jobs_tests(_LocalJobsTest):
+    def test_idle(self):
+        self._add_process(2000, 'slurmd')
+        self._add_path('/sys/fs/cgroup/memory/slurm/uid_1000', directory=True)
+        self.assertFalse(slurm.hasLocalJobs(), "test_idle failed: jobs found")
+
+    def test_job_step(self):
+        self._add_process(2000, 'slurmd')
+        self._add_process(2001, 'slurmstepd')
+        self.assertTrue(slurm.hasLocalJobs(), "test_job_step failed: no job found")
+
+    def test_job_cgroup(self):
+        self._add_path('/sys/fs/cgroup/memory/slurm/uid_1000/job_12', directory=True)
+        self.assertTrue(slurm.hasLocalJobs(), "test_job_cgroup failed: no job found")
+
+    def test_job_cgroup_with_node_name(self):
+        # cgroup hierarchy of slurm configured with multiple slurmd or a custom cgroup prefix
+        self._add_path('/sys/fs/cgroup/cpuset/slurm_compute-1/uid_1000/job_12', directory=True)
+        self.assertTrue(slurm.hasLocalJobs(), "test_job_cgroup_with_node_name failed: no job found")
+
+
+class sge_local_jobs_tests(_LocalJobsTest):
+    def test_idle(self):
+        self._add_process(2000, 'sge_execd')
+        self.assertFalse(sge.hasLocalJobs(), "test_idle failed: jobs found")
+
+    def test_shepherd(self):
+        self._add_process(2000, 'sge_execd')
+        self._add_process(2001, 'sge_shepherd')
+        self.assertTrue(sge.hasLocalJobs(), "test_shepherd failed: no job found")
+
+
+class torque_local_jobs_tests(_LocalJobsTest):
+    def test_idle(self):
+        self._add_path('/var/spool/torque/mom_priv/jobs', directory=True)
+        self._add_process(2000, 'pbs_mom')
+        self.assertFalse(torque.hasLocalJobs(), "test_idle failed: jobs found")
+
+    def test_job_file(self):
+        self._add_path('/var/spool/torque/mom_priv/jobs/12.ip-172-31-68-25.JB')
+        self.assertTrue(torque.hasLocalJobs(), "test_job_file failed: no job found")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+# Copyright 2013-2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You may not use this file except in compliance with the
+# License. A copy of the License is located at
+#
+# http://aws.amazon.com/apache2.0/
+#
+# or in the "LICENSE.txt" file accompanying this file. This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+# OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions and
+# limitations under the License.
+
+import errno
+import glob
+import logging
+import os
+
+log = logging.getLogger(__name__)
+
+
+def is_process_running(process_names, proc_dir='/proc'):
+    """
+    Verify if a process with one of the given names is running on the local host, scanning /proc.
+
+    :param process_names: the names of the executables to search for, as reported in /proc/<pid>/comm
+    :param proc_dir: mount point of the proc filesystem
+    :return: true if at least one process is found
+    """
+    for pid in os.listdir(proc_dir):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(os.path.join(proc_dir, pid, 'comm')) as comm:
+                if comm.read().strip() in process_names:
+                    log.debug("Found process %s with pid %s" % (process_names, pid))
+                    return True
+        except IOError as e:
+            # the process exited in the meantime
+            if e.errno not in (errno.ENOENT, errno.ESRCH):
+                raise
+    return False
+
+
+def has_matching_paths(patterns):
+    """
+    Verify if at least one path matches one of the given glob patterns, e.g. job cgroups or spool files.
+
+    :param patterns: list of glob patterns
+    :return: true if at least one path matches
+    """
+    for pattern in patterns:
+        if glob.glob(pattern):
+            log.debug("Found paths matching %s" % pattern)
+            return True
+    return False
@@ -0,0 +1,447 @@
+import json
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+try:
+    import nodewatcher
+except ImportError:
+    # boto3 not installed, or Python 3 which nodewatcher doesn't support yet
+    nodewatcher = None
+
+
+class _Clock(object):
+    """Stand-in for the time module and monotonic, sleeping advances the clock."""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class _Scheduler(object):
+    """Scheduler plugin reporting the given drain and job states at each poll, the last one is repeated."""
+
+    def __init__(self, drained=(True,), jobs=(False,), pending=(False, False)):
+        self.drained = list(drained)
+        self.jobs = list(jobs)
+        self.pending = pending
+        self.locks = []
+        self.polls = 0
+        self.pending_queries = 0
+
+    def lockHost(self, hostname, unlock=False):
+        self.locks.append((hostname, unlock))
+
+    def isHostDrained(self, hostname):
+        self.polls += 1
+        return self.drained.pop(0) if len(self.drained) > 1 else self.drained[0]
+
+    def hasJobs(self, hostname):
+        return self.jobs.pop(0) if len(self.jobs) > 1 else self.jobs[0]
+
+    def hasPendingJobs(self):
+        self.pending_queries += 1
+        return self.pending
+
+
+class lock_host_tests(unittest.TestCase):
+    def setUp(self):
+        if nodewatcher is None:
+            return
+        self.clock = _Clock()
+        self.saved = (nodewatcher.monotonic, nodewatcher.time)
+        nodewatcher.monotonic = self.clock.monotonic
+        nodewatcher.time = self.clock
+
+    def tearDown(self):
+        if nodewatcher is None:
+            return
+        nodewatcher.monotonic, nodewatcher.time = self.saved
+
+    def test_drained(self):
+        if nodewatcher is None:
+            return
+        scheduler = _Scheduler(drained=[True], jobs=[False])
+        locked = nodewatcher._lock_host(scheduler, 'ip-1', drain_timeout=60, poll_interval=2)
+        self.assertTrue(locked, "test_drained failed: host not locked")
+        expected = [('ip-1', False)]
+        self.assertEqual(scheduler.locks, expected, "test_drained failed: Got %s; Expected: %s"
+                         % (scheduler.locks, expected))
+        self.assertEqual(self.clock.sleeps, [], "test_drained failed: Got %s; Expected: []" % self.clock.sleeps)
+
+    def test_drained_after_polls(self):
+        if nodewatcher is None:
+            return
+        scheduler = _Scheduler(drained=[False, False, True], jobs=[False])
+        locked = nodewatcher._lock_host(scheduler, 'ip-1', drain_timeout=60, poll_interval=2)
+        self.assertTrue(locked, "test_drained_after_polls failed: host not locked")
+        expected = [2, 2]
+        self.assertEqual(self.clock.sleeps, expected, "test_drained_after_polls failed: Got %s; Expected: %s"
+                         % (self.clock.sleeps, expected))
+
+    def test_busy(self):
+        if nodewatcher is None:
+            return
+        # e.g. slurm reports draining while a job that raced with the lock is running
+        scheduler = _Scheduler(drained=[True], jobs=[True])
+        locked = nodewatcher._lock_host(scheduler, 'ip-1', drain_timeout=60, poll_interval=2)
+        self.assertFalse(locked, "test_busy failed: host locked")
+        self.assertEqual(self.clock.sleeps, [], "test_busy failed: Got %s; Expected: []" % self.clock.sleeps)
+
+    def test_job_received_while_draining(self):
+        if nodewatcher is None:
+            return
+        scheduler = _Scheduler(drained=[False], jobs=[False, True])
+        locked = nodewatcher._lock_host(scheduler, 'ip-1', drain_timeout=60, poll_interval=2)
+        self.assertFalse(locked, "test_job_received_while_draining failed: host locked")
+        self.assertEqual(scheduler.polls, 2, "test_job_received_while_draining failed: Got %s; Expected: %s"
+                         % (scheduler.polls, 2))
+
+    def test_drain_timeout(self):
+        if nodewatcher is None:
+            return
+        scheduler = _Scheduler(drained=[False], jobs=[False])
+        locked = nodewatcher._lock_host(scheduler, 'ip-1', drain_timeout=10, poll_interval=2)
+        self.assertFalse(locked, "test_drain_timeout failed: host locked")
+        waited = sum(self.clock.sleeps)
+        self.assertEqual(waited, 10, "test_drain_timeout failed: Got %s; Expected: %s" % (waited, 10))
+        self.assertEqual(scheduler.polls, 6, "test_drain_timeout failed: Got %s; Expected: %s"
+                         % (scheduler.polls, 6))
+
+    def test_unlock(self):
+        if nodewatcher is None:
+            return
+        scheduler = _Scheduler(drained=[False], jobs=[True])
+        unlocked = nodewatcher._lock_host(scheduler, 'ip-1', unlock=True)
+        self.assertTrue(unlocked, "test_unlock failed: host not unlocked")
+        expected = [('ip-1', True)]
+        self.assertEqual(scheduler.locks, expected, "test_unlock failed: Got %s; Expected: %s"
+                         % (scheduler.locks, expected))
+        self.assertEqual(scheduler.polls, 0, "test_unlock failed: Got %s; Expected: %s" % (scheduler.polls, 0))
+
+
+class pending_jobs_tests(unittest.TestCase):
+    def setUp(self):
+        if nodewatcher is None:
+            return
+        self.clock = _Clock()
+        self.saved = nodewatcher.time
+        nodewatcher.time = self.clock
+
+    def tearDown(self):
+        if nodewatcher is None:
+            return
+        nodewatcher.time = self.saved
+
+    def _cluster_state(self, pending_nodes, filtered_jobs=0, age=10):
+        return {'pending_nodes': pending_nodes, 'filtered_demand': {'jobs': filtered_jobs, 'slots': 0, 'reasons': {}},
+                'timestamp': self.clock.now - age}
+
+    def test_fresh_state_with_pending_jobs(self):
+        if nodewatcher is None:
+            return
+        scheduler = _Scheduler(pending=(False, False))
+        result = nodewatcher._has_pending_jobs(scheduler, self._cluster_state(3), max_age=90)
+        self.assertEqual(result, (True, False), "test_fresh_state_with_pending_jobs failed: Got %s; Expected: %s"
+                         % (result, (True, False)))
+        self.assertEqual(scheduler.pending_queries, 0, "test_fresh_state_with_pending_jobs failed: scheduler queried")
+
+    def test_fresh_state_without_pending_jobs(self):
+        if nodewatcher is None:
+            return
+        scheduler = _Scheduler(pending=(True, False))
+        result = nodewatcher._has_pending_jobs(scheduler, self._cluster_state(0, age=90), max_age=90)
+        self.assertEqual(result, (False, False), "test_fresh_state_without_pending_jobs failed: Got %s; Expected: %s"
+                         % (result, (False, False)))
+        self.assertEqual(scheduler.pending_queries, 0,
+                         "test_fresh_state_without_pending_jobs failed: scheduler queried")
+
+    def test_fresh_state_with_filtered_jobs(self):
+        if nodewatcher is None:
+            return
+        # held jobs aren't part of the published demand, but the scheduler query counts them as pending
+        scheduler = _Scheduler(pending=(False, False))
+        result = nodewatcher._has_pending_jobs(scheduler, self._cluster_state(0, filtered_jobs=2), max_age=90)
+        self.assertEqual(result, (True, False), "test_fresh_state_with_filtered_jobs failed: Got %s; Expected: %s"
+                         % (result, (True, False)))
+
+    def test_state_without_filtered_demand(self):
+        if nodewatcher is None:
+            return
+        scheduler = _Scheduler(pending=(True, False))
+        cluster_state = {'pending_nodes': 0, 'timestamp': self.clock.now}
+        result = nodewatcher._has_pending_jobs(scheduler, cluster_state, max_age=90)
+        self.assertEqual(result, (False, False), "test_state_without_filtered_demand failed: Got %s; Expected: %s"
+                         % (result, (False, False)))
+
+    def test_stale_state(self):
+        if nodewatcher is None:
+            return
+        scheduler = _Scheduler(pending=(True, False))
+        result = nodewatcher._has_pending_jobs(scheduler, self._cluster_state(0, age=91), max_age=90)
+        self.assertEqual(result, (True, False), "test_stale_state failed: Got %s; Expected: %s"
+                         % (result, (True, False)))
+        self.assertEqual(scheduler.pending_queries, 1, "test_stale_state failed: scheduler not queried")
+
+    def test_unknown_demand(self):
+        if nodewatcher is None:
+            return
+        # published when jobwatcher failed to compute the demand
+        scheduler = _Scheduler(pending=(False, True))
+        result = nodewatcher._has_pending_jobs(scheduler, self._cluster_state(None), max_age=90)
+        self.assertEqual(result, (False, True), "test_unknown_demand failed: Got %s; Expected: %s"
+                         % (result, (False, True)))
+        self.assertEqual(scheduler.pending_queries, 1, "test_unknown_demand failed: scheduler not queried")
+
+    def test_no_state(self):
+        if nodewatcher is None:
+            return
+        scheduler = _Scheduler(pending=(True, False))
+        result = nodewatcher._has_pending_jobs(scheduler, None, max_age=90)
+        self.assertEqual(result, (True, False), "test_no_state failed: Got %s; Expected: %s"
+                         % (result, (True, False)))
+        self.assertEqual(scheduler.pending_queries, 1, "test_no_state failed: scheduler not queried")
+
+
+class idle_time_tests(unittest.TestCase):
+    def setUp(self):
+        if nodewatcher is None:
+            return
+        self.directory = tempfile.mkdtemp()
+        self.idletime_file = os.path.join(self.directory, 'node_idletime.json')
+        self.clock = _Clock()
+        self.saved = nodewatcher.monotonic
+        nodewatcher.monotonic = self.clock.monotonic
+
+    def tearDown(self):
+        if nodewatcher is None:
+            return
+        nodewatcher.monotonic = self.saved
+        shutil.rmtree(self.directory)
+
+    def _write(self, data):
+        with open(self.idletime_file, 'w') as f:
+            json.dump(data, f)
+
+    def test_round_trip(self):
+        if nodewatcher is None:
+            return
+        nodewatcher._store_idle_since(self.idletime_file, 400.5)
+        idle_since = nodewatcher._load_idle_since(self.idletime_file)
+        self.assertEqual(idle_since, 400.5, "test_round_trip failed: Got %s; Expected: %s" % (idle_since, 400.5))
+
+    def test_not_idle(self):
+        if nodewatcher is None:
+            return
+        nodewatcher._store_idle_since(self.idletime_file, None)
+        idle_since = nodewatcher._load_idle_since(self.idletime_file)
+        self.assertEqual(idle_since, None, "test_not_idle failed: Got %s; Expected: None" % idle_since)
+
+    def test_missing_or_corrupted_file(self):
+        if nodewatcher is None:
+            return
+        idle_since = nodewatcher._load_idle_since(self.idletime_file)
+        self.assertEqual(idle_since, None, "test_missing_or_corrupted_file failed: Got %s; Expected: None" % idle_since)
+        with open(self.idletime_file, 'w') as f:
+            f.write('{"idle_since": ')
+        idle_since = nodewatcher._load_idle_since(self.idletime_file)
+        self.assertEqual(idle_since, None, "test_missing_or_corrupted_file failed: Got %s; Expected: None" % idle_since)
+
+    def test_older_version_file(self):
+        if nodewatcher is None:
+            return
+        self._write({'current_idletime': 5})
+        idle_since = nodewatcher._load_idle_since(self.idletime_file)
+        expected = self.clock.now - 300
+        self.assertEqual(idle_since, expected, "test_older_version_file failed: Got %s; Expected: %s"
+                         % (idle_since, expected))
+
+    def test_persisted_before_reboot(self):
+        if nodewatcher is None:
+            return
+        # the monotonic clock restarts from zero at boot, a time from the previous boot can be in its future
+        self._write({'idle_since': self.clock.now + 3600})
+        idle_since = nodewatcher._load_idle_since(self.idletime_file)
+        self.assertEqual(idle_since, None, "test_persisted_before_reboot failed: Got %s; Expected: None" % idle_since)
+
+    def test_reset(self):
+        if nodewatcher is None:
+            return
+        nodewatcher._store_idle_since(self.idletime_file, 400)
+        idle_since = nodewatcher._reset_idle_since(self.idletime_file, 400)
+        stored = nodewatcher._load_idle_since(self.idletime_file)
+        self.assertEqual((idle_since, stored), (None, None), "test_reset failed: Got %s; Expected: %s"
+                         % ((idle_since, stored), (None, None)))
+
+    def test_reset_busy_node(self):
+        if nodewatcher is None:
+            return
+        # a busy node doesn't rewrite the file at every check
+        idle_since = nodewatcher._reset_idle_since(self.idletime_file, None)
+        self.assertEqual(idle_since, None, "test_reset_busy_node failed: Got %s; Expected: None" % idle_since)
+        self.assertFalse(os.path.exists(self.idletime_file), "test_reset_busy_node failed: idle time persisted")
+
+    def test_becomes_idle(self):
+        if nodewatcher is None:
+            return
+        result = nodewatcher._update_idle_since(self.idletime_file, None, None, held=False)
+        expected = (self.clock.now, None)
+        self.assertEqual(result, expected, "test_becomes_idle failed: Got %s; Expected: %s" % (result, expected))
+        stored = nodewatcher._load_idle_since(self.idletime_file)
+        self.assertEqual(stored, self.clock.now, "test_becomes_idle failed: Got %s; Expected: %s"
+                         % (stored, self.clock.now))
+
+    def test_idle_time_increases(self):
+        if nodewatcher is None:
+            return
+        idle_since, held_since = nodewatcher._update_idle_since(self.idletime_file, None, None, held=False)
+        self.clock.sleep(120)
+        result = nodewatcher._update_idle_since(self.idletime_file, idle_since, held_since, held=False)
+        self.assertEqual(result, (idle_since, None), "test_idle_time_increases failed: Got %s; Expected: %s"
+                         % (result, (idle_since, None)))
+        idle_time = self.clock.monotonic() - result[0]
+        self.assertEqual(idle_time, 120, "test_idle_time_increases failed: Got %s; Expected: %s" % (idle_time, 120))
+
+    def test_idle_time_frozen_while_held(self):
+        if nodewatcher is None:
+            return
+        idle_since, held_since = nodewatcher._update_idle_since(self.idletime_file, None, None, held=False)
+        self.clock.sleep(100)
+        # e.g. the node is needed to keep the ASG min size or the warm reserve
+        idle_since, held_since = nodewatcher._update_idle_since(self.idletime_file, idle_since, held_since, held=True)
+        self.assertEqual(held_since, self.clock.now, "test_idle_time_frozen_while_held failed: Got %s; Expected: %s"
+                         % (held_since, self.clock.now))
+        self.clock.sleep(300)
+        idle_since, held_since = nodewatcher._update_idle_since(self.idletime_file, idle_since, held_since, held=True)
+        self.assertEqual(held_since, self.clock.now - 300,
+                         "test_idle_time_frozen_while_held failed: Got %s; Expected: %s"
+                         % (held_since, self.clock.now - 300))
+        self.clock.sleep(300)
+        idle_since, held_since = nodewatcher._update_idle_since(self.idletime_file, idle_since, held_since, held=False)
+        idle_time = self.clock.monotonic() - idle_since
+        self.assertEqual((idle_time, held_since), (100, None),
+                         "test_idle_time_frozen_while_held failed: Got %s; Expected: %s"
+                         % ((idle_time, held_since), (100, None)))
+        stored = nodewatcher._load_idle_since(self.idletime_file)
+        self.assertEqual(stored, idle_since, "test_idle_time_frozen_while_held failed: Got %s; Expected: %s"
+                         % (stored, idle_since))
+
+    def test_held_before_idle(self):
+        if nodewatcher is None:
+            return
+        # the node was already held when its last job completed, the idle time starts when it's released
+        idle_since, held_since = nodewatcher._update_idle_since(self.idletime_file, None, None, held=True)
+        self.assertEqual(idle_since, None, "test_held_before_idle failed: Got %s; Expected: None" % idle_since)
+        self.assertFalse(os.path.exists(self.idletime_file), "test_held_before_idle failed: idle time persisted")
+        self.clock.sleep(600)
+        idle_since, held_since = nodewatcher._update_idle_since(self.idletime_file, idle_since, held_since, held=False)
+        self.assertEqual((idle_since, held_since), (self.clock.now, None),
+                         "test_held_before_idle failed: Got %s; Expected: %s"
+                         % ((idle_since, held_since), (self.clock.now, None)))
+
+
+class bootstrap_state_tests(unittest.TestCase):
+    def setUp(self):
+        if nodewatcher is None:
+            return
+        self.directory = tempfile.mkdtemp()
+        self.bootstrap_file = os.path.join(self.directory, 'bootstrap.json')
+
+    def tearDown(self):
+        if nodewatcher is None:
+            return
+        shutil.rmtree(self.directory)
+
+    def test_round_trip(self):
+        if nodewatcher is None:
+            return
+        expected = {'instance_id': 'i-1', 'hostname': 'ip-1', 'asg': 'compute', 'stack_ready': True,
+                    'launch_time': 1000.5}
+        nodewatcher._store_bootstrap_state(self.bootstrap_file, expected)
+        bootstrap = nodewatcher._load_bootstrap_state(self.bootstrap_file)
+        self.assertEqual(bootstrap, expected, "test_round_trip failed: Got %s; Expected: %s" % (bootstrap, expected))
+
+    def test_missing_file(self):
+        if nodewatcher is None:
+            return
+        bootstrap = nodewatcher._load_bootstrap_state(self.bootstrap_file)
+        self.assertEqual(bootstrap, {}, "test_missing_file failed: Got %s; Expected: {}" % bootstrap)
+
+    def test_corrupted_file(self):
+        if nodewatcher is None:
+            return
+        with open(self.bootstrap_file, 'w') as f:
+            f.write('{"instance_id": "i-1", "host')
+        bootstrap = nodewatcher._load_bootstrap_state(self.bootstrap_file)
+        self.assertEqual(bootstrap, {}, "test_corrupted_file failed: Got %s; Expected: {}" % bootstrap)
+
+    def test_incomplete_identity(self):
+        if nodewatcher is None:
+            return
+        with open(self.bootstrap_file, 'w') as f:
+            json.dump({'instance_id': 'i-1', 'asg': 'compute'}, f)
+        bootstrap = nodewatcher._load_bootstrap_state(self.bootstrap_file)
+        self.assertEqual(bootstrap, {}, "test_incomplete_identity failed: Got %s; Expected: {}" % bootstrap)
+
+    def test_store_replaces_previous_state(self):
+        if nodewatcher is None:
+            return
+        nodewatcher._store_bootstrap_state(self.bootstrap_file, {'instance_id': 'i-1', 'hostname': 'ip-1'})
+        expected = {'instance_id': 'i-1', 'hostname': 'ip-1', 'first_job_seen': True}
+        nodewatcher._store_bootstrap_state(self.bootstrap_file, expected)
+        bootstrap = nodewatcher._load_bootstrap_state(self.bootstrap_file)
+        self.assertEqual(bootstrap, expected, "test_store_replaces_previous_state failed: Got %s; Expected: %s"
+                         % (bootstrap, expected))
+        leftovers = sorted(os.listdir(self.directory))
+        expected = ['bootstrap.json']
+        self.assertEqual(leftovers, expected, "test_store_replaces_previous_state failed: Got %s; Expected: %s"
+                         % (leftovers, expected))
+
+    def test_store_failure_is_not_fatal(self):
+        if nodewatcher is None:
+            return
+        bootstrap_file = os.path.join(self.directory, 'missing', 'bootstrap.json')
+        nodewatcher._store_bootstrap_state(bootstrap_file, {'instance_id': 'i-1', 'hostname': 'ip-1'})
+        self.assertFalse(os.path.exists(bootstrap_file), "test_store_failure_is_not_fatal failed: %s written"
+                         % bootstrap_file)
+
+
+class startup_delay_tests(unittest.TestCase):
+    def test_delay_within_interval(self):
+        if nodewatcher is None:
+            return
+        random.seed(0)
+        delays = [nodewatcher._get_startup_delay(60) for _ in range(1000)]
+        self.assertTrue(min(delays) >= 0 and max(delays) <= 60, "test_delay_within_interval failed: Got %s - %s"
+                        % (min(delays), max(delays)))
+
+    def test_delays_spread(self):
+        if nodewatcher is None:
+            return
+        random.seed(0)
+        delays = [nodewatcher._get_startup_delay(60) for _ in range(1000)]
+        # nodes started together must not all query the scheduler in the same second
+        buckets = len(set(int(delay) for delay in delays))
+        self.assertEqual(buckets, 60, "test_delays_spread failed: Got %s; Expected: %s" % (buckets, 60))
+
+    def test_no_interval(self):
+        if nodewatcher is None:
+            return
+        delay = nodewatcher._get_startup_delay(0)
+        self.assertEqual(delay, 0, "test_no_interval failed: Got %s; Expected: %s" % (delay, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
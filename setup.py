@@ -24,7 +24,9 @@ def read(fname):
 
 console_scripts = ['sqswatcher = sqswatcher.sqswatcher:main',
                    'nodewatcher = nodewatcher.nodewatcher:main',
-                   'jobwatcher = jobwatcher.jobwatcher:main']
+                   'jobwatcher = jobwatcher.jobwatcher:main',
+                   'jobwatcher-notify = jobwatcher.trigger:main',
+                   'scaling-latency-report = common.latency:main']
 version = "2.2.1"
 requires = ['boto3>=1.7.55', 'python-dateutil>=2.6.1']
 
@@ -0,0 +1,204 @@
+# Copyright 2013-2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You may not use this file except in compliance with the
+# License. A copy of the License is located at
+#
+# http://aws.amazon.com/apache2.0/
+#
+# or in the "LICENSE.txt" file accompanying this file. This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+# OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Journal of the host operations performed by sqswatcher.
+
+Every completed step of an event (e.g. hostname resolved, host added to the scheduler, item stored in DynamoDB) is
+appended to a JSON lines file and synced to disk before moving to the next step. When a message is delivered again,
+after a crash or because SQS delivered it twice, completed events are skipped and partially applied ones resume from
+the first step not yet recorded.
+
+A crash between a step and its record replays the step, so the scheduler plugins must accept adding a host already
+added and removing a host already removed.
+
+The journal is enabled with the journal_file option of sqswatcher.
+"""
+
+import errno
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+DONE = 'done'
+
+
+class EventJournal(object):
+    """Append-only, thread safe journal of the steps completed for each event, compacted periodically."""
+
+    def __init__(self, path, retention=4 * 24 * 60 * 60, compact_every=1000):
+        """
+        :param path: path of the journal file
+        :param retention: how long events are remembered to detect duplicates, in seconds
+        :param compact_every: number of appended records triggering a compaction
+        """
+        self.path = path
+        self.retention = retention
+        self.compact_every = compact_every
+        self._lock = threading.Lock()
+        self._events = {}
+        self._in_progress = set()
+        self._appended = 0
+        # records appended while a compaction is writing the new file, None if no compaction is running
+        self._pending = None
+        self._load()
+        self._file = open(self.path, 'a')
+
+    def _load(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        self._apply(json.loads(line))
+                    except ValueError:
+                        # record truncated by a crash
+                        log.warning("Skipping invalid journal record %s" % line.strip())
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        log.info("Loaded %d events from journal %s" % (len(self._events), self.path))
+        self.compact()
+
+    def _apply(self, record):
+        event = self._events.setdefault(record['event'], {'timestamp': record['timestamp'], 'steps': {}})
+        event['steps'][record['step']] = record.get('data')
+        event['timestamp'] = record['timestamp']
+
+    def start(self, event_id):
+        """
+        Claim the event for the calling thread.
+
+        :param event_id: the event identifier
+        :return: False if the event is completed or being processed by another thread
+        """
+        with self._lock:
+            if event_id in self._in_progress:
+                return False
+            event = self._events.get(event_id)
+            if event and DONE in event['steps']:
+                return False
+            self._in_progress.add(event_id)
+            return True
+
+    def finish(self, event_id):
+        """
+        Release the event claimed with start, whether it is completed or not.
+
+        :param event_id: the event identifier
+        """
+        with self._lock:
+            self._in_progress.discard(event_id)
+
+    def is_done(self, event_id):
+        """
+        :param event_id: the event identifier
+        :return: True if all the steps of the event have been completed
+        """
+        return DONE in self.get_steps(event_id)
+
+    def get_steps(self, event_id):
+        """
+        :param event_id: the event identifier
+        :return: dictionary step -> data of the steps completed for the event
+        """
+        with self._lock:
+            event = self._events.get(event_id)
+            return dict(event['steps']) if event else {}
+
+    def record(self, event_id, step, data=None):
+        """
+        Durably record the completion of a step.
+
+        :param event_id: the event identifier
+        :param step: name of the completed step, DONE when the whole event has been handled
+        :param data: optional JSON serializable data needed to resume the following steps
+        """
+        record = {'event': event_id, 'step': step, 'timestamp': time.time()}
+        if data is not None:
+            record['data'] = data
+        line = json.dumps(record) + '\n'
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._apply(record)
+            self._appended += 1
+            if self._pending is not None:
+                self._pending.append(line)
+            compact = self._appended >= self.compact_every and self._pending is None
+            if compact:
+                self._pending = []
+        if compact:
+            self._compact()
+
+    def compact(self):
+        """Rewrite the journal, dropping the events not updated in the last retention seconds."""
+        with self._lock:
+            if self._pending is not None:
+                # already running in another thread
+                return
+            self._pending = []
+        self._compact()
+
+    def _compact(self):
+        # the new file is written without holding the lock, the records appended in the meantime are copied to it
+        # before it replaces the journal
+        tmp_path = None
+        try:
+            with self._lock:
+                # events left incomplete that long are not going to be delivered again
+                expiration = time.time() - self.retention
+                for event_id, event in list(self._events.items()):
+                    if event['timestamp'] < expiration and event_id not in self._in_progress:
+                        del self._events[event_id]
+
+                records = []
+                for event_id, event in self._events.items():
+                    for step, data in event['steps'].items():
+                        records.append((event_id, step, event['timestamp'], data))
+
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path) or '.')
+            with os.fdopen(fd, 'w') as new_file:
+                for event_id, step, timestamp, data in records:
+                    record = {'event': event_id, 'step': step, 'timestamp': timestamp}
+                    if data is not None:
+                        record['data'] = data
+                    new_file.write(json.dumps(record) + '\n')
+                with self._lock:
+                    new_file.writelines(self._pending)
+                    new_file.flush()
+                    os.fsync(new_file.fileno())
+                    os.rename(tmp_path, self.path)
+                    if getattr(self, '_file', None):
+                        self._file.close()
+                        self._file = open(self.path, 'a')
+                    self._appended = len(self._pending)
+                    # from here on another compaction may start, its pending records must not be touched
+                    self._pending = None
+        except:
+            if tmp_path and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            with self._lock:
+                self._pending = None
+            raise
+        log.debug("Compacted journal %s to %d events" % (self.path, len(records)))
+
+    def close(self):
+        with self._lock:
+            self._file.close()
@@ -0,0 +1,201 @@
+# Copyright 2013-2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You may not use this file except in compliance with the
+# License. A copy of the License is located at
+#
+# http://aws.amazon.com/apache2.0/
+#
+# or in the "LICENSE.txt" file accompanying this file. This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+# OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+known_hosts bookkeeping for the compute nodes bootstrapped by sqswatcher.
+
+The host keys are indexed in memory: adding a node appends a single line to the file, under an exclusive lock, and the
+lines of the removed nodes are pruned in batches by rewriting the file, instead of parsing and rewriting the whole
+file for every node. Only the lines of the removed hosts and the keys replaced by sqswatcher are pruned, the lines
+written by other tools (e.g. ssh-keyscan) are kept.
+"""
+
+import errno
+import fcntl
+import logging
+import os
+import tempfile
+import threading
+
+log = logging.getLogger(__name__)
+
+_managers = {}
+_managers_lock = threading.Lock()
+
+
+def get_known_hosts_manager(cluster_user):
+    """
+    Get the manager of the known_hosts file of the given user, shared by all the threads.
+
+    :param cluster_user: the cluster user
+    :return: the KnownHostsManager
+    """
+    with _managers_lock:
+        if cluster_user not in _managers:
+            path = os.path.expanduser("~" + cluster_user) + '/.ssh/known_hosts'
+            _managers[cluster_user] = KnownHostsManager(path)
+        return _managers[cluster_user]
+
+
+class KnownHostsManager(object):
+    """Thread safe, indexed known_hosts file."""
+
+    def __init__(self, path, prune_batch_size=20):
+        """
+        :param path: path of the known_hosts file
+        :param prune_batch_size: number of removed hosts triggering the rewrite of the file
+        """
+        self.path = path
+        self.prune_batch_size = prune_batch_size
+        self._lock = threading.Lock()
+        # (host, key type) -> known_hosts line of the last key of that type
+        self._entries = None
+        # hosts whose keys have been added by sqswatcher
+        self._managed = set()
+        self._removed = set()
+        # lines of the managed hosts replaced by a new key of the same type
+        self._superseded = 0
+
+    def _load(self):
+        if self._entries is not None:
+            return
+        self._entries = {}
+        try:
+            with open(self.path) as known_hosts:
+                for line in known_hosts:
+                    self._index(line)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        log.info("Loaded %d host keys from %s" % (len(self._entries), self.path))
+
+    def _index(self, line):
+        key = self._get_key(line)
+        if key:
+            self._entries[key] = line if line.endswith('\n') else line + '\n'
+
+    @staticmethod
+    def _get_key(line):
+        # comments and marked lines (@cert-authority, @revoked) are not indexed
+        fields = line.split()
+        if len(fields) >= 3 and not line.startswith('#') and not line.startswith('@'):
+            return fields[0], fields[1]
+        return None
+
+    def add(self, hostname, key):
+        """
+        Store the host key of the given host, appending it to the file if it is new.
+
+        :param hostname: the host name, as used to connect to the host
+        :param key: the paramiko PKey of the host
+        """
+        line = '%s %s %s\n' % (hostname, key.get_name(), key.get_base64())
+        entry_key = (hostname, key.get_name())
+        with self._lock:
+            self._load()
+            self._removed.discard(hostname)
+            self._managed.add(hostname)
+            previous = self._entries.get(entry_key)
+            if previous == line:
+                return
+            created = not os.path.exists(self.path)
+            with open(self.path, 'a') as known_hosts:
+                fcntl.flock(known_hosts, fcntl.LOCK_EX)
+                try:
+                    known_hosts.write(line)
+                    known_hosts.flush()
+                finally:
+                    fcntl.flock(known_hosts, fcntl.LOCK_UN)
+            if created:
+                self._copy_owner(os.path.dirname(self.path), self.path, 0o644)
+            # a previous key of the same type is superseded and dropped by the next compaction
+            self._entries[entry_key] = line
+            if previous:
+                self._superseded += 1
+
+    def remove(self, hostname):
+        """
+        Forget the host key of the given host, the file is rewritten once enough hosts have been removed.
+
+        :param hostname: the host name, as used to connect to the host
+        """
+        with self._lock:
+            self._load()
+            entry_keys = [entry_key for entry_key in self._entries if entry_key[0] == hostname]
+            if not entry_keys:
+                return
+            for entry_key in entry_keys:
+                del self._entries[entry_key]
+            self._removed.add(hostname)
+            # also compact when superseded keys make up most of the file
+            if (len(self._removed) >= self.prune_batch_size or
+                    self._superseded > len(self._entries) + self.prune_batch_size):
+                self._compact()
+
+    def compact(self):
+        """Rewrite the file, dropping the keys of the removed hosts and the superseded keys."""
+        with self._lock:
+            self._load()
+            self._compact()
+
+    def _compact(self):
+        if not os.path.exists(self.path):
+            self._removed.clear()
+            self._superseded = 0
+            return
+
+        with open(self.path, 'r') as known_hosts:
+            fcntl.flock(known_hosts, fcntl.LOCK_EX)
+            try:
+                kept = []
+                seen = set()
+                # lines appended by other processes since the last load are preserved
+                for line in known_hosts:
+                    entry_key = self._get_key(line)
+                    if entry_key:
+                        host = entry_key[0]
+                        if host in self._removed:
+                            continue
+                        if host in self._managed and entry_key in self._entries:
+                            # superseded by the last key of the same type
+                            if self._entries[entry_key] != line or entry_key in seen:
+                                continue
+                            seen.add(entry_key)
+                    kept.append(line)
+
+                fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path))
+                try:
+                    with os.fdopen(fd, 'w') as new_known_hosts:
+                        new_known_hosts.writelines(kept)
+                        new_known_hosts.flush()
+                        os.fsync(new_known_hosts.fileno())
+                    self._copy_owner(self.path, tmp_path)
+                    os.rename(tmp_path, self.path)
+                except:
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
+                    raise
+            finally:
+                fcntl.flock(known_hosts, fcntl.LOCK_UN)
+
+        log.info("Pruned %d hosts from %s" % (len(self._removed), self.path))
+        self._removed.clear()
+        self._superseded = 0
+        self._entries = {}
+        for line in kept:
+            self._index(line)
+
+    @staticmethod
+    def _copy_owner(reference, path, mode=None):
+        # sqswatcher runs as root, the file belongs to the cluster user
+        st = os.stat(reference)
+        os.chown(path, st.st_uid, st.st_gid)
+        os.chmod(path, mode if mode is not None else st.st_mode & 0o777)
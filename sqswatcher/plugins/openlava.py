@@ -17,6 +17,9 @@ import paramiko
 import logging
 import shlex
 
+from common.scheduler_commands import check_command
+from sqswatcher.known_hosts import get_known_hosts_manager
+
 log = logging.getLogger(__name__)
 
 def __runOpenlavaCommand(command):
@@ -24,7 +27,7 @@ def __runOpenlavaCommand(command):
     _command = shlex.split(str(command))
     log.debug(_command)
     try:
-        sub.check_call(_command, env=dict(os.environ, LSF_ENVDIR='/opt/openlava/etc'))
+        check_command(_command, env=dict(os.environ, LSF_ENVDIR='/opt/openlava/etc'))
     except sub.CalledProcessError:
         log.error("Failed to run %s\n" % _command)
 
@@ -39,7 +42,6 @@ def addHost(hostname, cluster_user, slots):
     # Connect and hostkey
     ssh = paramiko.SSHClient()
     ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    hosts_key_file = os.path.expanduser("~" + cluster_user) + '/.ssh/known_hosts'
     user_key_file = os.path.expanduser("~" + cluster_user) + '/.ssh/id_rsa'
     iter=0
     connected=False
@@ -55,17 +57,14 @@ def addHost(hostname, cluster_user, slots):
             if iter == 3:
                log.critical("Unable to provison host")
                return
-    try:
-        ssh.load_host_keys(hosts_key_file)
-    except IOError:
-        ssh._host_keys_filename = None
-        pass
-    ssh.save_host_keys(hosts_key_file)
+    get_known_hosts_manager(cluster_user).add(hostname, ssh.get_transport().get_remote_server_key())
     ssh.close()
 
 def removeHost(hostname,cluster_user):
     log.info('Removing %s', hostname)
 
+    get_known_hosts_manager(cluster_user).remove(hostname)
+
     command = ('/opt/openlava/bin/lsrmhost %s' % hostname)
 
     __runOpenlavaCommand(command)
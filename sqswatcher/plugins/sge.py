@@ -17,6 +17,9 @@ import os
 import socket
 import logging
 import shlex
+
+from common.scheduler_commands import check_command, run_command
+from sqswatcher.known_hosts import get_known_hosts_manager
 from sqswatcher.sqswatcher import HostRemovalError
 from sqswatcher.sqswatcher import QueryConfigError
 
@@ -29,15 +32,14 @@ def _is_host_configured(command, hostname):
     host_configured = False
 
     try:
-        output = sub.Popen(
+        output = run_command(
             _command,
-            stdout=sub.PIPE,
             env=dict(
                 os.environ,
                 SGE_ROOT='/opt/sge',
                 PATH='/opt/sge/bin:/opt/sge/bin/lx-amd64:/bin:/usr/bin',
             ),
-        ).communicate()[0]
+        )
     except:
         log.error("Failed to run %s\n" % command)
         raise QueryConfigError
@@ -59,7 +61,7 @@ def _run_sge_command(command, raise_exception=False):
     log.debug(_command)
 
     try:
-        sub.check_call(_command, env=dict(os.environ, SGE_ROOT='/opt/sge'))
+        check_command(_command, env=dict(os.environ, SGE_ROOT='/opt/sge'))
     except sub.CalledProcessError:
         log.error("Failed to run %s\n" % _command)
         if raise_exception:
@@ -102,7 +104,6 @@ report_variables      NONE
     # Connect and start SGE
     ssh = paramiko.SSHClient()
     ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    hosts_key_file = os.path.expanduser("~" + cluster_user) + '/.ssh/known_hosts'
     user_key_file = os.path.expanduser("~" + cluster_user) + '/.ssh/id_rsa'
     iter=0
     connected=False
@@ -118,12 +119,7 @@ report_variables      NONE
             if iter == 3:
                log.critical("Unable to provison host")
                return
-    try:
-        ssh.load_host_keys(hosts_key_file)
-    except IOError:
-        ssh._host_keys_filename = None
-        pass
-    ssh.save_host_keys(hosts_key_file)
+    get_known_hosts_manager(cluster_user).add(hostname, ssh.get_transport().get_remote_server_key())
     command = "sudo sh -c \'cd /opt/sge && /opt/sge/inst_sge -noremote -x -auto /opt/parallelcluster/templates/sge/sge_inst.conf\'"
     stdin, stdout, stderr = ssh.exec_command(command)
     while not stdout.channel.exit_status_ready():
@@ -142,6 +138,8 @@ report_variables      NONE
 def removeHost(hostname, cluster_user):
     log.info('Removing %s', hostname)
 
+    get_known_hosts_manager(cluster_user).remove(hostname)
+
     # Check if host is administrative host
     command = "/opt/sge/bin/lx-amd64/qconf -sh"
     if _is_host_configured(command, hostname):
@@ -19,24 +19,73 @@ import socket
 import time
 import logging
 import re
+import threading
+import json
+
+from common.scheduler_commands import check_command, run_command
+from common.utils import atomic_write
+from sqswatcher.known_hosts import get_known_hosts_manager
 
 log = logging.getLogger(__name__)
 
+slurm_conf = '/opt/slurm/etc/slurm.conf'
+# nodes of the pre-provisioned pool bound to an instance, node name -> hostname
+node_map_file = '/var/lib/sqswatcher/slurm_nodes.json'
+
+# addHost and removeHost can be called concurrently, only the slurm.conf updates need locking
+thread_safe = True
+_config_lock = threading.Lock()
+_node_pool = None
+
+
+class NodePoolExhaustedError(Exception):
+    pass
+
+
+class SlurmdStartError(Exception):
+    pass
+
 
 def __runCommand(command):
     _command = command
     log.debug(repr(command))
     try:
-        sub.check_call(_command, env=dict(os.environ))
+        check_command(_command, env=dict(os.environ))
     except sub.CalledProcessError:
         log.error("Failed to run %s\n" % _command)
 
 
-def __restartSlurm(hostname, cluster_user):
-    # Connect and restart Slurm on compute node
+def __getRestartCommand(node_name=None):
+    command = 'if [ -f /etc/systemd/system/slurmd.service ]; then sudo systemctl restart slurmd.service; else sudo sh -c \"/etc/init.d/slurm restart 2>&1 > /tmp/slurmdstart.log\"; fi'
+    if not node_name:
+        return command
+
+    # Nodes of the pool must start slurmd with their node name. The options are read from /etc/sysconfig/slurmd
+    # (RHEL, CentOS, Amazon Linux) or /etc/default/slurmd (Ubuntu) by the slurmd unit, which a drop-in points to the
+    # right file, and from /etc/sysconfig/slurm or /etc/default/slurm by the init script. slurmd is not restarted if
+    # the options can't be written.
+    options = 'SLURMD_OPTIONS=\\"-N %s\\"' % node_name
+    return (
+        'set -e; '
+        'if [ -d /etc/sysconfig ]; then defaults_dir=/etc/sysconfig; else defaults_dir=/etc/default; fi; '
+        'if [ -f /etc/systemd/system/slurmd.service ]; then '
+        'echo "%s" | sudo tee $defaults_dir/slurmd > /dev/null; '
+        'sudo mkdir -p /etc/systemd/system/slurmd.service.d; '
+        'printf "[Service]\\nEnvironmentFile=-$defaults_dir/slurmd\\n" '
+        '| sudo tee /etc/systemd/system/slurmd.service.d/node-name.conf > /dev/null; '
+        'sudo systemctl daemon-reload; '
+        'sudo systemctl restart slurmd.service; '
+        'else '
+        'echo "%s" | sudo tee $defaults_dir/slurm > /dev/null; '
+        'sudo sh -c "/etc/init.d/slurm restart 2>&1 > /tmp/slurmdstart.log"; '
+        'fi' % (options, options)
+    )
+
+
+def __restartSlurm(hostname, cluster_user, node_name=None):
+    # Connect and restart Slurm on compute node, return True if slurmd has been restarted
     ssh = paramiko.SSHClient()
     ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    hosts_key_file = os.path.expanduser("~" + cluster_user) + '/.ssh/known_hosts'
     user_key_file = os.path.expanduser("~" + cluster_user) + '/.ssh/id_rsa'
     iter=0
     connected=False
@@ -45,36 +94,36 @@ def __restartSlurm(hostname, cluster_user):
             log.info('Connecting to host: %s iter: %d' % (hostname, iter))
             ssh.connect(hostname, username=cluster_user, key_filename=user_key_file)
             connected = True
-        except socket.error, e:
+        except socket.error as e:
             log.error('Socket error: %s' % e)
             time.sleep(10 + iter)
             iter = iter + 1
             if iter == 3:
                 log.critical("Unable to connect to host")
-                return
-    try:
-        ssh.load_host_keys(hosts_key_file)
-    except IOError:
-        ssh._host_keys_filename = None
-        pass
-    ssh.save_host_keys(hosts_key_file)
-    command = 'if [ -f /etc/systemd/system/slurmd.service ]; then sudo systemctl restart slurmd.service; else sudo sh -c \"/etc/init.d/slurm restart 2>&1 > /tmp/slurmdstart.log\"; fi'
+                return False
+    get_known_hosts_manager(cluster_user).add(hostname, ssh.get_transport().get_remote_server_key())
+    command = __getRestartCommand(node_name)
 
     stdin, stdout, stderr = ssh.exec_command(command)
     while not stdout.channel.exit_status_ready():
         time.sleep(1)
+    exit_status = stdout.channel.recv_exit_status()
     ssh.close()
+    if exit_status != 0:
+        log.error('Failed to restart slurmd on %s with exit status %d' % (hostname, exit_status))
+        return False
+    return True
 
 
 def __readNodeList():
-    _config = "/opt/slurm/etc/slurm.conf"
+    _config = slurm_conf
     nodes = {}
     with open(_config) as slurm_config:
         for line in slurm_config:
             if line.startswith('#PARTITION'):
                 partition = line.split(':')[1].rstrip()
-                dummy_node = slurm_config.next()
-                node_name = slurm_config.next()
+                dummy_node = next(slurm_config)
+                node_name = next(slurm_config)
                 items = node_name.split(' ')
                 node_line = items[0].split('=')
                 if len(node_line[1]) > 0:
@@ -85,7 +134,7 @@ def __readNodeList():
 
 
 def __writeNodeList(node_list, slots=0):
-    _config = "/opt/slurm/etc/slurm.conf"
+    _config = slurm_conf
     fh, abs_path = mkstemp()
     with open(abs_path,'w') as new_file:
         with open(_config) as slurm_config:
@@ -98,11 +147,11 @@ def __writeNodeList(node_list, slots=0):
                     # PartitionName=compute Nodes=dummy-compute,ip-172-31-6-43,ip-172-31-7-230 Default=YES MaxTime=INFINITE State=UP
                     partition_name = line.split(':')[1].rstrip()
                     new_file.write(line)
-                    dummy_node_line = slurm_config.next()
+                    dummy_node_line = next(slurm_config)
                     new_file.write(dummy_node_line)
                     dummy_nodes = re.search('NodeName=(dummy.*) Procs.* State.*', dummy_node_line).group(1)
-                    node_names_line = slurm_config.next()
-                    partitions_line = slurm_config.next()
+                    node_names_line = next(slurm_config)
+                    partitions_line = next(slurm_config)
                     node_names_line_items = node_names_line.split(' ')
                     if slots == 0:
                         slots = node_names_line_items[1].split('=')[1].strip()
@@ -120,45 +169,145 @@ def __writeNodeList(node_list, slots=0):
     # Move new file
     move(abs_path, _config)
     # Update permissions on new file
-    os.chmod(_config, 0744)
+    os.chmod(_config, 0o744)
+
+
+def __readNodePool():
+    # The pool is declared once in slurm.conf and never rewritten
+    # #NODEPOOL:compute
+    # NodeName=compute-[1-200] CPUs=4 State=CLOUD
+    # PartitionName=compute Nodes=compute-[1-200] Default=YES MaxTime=INFINITE State=UP
+    global _node_pool
+    if _node_pool is None:
+        node_pool = []
+        with open(slurm_conf) as slurm_config:
+            for line in slurm_config:
+                if line.startswith('#NODEPOOL'):
+                    node_names = next(slurm_config).split(' ')[0].split('=')[1]
+                    output = run_command(['/opt/slurm/bin/scontrol', 'show', 'hostnames', node_names])
+                    node_pool.extend(output.split())
+        _node_pool = node_pool
+        if _node_pool:
+            log.info('Binding instances to a pool of %d Slurm nodes' % len(_node_pool))
+    return _node_pool
+
+
+def __readNodeMap():
+    try:
+        with open(node_map_file) as node_map:
+            return json.load(node_map)
+    except IOError:
+        return {}
+
+
+def __writeNodeMap(node_map):
+    node_map_dir = os.path.dirname(node_map_file)
+    if not os.path.isdir(node_map_dir):
+        os.makedirs(node_map_dir)
+    atomic_write(node_map_file, json.dumps(node_map))
+
+
+def __addPoolHost(hostname, cluster_user, node_pool):
+    with _config_lock:
+        node_map = __readNodeMap()
+        # the same host may be added again when an event is redelivered
+        bound = [node_name for node_name, node_hostname in node_map.items() if node_hostname == hostname]
+        if bound:
+            node_name = bound[0]
+        else:
+            free = [node_name for node_name in node_pool if node_name not in node_map]
+            if not free:
+                # not added, the event is retried once a node of the pool is released
+                raise NodePoolExhaustedError('No free node left in the Slurm node pool for %s' % hostname)
+            node_name = free[0]
+            node_map[node_name] = hostname
+            __writeNodeMap(node_map)
+
+    log.info('Binding %s to Slurm node %s' % (hostname, node_name))
+    command = ['/opt/slurm/bin/scontrol', 'update', 'NodeName=%s' % node_name, 'NodeAddr=%s' % hostname,
+               'NodeHostname=%s' % hostname, 'State=RESUME']
+    __runCommand(command)
+
+    # Start slurmd on host with the node name
+    if not __restartSlurm(hostname, cluster_user, node_name):
+        # the node can't join with its name, release it and retry the event later
+        __releasePoolNodes(hostname, 'sqswatcher: slurmd not started')
+        raise SlurmdStartError('Unable to start slurmd on %s as Slurm node %s' % (hostname, node_name))
+
+
+def __releasePoolNodes(hostname, reason):
+    with _config_lock:
+        node_map = __readNodeMap()
+        bound = [node_name for node_name, node_hostname in node_map.items() if node_hostname == hostname]
+        if not bound:
+            log.warning('Host %s is not bound to any Slurm node' % hostname)
+            return
+        for node_name in bound:
+            log.info('Releasing Slurm node %s bound to %s' % (node_name, hostname))
+            command = ['/opt/slurm/bin/scontrol', 'update', 'NodeName=%s' % node_name, 'State=DOWN',
+                       'Reason=%s' % reason]
+            __runCommand(command)
+            del node_map[node_name]
+        __writeNodeMap(node_map)
 
 
 def addHost(hostname, cluster_user, slots):
     log.info('Adding %s with %s slots' % (hostname, slots))
 
-    # Get the current node list
-    node_list = __readNodeList()
+    node_pool = __readNodePool()
+    if node_pool:
+        # No slurm.conf change, slurmctld is not restarted
+        __addPoolHost(hostname, cluster_user, node_pool)
+        return
+
+    with _config_lock:
+        # Get the current node list
+        node_list = __readNodeList()
 
-    # Add new node
-    node_list['compute'].append(hostname)
-    __writeNodeList(node_list, slots)
+        # Add new node, the same host may be added again when an event is redelivered
+        if hostname in node_list['compute']:
+            log.info('Host %s is already in the node list' % hostname)
+        else:
+            node_list['compute'].append(hostname)
+            __writeNodeList(node_list, slots)
 
-    # Restart slurmctl locally
-    restartMasterNodeSlurm()
+            # Restart slurmctl locally
+            restartMasterNodeSlurm()
 
     # Restart slurmctl on host
     __restartSlurm(hostname, cluster_user)
 
-    # Reconfifure Slurm, prompts all compute nodes to reread slurm.conf
-    command = ['/opt/slurm/bin/scontrol', 'reconfigure']
-    __runCommand(command)
+    with _config_lock:
+        # Reconfifure Slurm, prompts all compute nodes to reread slurm.conf
+        command = ['/opt/slurm/bin/scontrol', 'reconfigure']
+        __runCommand(command)
 
 def removeHost(hostname, cluster_user):
     log.info('Removing %s', hostname)
 
-    # Get the current node list
-    node_list = __readNodeList()
+    get_known_hosts_manager(cluster_user).remove(hostname)
 
-    # Remove node
-    node_list['compute'].remove(hostname)
-    __writeNodeList(node_list)
+    if __readNodePool():
+        __releasePoolNodes(hostname, 'sqswatcher: instance terminated')
+        return
 
-    # Restart slurmctl
-    restartMasterNodeSlurm()
+    with _config_lock:
+        # Get the current node list
+        node_list = __readNodeList()
 
-    # Reconfifure Slurm, prompts all compute nodes to reread slurm.conf
-    command = ['/opt/slurm/bin/scontrol', 'reconfigure']
-    __runCommand(command)
+        # Remove node, the host may already be removed when an event is redelivered
+        if hostname not in node_list['compute']:
+            log.warning('Host %s is not in the node list' % hostname)
+            return
+        node_list['compute'].remove(hostname)
+        __writeNodeList(node_list)
+
+        # Restart slurmctl
+        restartMasterNodeSlurm()
+
+        # Reconfifure Slurm, prompts all compute nodes to reread slurm.conf
+        command = ['/opt/slurm/bin/scontrol', 'reconfigure']
+        __runCommand(command)
 
 
 def restartMasterNodeSlurm():
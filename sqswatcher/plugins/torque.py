@@ -11,7 +11,6 @@
 
 __author__ = 'dougalb'
 
-import subprocess as sub
 import os
 import paramiko
 import logging
@@ -20,6 +19,9 @@ import time
 import xml.etree.ElementTree as xmltree
 import socket
 
+from common.scheduler_commands import executor
+from sqswatcher.known_hosts import get_known_hosts_manager
+
 log = logging.getLogger(__name__)
 
 def __runCommand(command):
@@ -27,16 +29,10 @@ def __runCommand(command):
     _command = shlex.split(str(command))
     log.debug(_command)
 
-    DEV_NULL = open(os.devnull, "rb")
-    try:
-        process = sub.Popen(_command, env=dict(os.environ), stdout=sub.PIPE, stderr=sub.STDOUT, stdin=DEV_NULL)
-        stdout = process.communicate()[0]
-        exitcode = process.poll()
-        if exitcode != 0:
-            log.error("Failed to run %s:\n%s" % (_command, stdout))
-        return stdout
-    finally:
-        DEV_NULL.close()
+    result = executor.run(_command, env=dict(os.environ), merge_stderr=True)
+    if result.returncode != 0:
+        log.error("Failed to run %s:\n%s" % (_command, result.output))
+    return result.output
 
 
 def isHostInitState(host_state):
@@ -91,7 +87,6 @@ def addHost(hostname,cluster_user,slots):
     # Connect and hostkey
     ssh = paramiko.SSHClient()
     ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    hosts_key_file = os.path.expanduser("~" + cluster_user) + '/.ssh/known_hosts'
     user_key_file = os.path.expanduser("~" + cluster_user) + '/.ssh/id_rsa'
     iter=0
     connected=False
@@ -107,12 +102,7 @@ def addHost(hostname,cluster_user,slots):
             if iter == 3:
                log.info("Unable to provison host")
                return
-    try:
-        ssh.load_host_keys(hosts_key_file)
-    except IOError:
-        ssh._host_keys_filename = None
-        pass
-    ssh.save_host_keys(hosts_key_file)
+    get_known_hosts_manager(cluster_user).add(hostname, ssh.get_transport().get_remote_server_key())
     ssh.close()
 
     wakeupSchedOn(hostname)
@@ -120,6 +110,8 @@ def addHost(hostname,cluster_user,slots):
 def removeHost(hostname, cluster_user):
     log.info('Removing %s', hostname)
 
+    get_known_hosts_manager(cluster_user).remove(hostname)
+
     command = ('/opt/torque/bin/pbsnodes -o %s' % hostname)
     __runCommand(command)
 
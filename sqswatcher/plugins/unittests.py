@@ -0,0 +1,139 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from sqswatcher import known_hosts
+
+try:
+    import slurm
+except ImportError:
+    # paramiko or boto3 not installed
+    slurm = None
+
+
+class slurm_node_pool_tests(unittest.TestCase):
+    def setUp(self):
+        if slurm is None:
+            return
+        self.directory = tempfile.mkdtemp()
+        self.saved = dict((name, getattr(slurm, name))
+                          for name in ['node_map_file', '_node_pool', '__runCommand', '__restartSlurm'])
+        slurm.node_map_file = os.path.join(self.directory, 'slurm_nodes.json')
+        slurm._node_pool = ['compute-1', 'compute-2']
+        self.commands = []
+        self.restarts = []
+        self.slurmd_started = True
+        setattr(slurm, '__runCommand', self.commands.append)
+        setattr(slurm, '__restartSlurm', self._restart_slurm)
+        known_hosts._managers['centos'] = known_hosts.KnownHostsManager(os.path.join(self.directory, 'known_hosts'))
+
+    def tearDown(self):
+        if slurm is None:
+            return
+        for name, value in self.saved.items():
+            setattr(slurm, name, value)
+        del known_hosts._managers['centos']
+        shutil.rmtree(self.directory)
+
+    def _restart_slurm(self, hostname, cluster_user, node_name=None):
+        self.restarts.append((hostname, node_name))
+        return self.slurmd_started
+
+    def _node_map(self):
+        with open(slurm.node_map_file) as node_map:
+            return json.load(node_map)
+
+    def test_free_node_bound(self):
+        if slurm is None:
+            return
+        slurm.addHost('ip-1', 'centos', 4)
+        node_map = self._node_map()
+        expected = {'compute-1': 'ip-1'}
+        self.assertEqual(node_map, expected, "test_free_node_bound failed: Got %s; Expected: %s"
+                         % (node_map, expected))
+        expected = [['/opt/slurm/bin/scontrol', 'update', 'NodeName=compute-1', 'NodeAddr=ip-1',
+                     'NodeHostname=ip-1', 'State=RESUME']]
+        self.assertEqual(self.commands, expected, "test_free_node_bound failed: Got %s; Expected: %s"
+                         % (self.commands, expected))
+        expected = [('ip-1', 'compute-1')]
+        self.assertEqual(self.restarts, expected, "test_free_node_bound failed: Got %s; Expected: %s"
+                         % (self.restarts, expected))
+
+    def test_redelivered_host_keeps_its_node(self):
+        if slurm is None:
+            return
+        slurm.addHost('ip-1', 'centos', 4)
+        slurm.addHost('ip-1', 'centos', 4)
+        node_map = self._node_map()
+        expected = {'compute-1': 'ip-1'}
+        self.assertEqual(node_map, expected, "test_redelivered_host_keeps_its_node failed: Got %s; Expected: %s"
+                         % (node_map, expected))
+        expected = [('ip-1', 'compute-1'), ('ip-1', 'compute-1')]
+        self.assertEqual(self.restarts, expected, "test_redelivered_host_keeps_its_node failed: Got %s; Expected: %s"
+                         % (self.restarts, expected))
+
+    def test_removed_host_releases_its_node(self):
+        if slurm is None:
+            return
+        slurm.addHost('ip-1', 'centos', 4)
+        slurm.addHost('ip-2', 'centos', 4)
+        slurm.removeHost('ip-1', 'centos')
+        expected = ['/opt/slurm/bin/scontrol', 'update', 'NodeName=compute-1', 'State=DOWN',
+                    'Reason=sqswatcher: instance terminated']
+        self.assertEqual(self.commands[-1], expected, "test_removed_host_releases_its_node failed: Got %s; "
+                         "Expected: %s" % (self.commands[-1], expected))
+        slurm.addHost('ip-3', 'centos', 4)
+        node_map = self._node_map()
+        expected = {'compute-1': 'ip-3', 'compute-2': 'ip-2'}
+        self.assertEqual(node_map, expected, "test_removed_host_releases_its_node failed: Got %s; Expected: %s"
+                         % (node_map, expected))
+
+    def test_removed_unknown_host(self):
+        if slurm is None:
+            return
+        slurm.addHost('ip-1', 'centos', 4)
+        slurm.removeHost('ip-2', 'centos')
+        node_map = self._node_map()
+        expected = {'compute-1': 'ip-1'}
+        self.assertEqual(node_map, expected, "test_removed_unknown_host failed: Got %s; Expected: %s"
+                         % (node_map, expected))
+
+    def test_exhausted_pool(self):
+        if slurm is None:
+            return
+        slurm.addHost('ip-1', 'centos', 4)
+        slurm.addHost('ip-2', 'centos', 4)
+        self.assertRaises(slurm.NodePoolExhaustedError, slurm.addHost, 'ip-3', 'centos', 4)
+        node_map = self._node_map()
+        expected = {'compute-1': 'ip-1', 'compute-2': 'ip-2'}
+        self.assertEqual(node_map, expected, "test_exhausted_pool failed: Got %s; Expected: %s"
+                         % (node_map, expected))
+        self.assertEqual(len(self.restarts), 2, "test_exhausted_pool failed: Got %s" % self.restarts)
+
+    def test_node_released_when_slurmd_not_started(self):
+        if slurm is None:
+            return
+        self.slurmd_started = False
+        self.assertRaises(slurm.SlurmdStartError, slurm.addHost, 'ip-1', 'centos', 4)
+        node_map = self._node_map()
+        self.assertEqual(node_map, {}, "test_node_released_when_slurmd_not_started failed: Got %s" % node_map)
+        expected = ['/opt/slurm/bin/scontrol', 'update', 'NodeName=compute-1', 'State=DOWN',
+                    'Reason=sqswatcher: slurmd not started']
+        self.assertEqual(self.commands[-1], expected, "test_node_released_when_slurmd_not_started failed: Got %s; "
+                         "Expected: %s" % (self.commands[-1], expected))
+
+    def test_restart_command(self):
+        if slurm is None:
+            return
+        command = getattr(slurm, '__getRestartCommand')('compute-1')
+        self.assertTrue(command.startswith('set -e;'), "test_restart_command failed: Got %s" % command)
+        for expected in ['SLURMD_OPTIONS=\\"-N compute-1\\"', '$defaults_dir/slurmd', '$defaults_dir/slurm ']:
+            self.assertTrue(expected in command, "test_restart_command failed: %s not in %s" % (expected, command))
+        command = getattr(slurm, '__getRestartCommand')()
+        self.assertFalse('SLURMD_OPTIONS' in command, "test_restart_command failed: Got %s" % command)
+
+
+if __name__ == '__main__':
+    unittest.main()
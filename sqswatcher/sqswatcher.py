@@ -15,10 +15,16 @@ import time
 import sys
 import ConfigParser
 import logging
+import Queue
+import signal
+import threading
 
 import boto3
 from botocore.config import Config
-from botocore.exceptions import ClientError
+from botocore.exceptions import BotoCoreError, ClientError
+
+from common.latency import get_latency_log, to_timestamp
+from journal import DONE, EventJournal
 
 
 class HostRemovalError(Exception):
@@ -30,6 +36,9 @@ class QueryConfigError(Exception):
 
 
 log = logging.getLogger(__name__)
+_thread_local = threading.local()
+# LatencyLog recording the scale-up stages, None if disabled
+latency_log = None
 
 
 def _get_config():
@@ -52,6 +61,16 @@ def _get_config():
     _scheduler = config.get('sqswatcher', 'scheduler')
     _cluster_user = config.get('sqswatcher', 'cluster_user')
     _proxy = config.get('sqswatcher', 'proxy')
+    _workers = config.getint('sqswatcher', 'workers') if config.has_option('sqswatcher', 'workers') else 8
+    _max_queued_events = (
+        config.getint('sqswatcher', 'max_queued_events') if config.has_option('sqswatcher', 'max_queued_events')
+        else 100
+    )
+    _journal_file = (
+        config.get('sqswatcher', 'journal_file') if config.has_option('sqswatcher', 'journal_file')
+        else 'NONE'
+    )
+    _latency_dir = config.get('sqswatcher', 'latency_dir') if config.has_option('sqswatcher', 'latency_dir') else None
     proxy_config = Config()
 
     if not _proxy == "NONE":
@@ -63,9 +82,14 @@ def _get_config():
                                  ('_table_name', _table_name),
                                  ('_scheduler', _scheduler),
                                  ('_cluster_user', _cluster_user),
-                                 ('_proxy', _proxy)]))
+                                 ('_proxy', _proxy),
+                                 ('_workers', _workers),
+                                 ('_max_queued_events', _max_queued_events),
+                                 ('_journal_file', _journal_file),
+                                 ('_latency_dir', _latency_dir)]))
 
-    return _region, _sqsqueue, _table_name, _scheduler, _cluster_user, proxy_config
+    return (_region, _sqsqueue, _table_name, _scheduler, _cluster_user, proxy_config, _workers, _max_queued_events,
+            _journal_file, _latency_dir)
 
 
 def _setup_queue(region, queue_name, proxy_config):
@@ -141,6 +165,41 @@ def _load_scheduler_module(scheduler):
     return _scheduler
 
 
+class _SerializedPlugin(object):
+    """Serialize the calls to a scheduler plugin that doesn't declare itself thread safe."""
+
+    def __init__(self, scheduler_module):
+        self._scheduler_module = scheduler_module
+        self._lock = threading.Lock()
+
+    def addHost(self, *args, **kwargs):
+        with self._lock:
+            return self._scheduler_module.addHost(*args, **kwargs)
+
+    def removeHost(self, *args, **kwargs):
+        with self._lock:
+            return self._scheduler_module.removeHost(*args, **kwargs)
+
+
+def _get_thread_resource(service_name, proxy_config):
+    """
+    Get a boto3 resource owned by the calling thread, since boto3 resources must not be shared between threads.
+
+    :param service_name: name of the AWS service, e.g. ec2
+    :param proxy_config: proxy configuration
+    :return: the resource object
+    """
+    resources = getattr(_thread_local, 'resources', None)
+    if resources is None:
+        resources = _thread_local.resources = {}
+        _thread_local.session = boto3.session.Session()
+    if service_name not in resources:
+        resources[service_name] = _thread_local.session.resource(
+            service_name, region_name=region, config=proxy_config
+        )
+    return resources[service_name]
+
+
 def _exponential_retry(func, attempts=3, delay=15, multiplier=2):
     """
     Execute the given boto3 function multiple times with an exponential delay in case of RequestLimitExceeded.
@@ -171,60 +230,139 @@ def _exponential_retry(func, attempts=3, delay=15, multiplier=2):
             break
 
 
-def _add_host(scheduler_module, table, instance_id, slots, proxy_config):
+def _record_step(journal, event_id, step, data=None):
+    """
+    Record a completed step of the event in the journal, if enabled.
+
+    :param journal: the EventJournal, None if disabled
+    :param event_id: the event identifier
+    :param step: name of the completed step
+    :param data: optional data needed to resume the following steps
+    """
+    if journal:
+        journal.record(event_id, step, data)
+
+
+def _add_host(scheduler_module, table, instance_id, slots, proxy_config, journal=None, event_id=None):
     """
     Add the given instance_id to the scheduler cluster and to the instances table.
 
+    The steps already recorded in the journal for the event are skipped.
+
     :param scheduler_module: scheduler specific module to use
     :param table: dynamodb table in which the instance must be added
     :param instance_id: the id of the instance to add
     :param slots: the number of slots associated to the instance
     :param proxy_config: proxy configuration to use
+    :param journal: EventJournal tracking the completed steps, None to disable it
+    :param event_id: identifier of the event in the journal
     """
-    ec2 = boto3.resource('ec2', region_name=region, config=proxy_config)
-    instances = _exponential_retry(lambda: ec2.instances.filter(InstanceIds=[instance_id]))
-    instance = next(iter(instances or []), None)
+    steps = journal.get_steps(event_id) if journal else {}
+    launch_time = None
 
-    if not instance:
-        log.error("Unable to find running instance %s." % instance_id)
+    if 'hostname' in steps:
+        hostname = steps['hostname']
+        log.info("Resuming addition of hostname: %s" % hostname)
     else:
-        hostname = instance.private_dns_name.split('.')[:1][0]
-        if hostname:
-            log.info("Adding hostname: %s" % hostname)
-            scheduler_module.addHost(hostname=hostname, cluster_user=cluster_user, slots=slots)
-            log.info("Host %s successfully added to the cluster" % hostname)
-
-            table.put_item(Item={
-                'instanceId': instance_id,
-                'hostname': hostname
-            })
-            log.info("Instance %s successfully added to the database" % instance_id)
-        else:
-            log.error("Unable to get the hostname for the instance %s" % instance_id)
+        ec2 = _get_thread_resource('ec2', proxy_config)
+        instances = _exponential_retry(lambda: ec2.instances.filter(InstanceIds=[instance_id]))
+        instance = next(iter(instances or []), None)
 
+        if not instance:
+            log.error("Unable to find running instance %s." % instance_id)
+            return
+        launch_time = instance.launch_time
 
-def _remove_host(scheduler_module, table, instance_id):
+        hostname = instance.private_dns_name.split('.')[:1][0]
+        if not hostname:
+            log.error("Unable to get the hostname for the instance %s" % instance_id)
+            return
+        _record_step(journal, event_id, 'hostname', hostname)
+
+    if 'scheduler' not in steps:
+        log.info("Adding hostname: %s" % hostname)
+        scheduler_module.addHost(hostname=hostname, cluster_user=cluster_user, slots=slots)
+        log.info("Host %s successfully added to the cluster" % hostname)
+        _record_step(journal, event_id, 'scheduler')
+
+    if 'database' not in steps:
+        table.put_item(Item={
+            'instanceId': instance_id,
+            'hostname': hostname
+        })
+        log.info("Instance %s successfully added to the database" % instance_id)
+        _record_step(journal, event_id, 'database')
+        if latency_log:
+            latency_log.record('host_added', instance_id, hostname=hostname, launch_time=to_timestamp(launch_time))
+
+
+def _remove_host(scheduler_module, table, instance_id, journal=None, event_id=None):
     """
     Remove the given instance_id from the scheduler cluster and from the instances table.
 
+    The steps already recorded in the journal for the event are skipped.
+
     :param scheduler_module: scheduler specific module to use
     :param table: dynamodb table from which the instance item must be removed
     :param instance_id: the id of the instance to remove
+    :param journal: EventJournal tracking the completed steps, None to disable it
+    :param event_id: identifier of the event in the journal
     """
-    item = _exponential_retry(lambda: table.get_item(ConsistentRead=True, Key={"instanceId": instance_id}))
-    if item.get('Item') is not None:
+    steps = journal.get_steps(event_id) if journal else {}
+
+    if 'hostname' in steps:
+        hostname = steps['hostname']
+    else:
+        item = _exponential_retry(lambda: table.get_item(ConsistentRead=True, Key={"instanceId": instance_id}))
+        if item.get('Item') is None:
+            log.error("Instance %s not found in the database" % instance_id)
+            return
         hostname = item.get('Item').get('hostname')
+        _record_step(journal, event_id, 'hostname', hostname)
+
+    if 'scheduler' not in steps:
         if hostname:
             log.info("Removing hostname: %s" % hostname)
             scheduler_module.removeHost(hostname, cluster_user)
             log.info("Host %s successfully removed from the cluster" % hostname)
         else:
             log.warning("Hostname is empty for the instance %s." % instance_id)
+        _record_step(journal, event_id, 'scheduler')
 
+    if 'database' not in steps:
         _exponential_retry(lambda: table.delete_item(Key={"instanceId": instance_id}))
         log.info("Instance %s successfully removed from the database" % instance_id)
-    else:
-        log.error("Instance %s not found in the database" % instance_id)
+        _record_step(journal, event_id, 'database')
+
+
+def _get_thread_message(queue, message, proxy_config):
+    """
+    Get the received message and its queue bound to the resources of the calling thread.
+
+    :param queue: the queue the message has been received from
+    :param message: the received message
+    :param proxy_config: proxy configuration
+    :return: the queue and the message owned by the calling thread
+    """
+    sqs = _get_thread_resource('sqs', proxy_config)
+    thread_message = sqs.Message(queue.url, message.receipt_handle)
+    # the data already received, e.g. the body, can't be loaded again
+    thread_message.meta.data = message.meta.data
+    return sqs.Queue(queue.url), thread_message
+
+
+def _get_event_instance_id(message):
+    """
+    Get the instance the event carried by the message refers to, without handling the event.
+
+    :param message: the received message
+    :return: the instance id, None if not found
+    """
+    try:
+        message_attrs = json.loads(json.loads(message.body).get('Message'))
+        return message_attrs.get('EC2InstanceId') or (message_attrs.get('detail') or {}).get('instance-id')
+    except (ValueError, TypeError, AttributeError):
+        return None
 
 
 def _requeue_message(queue, message):
@@ -237,71 +375,215 @@ def _requeue_message(queue, message):
     queue.send_message(MessageBody=message.body, DelaySeconds=60)
 
 
-def _poll_queue(scheduler, queue, table, proxy_config):
-    log.debug("startup")
-    scheduler_module = _load_scheduler_module(scheduler)
+def _process_message(scheduler_module, queue, table, message, proxy_config, journal=None):
+    """
+    Handle a single instance event received from the queue, skipping the events already completed.
 
-    while True:
+    :param scheduler_module: scheduler specific module to use
+    :param queue: the queue the message has been received from
+    :param table: dynamodb table tracking the instances of the cluster
+    :param message: the message to process
+    :param proxy_config: proxy configuration to use
+    :param journal: EventJournal tracking the completed steps, None to disable it
+    """
+    message_text = json.loads(message.body)
+    # SNS notification id, preserved when the message is requeued, or SQS message id
+    event_id = message_text.get('MessageId') or message.message_id
+
+    if not journal:
+        _handle_event(scheduler_module, queue, table, message, message_text, proxy_config, None, event_id)
+        return
+
+    if not journal.start(event_id):
+        if journal.is_done(event_id):
+            log.info("Event %s already processed, deleting duplicate message" % event_id)
+            message.delete()
+        else:
+            # left in the queue, it will be skipped once the other worker completes the event
+            log.info("Event %s is being processed by another worker" % event_id)
+        return
 
-        results = queue.receive_messages(MaxNumberOfMessages=10)
-        while len(results) > 0:
+    try:
+        if _handle_event(scheduler_module, queue, table, message, message_text, proxy_config, journal, event_id):
+            journal.record(event_id, DONE)
+    finally:
+        journal.finish(event_id)
 
-            for message in results:
-                message_text = json.loads(message.body)
-                message_attrs = json.loads(message_text.get('Message'))
-                log.debug("SQS Message %s" % message_attrs)
 
-                try:
-                    event_type = message_attrs.get('Event')
-                except:
-                    try:
-                        event_type = message_attrs.get('detail-type')
-                    except KeyError:
-                        log.warning("Unable to read message. Deleting.")
-                        message.delete()
-                        break
+def _handle_event(scheduler_module, queue, table, message, message_text, proxy_config, journal, event_id):
+    """
+    Apply the event carried by the message.
 
-                log.info("event_type=%s" % event_type)
-
-                if event_type == 'autoscaling:TEST_NOTIFICATION':
-                    message.delete()
-
-                elif event_type == 'parallelcluster:COMPUTE_READY':
-                    instance_id = message_attrs.get('EC2InstanceId')
-                    slots = message_attrs.get('Slots')
-                    log.info("instance_id=%s" % instance_id)
-                    _add_host(scheduler_module, table, instance_id, slots, proxy_config)
-                    message.delete()
-
-                elif (
-                        event_type == 'autoscaling:EC2_INSTANCE_TERMINATE' or
-                        event_type == 'EC2 Instance State-change Notification'
-                ):
-                    if event_type == 'autoscaling:EC2_INSTANCE_TERMINATE':
-                        instance_id = message_attrs.get('EC2InstanceId')
-                    elif event_type == 'EC2 Instance State-change Notification':
-                        if message_attrs.get('detail').get('state') == 'terminated':
-                            log.info('Terminated instance state from CloudWatch')
-                            instance_id = message_attrs.get('detail').get('instance-id')
-                        else:
-                            log.info('Not Terminated, ignoring')
-                            message.delete()
-                            break
+    :return: False if the event has been requeued to be completed later
+    """
+    message_attrs = json.loads(message_text.get('Message'))
+    log.debug("SQS Message %s" % message_attrs)
 
-                    log.info("instance_id=%s" % instance_id)
-                    try:
-                        _remove_host(scheduler_module, table, instance_id)
-                    except HostRemovalError:
-                        log.info("Unable to remove host, requeuing %s message" % event_type)
-                        _requeue_message(queue, message)
-                    except QueryConfigError:
-                        log.info("Unable to query scheduler configuration, discarding %s message" % event_type)
+    try:
+        event_type = message_attrs.get('Event')
+    except:
+        try:
+            event_type = message_attrs.get('detail-type')
+        except KeyError:
+            log.warning("Unable to read message. Deleting.")
+            message.delete()
+            return True
+
+    log.info("event_type=%s" % event_type)
+
+    if event_type == 'autoscaling:TEST_NOTIFICATION':
+        message.delete()
+
+    elif event_type == 'parallelcluster:COMPUTE_READY':
+        instance_id = message_attrs.get('EC2InstanceId')
+        slots = message_attrs.get('Slots')
+        log.info("instance_id=%s" % instance_id)
+        if latency_log:
+            latency_log.record('compute_ready', instance_id, sent_time=to_timestamp(message_text.get('Timestamp')))
+        _add_host(scheduler_module, table, instance_id, slots, proxy_config, journal, event_id)
+        message.delete()
+
+    elif (
+            event_type == 'autoscaling:EC2_INSTANCE_TERMINATE' or
+            event_type == 'EC2 Instance State-change Notification'
+    ):
+        if event_type == 'autoscaling:EC2_INSTANCE_TERMINATE':
+            instance_id = message_attrs.get('EC2InstanceId')
+        elif event_type == 'EC2 Instance State-change Notification':
+            if message_attrs.get('detail').get('state') == 'terminated':
+                log.info('Terminated instance state from CloudWatch')
+                instance_id = message_attrs.get('detail').get('instance-id')
+            else:
+                log.info('Not Terminated, ignoring')
+                message.delete()
+                return True
+
+        log.info("instance_id=%s" % instance_id)
+        try:
+            _remove_host(scheduler_module, table, instance_id, journal, event_id)
+        except HostRemovalError:
+            log.info("Unable to remove host, requeuing %s message" % event_type)
+            _requeue_message(queue, message)
+            # the requeued message carries the same event id and resumes from the failed step
+            message.delete()
+            return False
+        except QueryConfigError:
+            log.info("Unable to query scheduler configuration, discarding %s message" % event_type)
+
+        message.delete()
 
-                    message.delete()
+    return True
 
-            results = queue.receive_messages(MaxNumberOfMessages=10)
 
-        time.sleep(30)
+def _process_messages(scheduler_module, queue, table_name, events, proxy_config, journal):
+    """
+    Worker thread body, process the messages taken from events until a None sentinel is found.
+
+    :param scheduler_module: scheduler specific module to use
+    :param queue: the queue the messages have been received from
+    :param table_name: name of the dynamodb table tracking the instances of the cluster
+    :param events: Queue.Queue of the received messages assigned to the worker
+    :param proxy_config: proxy configuration to use
+    :param journal: EventJournal tracking the completed steps, None to disable it
+    """
+    table = _get_thread_resource('dynamodb', proxy_config).Table(table_name)
+    while True:
+        message = events.get()
+        try:
+            if message is None:
+                return
+            thread_queue, thread_message = _get_thread_message(queue, message, proxy_config)
+            _process_message(scheduler_module, thread_queue, table, thread_message, proxy_config, journal)
+        except Exception as e:
+            # the message will be delivered again once its visibility timeout expires
+            log.exception("Unable to process message %s: %s" % (message.message_id, e))
+        finally:
+            events.task_done()
+
+
+def _poll_queue(scheduler, queue, table, proxy_config, workers=8, max_queued_events=100, wait_time=20, journal=None):
+    """
+    Receive the instance events from the queue and dispatch them to a pool of worker threads.
+
+    The events of an instance are always dispatched to the same worker, so that they are processed one at a time and
+    in the order they are received, e.g. COMPUTE_READY before EC2_INSTANCE_TERMINATE.
+
+    Messages are received with long polling. When the worker of a message already has its share of max_queued_events
+    messages waiting, receiving is paused until the worker catches up. On SIGTERM or SIGINT no new message is received,
+    the messages already received are processed and the function returns.
+
+    :param scheduler: name of the scheduler plugin
+    :param queue: the queue to receive the messages from
+    :param table: dynamodb table tracking the instances of the cluster
+    :param proxy_config: proxy configuration to use
+    :param workers: number of messages processed concurrently
+    :param max_queued_events: maximum number of received messages waiting for the workers
+    :param wait_time: long polling wait time in seconds, at most 20
+    :param journal: EventJournal tracking the completed steps, None to disable it
+    """
+    log.debug("startup")
+    scheduler_module = _load_scheduler_module(scheduler)
+    if not getattr(scheduler_module, 'thread_safe', False):
+        scheduler_module = _SerializedPlugin(scheduler_module)
+
+    stop = threading.Event()
+
+    def _stop(signum, frame):
+        log.info("Received signal %d, shutting down" % signum)
+        stop.set()
+
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGINT, _stop)
+
+    # messages received and waiting for each worker, few enough to be processed within their visibility timeout
+    events = [Queue.Queue(maxsize=max(max_queued_events // workers, 1)) for _ in range(workers)]
+    threads = []
+    for i in range(workers):
+        thread = threading.Thread(
+            target=_process_messages,
+            name="sqswatcher-worker-%d" % i,
+            args=(scheduler_module, queue, table.name, events[i], proxy_config, journal),
+        )
+        # never keep the process alive if the receive loop fails
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    try:
+        while not stop.is_set():
+            try:
+                results = queue.receive_messages(MaxNumberOfMessages=10, WaitTimeSeconds=wait_time)
+            except ClientError as e:
+                log.error("Unable to receive messages: %s" % e.response.get("Error").get("Message"))
+                stop.wait(30)
+                continue
+            except BotoCoreError as e:
+                log.error("Unable to receive messages: %s" % e)
+                stop.wait(30)
+                continue
+
+            for message in results:
+                worker_events = events[hash(_get_event_instance_id(message) or message.message_id) % workers]
+                # wait with a timeout, so that signals are handled while the workers are busy
+                while True:
+                    try:
+                        worker_events.put(message, timeout=1)
+                        break
+                    except Queue.Full:
+                        if stop.is_set():
+                            # not deleted, the message will be delivered again once its visibility timeout expires
+                            break
+    finally:
+        log.info("Waiting for %d workers to complete the events in progress" % len(threads))
+        for worker_events in events:
+            worker_events.put(None)
+        for thread in threads:
+            # join with a timeout to keep handling signals
+            while thread.is_alive():
+                thread.join(1)
+        if journal:
+            journal.close()
+    log.info("sqswatcher stopped")
 
 
 def main():
@@ -310,13 +592,16 @@ def main():
         format='%(asctime)s %(levelname)s [%(module)s:%(funcName)s] %(message)s'
     )
     log.info("sqswatcher startup")
-    global region, cluster_user
+    global region, cluster_user, latency_log
 
-    region, sqsqueue, table_name, scheduler, cluster_user, proxy_config = _get_config()
+    (region, sqsqueue, table_name, scheduler, cluster_user, proxy_config, workers, max_queued_events,
+     journal_file, latency_dir) = _get_config()
+    latency_log = get_latency_log(latency_dir, 'sqswatcher')
     queue = _setup_queue(region, sqsqueue, proxy_config)
     table = _setup_ddb_table(region, table_name, proxy_config)
+    journal = EventJournal(journal_file) if journal_file != 'NONE' else None
 
-    _poll_queue(scheduler, queue, table, proxy_config)
+    _poll_queue(scheduler, queue, table, proxy_config, workers, max_queued_events, journal=journal)
 
 
 if __name__ == "__main__":
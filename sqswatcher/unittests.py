@@ -0,0 +1,402 @@
+import json
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from journal import DONE, EventJournal
+from known_hosts import KnownHostsManager
+
+try:
+    import sqswatcher
+except ImportError:
+    # boto3 not installed, or Python 3 which sqswatcher doesn't support yet
+    sqswatcher = None
+
+
+def _event_message(message_id, event_type, instance_id):
+    body = json.dumps({
+        'MessageId': message_id,
+        'Message': json.dumps({'Event': event_type, 'EC2InstanceId': instance_id}),
+    })
+    return _Message(message_id, body)
+
+
+class _Message(object):
+    def __init__(self, message_id, body):
+        self.message_id = message_id
+        self.body = body
+        self.deleted = False
+
+    def delete(self):
+        self.deleted = True
+
+
+class _Queue(object):
+    """Deliver the given batches of messages, then fail the receive call."""
+
+    def __init__(self, batches):
+        self.batches = list(batches)
+
+    def receive_messages(self, MaxNumberOfMessages=1, WaitTimeSeconds=0):
+        if not self.batches:
+            raise RuntimeError('connection lost')
+        return self.batches.pop(0)
+
+
+class poll_queue_tests(unittest.TestCase):
+    def setUp(self):
+        if sqswatcher is None:
+            return
+        self.patched = {}
+        self.processed = []
+        self.active = set()
+        self.overlaps = []
+        self.lock = threading.Lock()
+
+        def process_message(scheduler_module, queue, table, message, proxy_config, journal=None):
+            instance_id = sqswatcher._get_event_instance_id(message)
+            with self.lock:
+                if instance_id in self.active:
+                    self.overlaps.append(instance_id)
+                self.active.add(instance_id)
+            time.sleep(0.001)
+            with self.lock:
+                self.active.discard(instance_id)
+                self.processed.append(message.message_id)
+
+        self._patch('_process_message', process_message)
+        self._patch('_load_scheduler_module', lambda scheduler: type('plugin', (object,), {'thread_safe': True}))
+        self._patch('_get_thread_resource', lambda service_name, proxy_config: type(
+            'resource', (object,), {'Table': staticmethod(lambda name: None)}
+        ))
+        self._patch('_get_thread_message', lambda queue, message, proxy_config: (queue, message))
+
+    def tearDown(self):
+        if sqswatcher is None:
+            return
+        for name, value in self.patched.items():
+            setattr(sqswatcher, name, value)
+
+    def _patch(self, name, value):
+        self.patched[name] = getattr(sqswatcher, name)
+        setattr(sqswatcher, name, value)
+
+    def _poll(self, batches, workers=4):
+        table = type('table', (object,), {'name': 'instances'})
+        self.assertRaises(
+            RuntimeError, sqswatcher._poll_queue, 'slurm', _Queue(batches), table, None, workers=workers,
+            max_queued_events=8
+        )
+
+    def test_events_of_an_instance_are_ordered(self):
+        if sqswatcher is None:
+            return
+        batches = []
+        for i in range(20):
+            batches.append([_event_message('ready-%d' % i, 'parallelcluster:COMPUTE_READY', 'i-%d' % i)])
+        for i in range(20):
+            batches.append([_event_message('terminate-%d' % i, 'autoscaling:EC2_INSTANCE_TERMINATE', 'i-%d' % i)])
+        self._poll(batches)
+        self.assertEqual(
+            len(self.processed), 40, "test_events_of_an_instance_are_ordered failed: Got %s" % self.processed
+        )
+        self.assertEqual(self.overlaps, [], "test_events_of_an_instance_are_ordered failed: Got %s" % self.overlaps)
+        for i in range(20):
+            self.assertTrue(
+                self.processed.index('ready-%d' % i) < self.processed.index('terminate-%d' % i),
+                "test_events_of_an_instance_are_ordered failed: Got %s" % self.processed
+            )
+
+    def test_redelivered_events_are_not_concurrent(self):
+        if sqswatcher is None:
+            return
+        message = _event_message('ready-0', 'parallelcluster:COMPUTE_READY', 'i-0')
+        batches = [[message, message, message], [message, message]]
+        self._poll(batches)
+        self.assertEqual(
+            len(self.processed), 5, "test_redelivered_events_are_not_concurrent failed: Got %s" % self.processed
+        )
+        self.assertEqual(self.overlaps, [], "test_redelivered_events_are_not_concurrent failed: Got %s" % self.overlaps)
+
+    def test_receive_error_stops_the_workers(self):
+        if sqswatcher is None:
+            return
+        self._poll([], workers=2)
+        for thread in threading.enumerate():
+            self.assertFalse(
+                thread.name.startswith('sqswatcher-worker'),
+                "test_receive_error_stops_the_workers failed: Got %s" % thread.name
+            )
+
+
+class redelivery_tests(unittest.TestCase):
+    def setUp(self):
+        if sqswatcher is None:
+            return
+        self.directory = tempfile.mkdtemp()
+        self.journal = EventJournal(self.directory + '/events.journal')
+        self.handled = []
+        self.handle_event = sqswatcher._handle_event
+
+        def handle_event(scheduler_module, queue, table, message, message_text, proxy_config, journal, event_id):
+            self.handled.append(event_id)
+            return True
+
+        sqswatcher._handle_event = handle_event
+
+    def tearDown(self):
+        if sqswatcher is None:
+            return
+        sqswatcher._handle_event = self.handle_event
+        self.journal.close()
+        shutil.rmtree(self.directory)
+
+    def test_completed_event_is_deleted(self):
+        if sqswatcher is None:
+            return
+        first = _event_message('event-0', 'parallelcluster:COMPUTE_READY', 'i-0')
+        sqswatcher._process_message(None, None, None, first, None, self.journal)
+        redelivered = _event_message('event-0', 'parallelcluster:COMPUTE_READY', 'i-0')
+        sqswatcher._process_message(None, None, None, redelivered, None, self.journal)
+        self.assertEqual(self.handled, ['event-0'], "test_completed_event_is_deleted failed: Got %s" % self.handled)
+        self.assertTrue(self.journal.is_done('event-0'), "test_completed_event_is_deleted failed: event not done")
+        self.assertTrue(redelivered.deleted, "test_completed_event_is_deleted failed: message not deleted")
+
+    def test_event_in_progress_is_kept(self):
+        if sqswatcher is None:
+            return
+        self.journal.start('event-0')
+        redelivered = _event_message('event-0', 'parallelcluster:COMPUTE_READY', 'i-0')
+        sqswatcher._process_message(None, None, None, redelivered, None, self.journal)
+        self.assertEqual(self.handled, [], "test_event_in_progress_is_kept failed: Got %s" % self.handled)
+        self.assertFalse(redelivered.deleted, "test_event_in_progress_is_kept failed: message deleted")
+
+
+class journal_tests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = self.directory + '/events.journal'
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _lines(self):
+        with open(self.path) as journal_file:
+            return journal_file.readlines()
+
+    def test_resume_from_the_last_step(self):
+        journal = EventJournal(self.path)
+        journal.record('event-0', 'hostname', 'ip-1')
+        journal.record('event-0', 'scheduler')
+        journal.record('event-1', 'hostname', 'ip-2')
+        journal.record('event-1', 'scheduler')
+        journal.record('event-1', 'database')
+        journal.record('event-1', DONE)
+        journal.close()
+
+        journal = EventJournal(self.path)
+        steps = journal.get_steps('event-0')
+        expected = {'hostname': 'ip-1', 'scheduler': None}
+        self.assertEqual(steps, expected, "test_resume_from_the_last_step failed: Got %s; Expected: %s"
+                         % (steps, expected))
+        self.assertTrue(journal.start('event-0'), "test_resume_from_the_last_step failed: event-0 not started")
+        self.assertFalse(journal.start('event-1'), "test_resume_from_the_last_step failed: event-1 started")
+        journal.close()
+
+    def test_truncated_record_is_skipped(self):
+        journal = EventJournal(self.path)
+        journal.record('event-0', 'hostname', 'ip-1')
+        journal.record('event-0', 'scheduler')
+        journal.close()
+        # crash while appending the next record
+        with open(self.path, 'a') as journal_file:
+            journal_file.write('{"event": "event-0", "step": "data')
+
+        journal = EventJournal(self.path)
+        steps = journal.get_steps('event-0')
+        expected = {'hostname': 'ip-1', 'scheduler': None}
+        self.assertEqual(steps, expected, "test_truncated_record_is_skipped failed: Got %s; Expected: %s"
+                         % (steps, expected))
+        # the truncated record is dropped when loading, the next records are appended on a new line
+        journal.record('event-0', 'database')
+        journal.close()
+        lines = self._lines()
+        self.assertEqual(len(lines), 3, "test_truncated_record_is_skipped failed: Got %s" % lines)
+        steps = EventJournal(self.path).get_steps('event-0')
+        self.assertTrue('database' in steps, "test_truncated_record_is_skipped failed: Got %s" % steps)
+
+    def test_empty_and_garbage_journal(self):
+        with open(self.path, 'w') as journal_file:
+            journal_file.write('\x00\x00\x00\n\n')
+        journal = EventJournal(self.path)
+        self.assertEqual(journal.get_steps('event-0'), {}, "test_empty_and_garbage_journal failed")
+        journal.close()
+        self.assertEqual(self._lines(), [], "test_empty_and_garbage_journal failed: Got %s" % self._lines())
+
+    def test_compaction_keeps_the_records(self):
+        journal = EventJournal(self.path, compact_every=5)
+        for i in range(12):
+            journal.record('event-%d' % i, 'hostname', 'ip-%d' % i)
+            journal.record('event-%d' % i, DONE)
+        journal.close()
+        lines = self._lines()
+        self.assertEqual(len(lines), 24, "test_compaction_keeps_the_records failed: Got %d lines" % len(lines))
+        journal = EventJournal(self.path)
+        for i in range(12):
+            self.assertTrue(journal.is_done('event-%d' % i), "test_compaction_keeps_the_records failed: event-%d" % i)
+        journal.close()
+
+    def test_records_appended_during_compaction_are_kept(self):
+        journal = EventJournal(self.path, compact_every=50)
+
+        def _record(worker):
+            for i in range(100):
+                journal.record('event-%d-%d' % (worker, i), DONE)
+
+        threads = [threading.Thread(target=_record, args=(worker,)) for worker in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        journal.close()
+
+        journal = EventJournal(self.path)
+        missing = [(worker, i) for worker in range(4) for i in range(100)
+                   if not journal.is_done('event-%d-%d' % (worker, i))]
+        self.assertEqual(missing, [], "test_records_appended_during_compaction_are_kept failed: Got %s" % missing)
+        journal.close()
+
+    def test_expired_events_are_dropped(self):
+        journal = EventJournal(self.path)
+        journal.record('event-0', DONE)
+        journal.close()
+        journal = EventJournal(self.path, retention=-1)
+        self.assertFalse(journal.is_done('event-0'), "test_expired_events_are_dropped failed: event-0 kept")
+        journal.close()
+        self.assertEqual(self._lines(), [], "test_expired_events_are_dropped failed: Got %s" % self._lines())
+
+
+class _Key(object):
+    def __init__(self, key, name='ssh-rsa'):
+        self.key = key
+        self.name = name
+
+    def get_name(self):
+        return self.name
+
+    def get_base64(self):
+        return self.key
+
+
+class known_hosts_tests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = self.directory + '/known_hosts'
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _read(self):
+        with open(self.path) as known_hosts:
+            return known_hosts.read()
+
+    def test_add_appends_new_keys_only(self):
+        manager = KnownHostsManager(self.path)
+        manager.add('ip-1', _Key('AAAA1'))
+        manager.add('ip-2', _Key('AAAA2'))
+        manager.add('ip-1', _Key('AAAA1'))
+        content = self._read()
+        expected = 'ip-1 ssh-rsa AAAA1\nip-2 ssh-rsa AAAA2\n'
+        self.assertEqual(content, expected, "test_add_appends_new_keys_only failed: Got %s; Expected: %s"
+                         % (content, expected))
+
+    def test_index_is_loaded_from_the_file(self):
+        with open(self.path, 'w') as known_hosts:
+            known_hosts.write('# managed by sqswatcher\nip-1 ssh-rsa AAAA1\n')
+        manager = KnownHostsManager(self.path)
+        manager.add('ip-1', _Key('AAAA1'))
+        content = self._read()
+        expected = '# managed by sqswatcher\nip-1 ssh-rsa AAAA1\n'
+        self.assertEqual(content, expected, "test_index_is_loaded_from_the_file failed: Got %s; Expected: %s"
+                         % (content, expected))
+
+    def test_removed_hosts_are_pruned_in_batches(self):
+        manager = KnownHostsManager(self.path, prune_batch_size=2)
+        for i in range(3):
+            manager.add('ip-%d' % i, _Key('AAAA%d' % i))
+        manager.remove('ip-0')
+        content = self._read()
+        self.assertTrue('ip-0 ' in content, "test_removed_hosts_are_pruned_in_batches failed: pruned too early")
+        manager.remove('ip-1')
+        content = self._read()
+        expected = 'ip-2 ssh-rsa AAAA2\n'
+        self.assertEqual(content, expected, "test_removed_hosts_are_pruned_in_batches failed: Got %s; Expected: %s"
+                         % (content, expected))
+
+    def test_compaction_keeps_the_last_key_and_foreign_lines(self):
+        manager = KnownHostsManager(self.path)
+        manager.add('ip-1', _Key('OLD'))
+        manager.add('ip-1', _Key('NEW'))
+        with open(self.path, 'a') as known_hosts:
+            # written by another tool after the index was loaded
+            known_hosts.write('github.com ssh-rsa AAAAG\n')
+        manager.compact()
+        content = self._read()
+        expected = 'ip-1 ssh-rsa NEW\ngithub.com ssh-rsa AAAAG\n'
+        self.assertEqual(content, expected, "test_compaction_keeps_the_last_key_and_foreign_lines failed: Got %s; "
+                         "Expected: %s" % (content, expected))
+
+    def test_compaction_keeps_every_key_type(self):
+        foreign = ('github.com ssh-rsa AAAAG1\n'
+                   'github.com ecdsa-sha2-nistp256 AAAAG2\n'
+                   'github.com ssh-ed25519 AAAAG3\n')
+        with open(self.path, 'w') as known_hosts:
+            known_hosts.write(foreign)
+        manager = KnownHostsManager(self.path, prune_batch_size=1)
+        manager.add('ip-1', _Key('RSA1'))
+        manager.add('ip-1', _Key('ED1', 'ssh-ed25519'))
+        manager.add('ip-2', _Key('RSA2'))
+        manager.remove('ip-2')
+        content = self._read()
+        expected = foreign + 'ip-1 ssh-rsa RSA1\nip-1 ssh-ed25519 ED1\n'
+        self.assertEqual(content, expected, "test_compaction_keeps_every_key_type failed: Got %s; Expected: %s"
+                         % (content, expected))
+
+    def test_compaction_replaces_the_key_of_the_same_type(self):
+        with open(self.path, 'w') as known_hosts:
+            known_hosts.write('ip-1 ssh-rsa OLD\nip-1 ssh-ed25519 ED1\n')
+        manager = KnownHostsManager(self.path)
+        manager.add('ip-1', _Key('NEW'))
+        manager.compact()
+        content = self._read()
+        expected = 'ip-1 ssh-ed25519 ED1\nip-1 ssh-rsa NEW\n'
+        self.assertEqual(content, expected, "test_compaction_replaces_the_key_of_the_same_type failed: Got %s; "
+                         "Expected: %s" % (content, expected))
+
+    def test_removed_host_loses_every_key_type(self):
+        manager = KnownHostsManager(self.path, prune_batch_size=1)
+        manager.add('ip-1', _Key('RSA1'))
+        manager.add('ip-1', _Key('ED1', 'ssh-ed25519'))
+        manager.add('ip-2', _Key('RSA2'))
+        manager.remove('ip-1')
+        content = self._read()
+        expected = 'ip-2 ssh-rsa RSA2\n'
+        self.assertEqual(content, expected, "test_removed_host_loses_every_key_type failed: Got %s; Expected: %s"
+                         % (content, expected))
+
+    def test_readded_host_is_not_pruned(self):
+        manager = KnownHostsManager(self.path)
+        manager.add('ip-1', _Key('AAAA1'))
+        manager.remove('ip-1')
+        manager.add('ip-1', _Key('AAAA1'))
+        manager.compact()
+        content = self._read()
+        expected = 'ip-1 ssh-rsa AAAA1\n'
+        self.assertEqual(content, expected, "test_readded_host_is_not_pruned failed: Got %s; Expected: %s"
+                         % (content, expected))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,1193 @@
+#!/usr/bin/env python
+# Copyright 2013-2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You may not use this file except in compliance with the
+# License. A copy of the License is located at
+#
+# http://aws.amazon.com/apache2.0/
+#
+# or in the "LICENSE.txt" file accompanying this file. This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES
+# OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+End-to-end scaling simulator.
+
+Runs the real jobwatcher, sqswatcher and nodewatcher loops in a single process, one thread per daemon and one thread
+per compute node, against in-process stand-ins:
+
+- AWS: ASG, EC2, SQS, DynamoDB, CloudFormation and the instance metadata service
+- Slurm: squeue, sinfo and scontrol answering from a simulated cluster, with sqswatcher in node pool mode
+- SSH: paramiko connections always succeed
+
+Time is virtual: time.time and time.sleep are replaced by a clock that jumps to the next wake-up as soon as every
+simulated thread is waiting, so hours of scaling activity run in seconds or minutes.
+
+Example, scale from 0 to 1000 nodes and back:
+
+    python util/scaling_simulator.py --jobs 1000 --max-size 1000 --log-file /tmp/simulation.log
+
+Daemon options can be overridden, e.g. --option jobwatcher.forecast_model=ewma or --option sqswatcher.workers=16.
+"""
+
+import argparse
+import collections
+import glob
+import heapq
+import itertools
+import json
+import logging
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import thread
+import threading
+import time
+import types
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+log = logging.getLogger('simulator')
+
+# identifies the simulated daemon or node running in the current thread
+_context = threading.local()
+
+
+class ThreadKilled(Exception):
+    """Raised in the thread of a node whose instance has been terminated."""
+
+
+class VirtualClock(object):
+    """
+    Virtual time shared by all the simulated threads.
+
+    The clock advances, to the earliest wake-up time, only when all the registered threads are sleeping or blocked on a
+    simulated queue.
+    """
+
+    def __init__(self, start):
+        self.now = float(start)
+        self._cond = threading.Condition(threading.Lock())
+        self._sleepers = []
+        self._events = {}
+        self._threads = set()
+        self._blocked = 0
+        self._starting = 0
+        self._killed = set()
+        self._seq = itertools.count()
+
+    def time(self):
+        return self.now
+
+    def spawn(self, target, name, context):
+        """
+        Start a thread taking part in the simulation.
+
+        :param target: function run by the thread
+        :param name: thread name
+        :param context: name of the simulated daemon or node, used to separate the state of the simulated hosts
+        :return: the started thread
+        """
+        with self._cond:
+            self._starting += 1
+
+        def run():
+            with self._cond:
+                self._threads.add(thread.get_ident())
+                self._starting -= 1
+            _context.name = context
+            try:
+                target()
+            except ThreadKilled:
+                pass
+            except Exception:
+                log.exception("Simulated thread %s failed" % name)
+            finally:
+                with self._cond:
+                    self._threads.discard(thread.get_ident())
+                    self._killed.discard(thread.get_ident())
+                    self._cond.notify_all()
+
+        simulated_thread = threading.Thread(target=run, name=name)
+        simulated_thread.daemon = True
+        simulated_thread.start()
+        return simulated_thread
+
+    def sleep(self, seconds):
+        ident = thread.get_ident()
+        event = threading.Event()
+        with self._cond:
+            self._check_killed(ident)
+            self._threads.add(ident)
+            heapq.heappush(self._sleepers, (self.now + max(seconds, 0), next(self._seq), ident))
+            self._events[ident] = event
+            self._blocked += 1
+            self._cond.notify_all()
+        event.wait()
+        with self._cond:
+            self._check_killed(ident)
+
+    def _check_killed(self, ident):
+        if ident in self._killed:
+            raise ThreadKilled()
+
+    def _cancel_sleep(self, ident):
+        self._sleepers = [sleeper for sleeper in self._sleepers if sleeper[2] != ident]
+        heapq.heapify(self._sleepers)
+        return self._events.pop(ident)
+
+    def wake(self, ident):
+        """Interrupt the sleep of the given thread, e.g. an SQS long polling receiving a message."""
+        with self._cond:
+            if ident in self._events:
+                event = self._cancel_sleep(ident)
+                self._events[ident] = event
+                heapq.heappush(self._sleepers, (self.now, next(self._seq), ident))
+
+    def kill(self, simulated_thread):
+        """Make the given thread exit at its next sleep."""
+        with self._cond:
+            ident = simulated_thread.ident
+            if ident not in self._threads:
+                return
+            self._killed.add(ident)
+            if ident in self._events:
+                self._blocked -= 1
+                self._cancel_sleep(ident).set()
+
+    def add_blocked(self, count):
+        """Account threads blocking, or unblocking with a negative count, on something other than sleep."""
+        with self._cond:
+            if count > 0:
+                self._threads.add(thread.get_ident())
+            self._blocked += count
+            self._cond.notify_all()
+
+    def run(self, until, on_advance, finished):
+        """
+        Advance the time until the given instant or until finished returns True.
+
+        :param until: end of the simulation, in seconds since the epoch
+        :param on_advance: function called with (previous time, new time) before waking up the threads
+        :param finished: function telling whether the simulation is complete, called when all threads are waiting
+        """
+        with self._cond:
+            while True:
+                while self._starting or self._blocked < len(self._threads):
+                    self._cond.wait()
+                if finished():
+                    return
+                if not self._sleepers:
+                    raise RuntimeError("All simulated threads are blocked")
+                previous = self.now
+                self.now = min(until, max(previous, self._sleepers[0][0]))
+                on_advance(previous, self.now)
+                if self.now >= until:
+                    return
+                while self._sleepers and self._sleepers[0][0] <= self.now:
+                    ident = heapq.heappop(self._sleepers)[2]
+                    self._blocked -= 1
+                    self._events.pop(ident).set()
+
+
+class SimulatedQueue(object):
+    """Queue.Queue replacement telling the clock when a consumer blocks, used by the sqswatcher workers."""
+
+    Full = __import__('Queue').Full
+    Empty = __import__('Queue').Empty
+
+    def __init__(self, clock):
+        self.clock = clock
+
+    def Queue(self, maxsize=0):
+        return _BlockingQueue(self.clock, maxsize)
+
+
+class _BlockingQueue(object):
+    def __init__(self, clock, maxsize=0):
+        self.clock = clock
+        self.maxsize = maxsize
+        self._items = collections.deque()
+        self._cond = threading.Condition(threading.Lock())
+        self._waiting = 0
+        # items put while a consumer was waiting, reserved to the waiting consumers
+        self._handoff = 0
+
+    def put(self, item, block=True, timeout=None):
+        with self._cond:
+            deadline = None if timeout is None else time.time() + timeout
+            while self.maxsize > 0 and len(self._items) >= self.maxsize:
+                # the producer keeps running while waiting for a free slot, workers don't sleep in the simulation
+                if not block or (deadline is not None and self.clock.now >= deadline):
+                    raise SimulatedQueue.Full
+                self._cond.wait(0.01)
+            self._items.append(item)
+            if self._waiting:
+                self._waiting -= 1
+                self._handoff += 1
+                self.clock.add_blocked(-1)
+            self._cond.notify_all()
+
+    def get(self, block=True, timeout=None):
+        with self._cond:
+            if len(self._items) <= self._handoff:
+                self._waiting += 1
+                self.clock.add_blocked(1)
+                while not self._handoff:
+                    self._cond.wait()
+                self._handoff -= 1
+            self._cond.notify_all()
+            return self._items.popleft()
+
+    def task_done(self):
+        pass
+
+
+class SimulatedThreading(object):
+    """Stand-in for the threading module in sqswatcher, so that its worker threads take part in the simulation."""
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.Event = threading.Event
+        self.Lock = threading.Lock
+        self.local = threading.local
+
+    def Thread(self, target, name=None, args=()):
+        clock = self.clock
+
+        class _Thread(object):
+            def start(self):
+                self._thread = clock.spawn(lambda: target(*args), name, 'sqswatcher')
+
+            def is_alive(self):
+                return self._thread.is_alive()
+
+            def join(self, timeout=None):
+                self._thread.join(timeout)
+
+        return _Thread()
+
+
+class ApiCalls(object):
+    """Counter of the calls to the AWS stand-ins and of the scheduler commands executed."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = collections.defaultdict(int)
+
+    def count(self, name):
+        with self._lock:
+            self.counts[name] += 1
+
+
+class FakeInstance(object):
+    def __init__(self, instance_id, private_ip, asg_name, launch_time, vcpus):
+        self.id = instance_id
+        self.instance_id = instance_id
+        self.private_dns_name = 'ip-%s.ec2.internal' % private_ip.replace('.', '-')
+        self.hostname = self.private_dns_name.split('.')[0]
+        self.tags = [{'Key': 'aws:autoscaling:groupName', 'Value': asg_name}]
+        self.launch_time = launch_time
+        self.vcpus = vcpus
+        self.state = 'pending'
+        self.ready_time = None
+        self.terminate_time = None
+        self.thread = None
+
+
+class FakeMessage(object):
+    def __init__(self, queue, body, visible_at):
+        self.queue = queue
+        self.message_id = str(uuid.uuid4())
+        self.receipt_handle = str(uuid.uuid4())
+        self.body = body
+        self.visible_at = visible_at
+        self.meta = _namespace(data={'MessageId': self.message_id, 'Body': body})
+
+    def delete(self):
+        self.queue.calls.count('sqs:DeleteMessage')
+        self.queue.forget(self.receipt_handle)
+
+
+class FakeQueue(object):
+    url = 'https://sqs.us-east-1.amazonaws.com/123456789012/simulation'
+
+    def __init__(self, clock, calls):
+        self.clock = clock
+        self.calls = calls
+        self._lock = threading.Lock()
+        self._messages = []
+        self._in_flight = {}
+        self._receivers = set()
+
+    def get_message(self, receipt_handle):
+        """Message resource built from the receipt handle of a received message."""
+        with self._lock:
+            return self._in_flight[receipt_handle]
+
+    def send_message(self, MessageBody, DelaySeconds=0):
+        self.calls.count('sqs:SendMessage')
+        with self._lock:
+            self._messages.append(FakeMessage(self, MessageBody, self.clock.now + DelaySeconds))
+            receivers = list(self._receivers)
+        for receiver in receivers:
+            self.clock.wake(receiver)
+
+    def notify(self, event):
+        """Publish an SNS notification to the queue."""
+        body = json.dumps({
+            'Type': 'Notification',
+            'MessageId': str(uuid.uuid4()),
+            'Timestamp': time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(self.clock.now)),
+            'Message': json.dumps(event),
+        })
+        with self._lock:
+            self._messages.append(FakeMessage(self, body, self.clock.now))
+            receivers = list(self._receivers)
+        for receiver in receivers:
+            self.clock.wake(receiver)
+
+    def forget(self, receipt_handle):
+        with self._lock:
+            self._in_flight.pop(receipt_handle, None)
+
+    def receive_messages(self, MaxNumberOfMessages=1, WaitTimeSeconds=0):
+        deadline = self.clock.now + WaitTimeSeconds
+        while True:
+            self.calls.count('sqs:ReceiveMessage')
+            with self._lock:
+                visible = [m for m in self._messages if m.visible_at <= self.clock.now][:MaxNumberOfMessages]
+                for message in visible:
+                    self._messages.remove(message)
+                    self._in_flight[message.receipt_handle] = message
+                if visible or self.clock.now >= deadline:
+                    self._receivers.discard(thread.get_ident())
+                    return visible
+                self._receivers.add(thread.get_ident())
+                delayed = [m.visible_at for m in self._messages]
+            time.sleep(min([deadline] + delayed) - self.clock.now)
+
+
+class FakeTable(object):
+    def __init__(self, name, calls):
+        self.name = name
+        self.calls = calls
+        self._lock = threading.Lock()
+        self._items = {}
+
+    def put_item(self, Item):
+        self.calls.count('dynamodb:PutItem')
+        with self._lock:
+            self._items[Item['instanceId']] = dict(Item)
+
+    def get_item(self, Key, ConsistentRead=False):
+        self.calls.count('dynamodb:GetItem')
+        with self._lock:
+            item = self._items.get(Key['instanceId'])
+        return {'Item': dict(item)} if item else {}
+
+    def delete_item(self, Key):
+        self.calls.count('dynamodb:DeleteItem')
+        with self._lock:
+            self._items.pop(Key['instanceId'], None)
+
+
+class FakeCloud(object):
+    """Auto Scaling group, EC2 instances, SQS queue and DynamoDB table of the simulated cluster."""
+
+    def __init__(self, clock, calls, asg_name, max_size, vcpus, boot_time, on_boot):
+        self.clock = clock
+        self.calls = calls
+        self.asg_name = asg_name
+        self.min_size = 0
+        self.max_size = max_size
+        self.desired = 0
+        self.vcpus = vcpus
+        self.boot_time = boot_time
+        self.on_boot = on_boot
+        self.lock = threading.RLock()
+        self.instances = collections.OrderedDict()
+        self.queue = FakeQueue(clock, calls)
+        self.table = FakeTable('instances', calls)
+        self._next_ip = itertools.count(10)
+
+    def _active(self):
+        return [i for i in self.instances.values() if i.state in ('pending', 'running')]
+
+    def _reconcile(self):
+        active = self._active()
+        for _ in range(self.desired - len(active)):
+            ip = next(self._next_ip)
+            instance = FakeInstance(
+                'i-%017x' % random.getrandbits(68), '10.0.%d.%d' % (ip // 250, ip % 250 + 4), self.asg_name,
+                self.clock.now, self.vcpus
+            )
+            instance.ready_time = self.clock.now + random.uniform(0.8, 1.2) * self.boot_time
+            self.instances[instance.id] = instance
+        for instance in reversed(active[self.desired:]):
+            self._terminate(instance)
+
+    def _terminate(self, instance):
+        instance.state = 'terminated'
+        instance.terminate_time = self.clock.now
+        if instance.thread:
+            self.clock.kill(instance.thread)
+        self.queue.notify({'Event': 'autoscaling:EC2_INSTANCE_TERMINATE', 'EC2InstanceId': instance.id})
+
+    def boot_loop(self):
+        """Complete the boot of the pending instances, as the node bootstrap would do."""
+        while True:
+            with self.lock:
+                pending = [i for i in self.instances.values() if i.state == 'pending']
+                for instance in pending:
+                    if instance.ready_time <= self.clock.now:
+                        instance.state = 'running'
+                        self.on_boot(instance)
+                        self.queue.notify({
+                            'Event': 'parallelcluster:COMPUTE_READY',
+                            'EC2InstanceId': instance.id,
+                            'Slots': instance.vcpus,
+                        })
+                next_boot = min([i.ready_time for i in pending if i.state == 'pending'] or [self.clock.now + 60])
+            time.sleep(max(next_boot - self.clock.now, 1))
+
+    # autoscaling
+    def describe_auto_scaling_groups(self, AutoScalingGroupNames):
+        self.calls.count('autoscaling:DescribeAutoScalingGroups')
+        with self.lock:
+            return {'AutoScalingGroups': [{
+                'AutoScalingGroupName': self.asg_name,
+                'MinSize': self.min_size,
+                'MaxSize': self.max_size,
+                'DesiredCapacity': self.desired,
+            }]}
+
+    def update_auto_scaling_group(self, AutoScalingGroupName, DesiredCapacity):
+        self.calls.count('autoscaling:UpdateAutoScalingGroup')
+        with self.lock:
+            self.desired = max(self.min_size, min(DesiredCapacity, self.max_size))
+            self._reconcile()
+
+    def terminate_instance_in_auto_scaling_group(self, InstanceId, ShouldDecrementDesiredCapacity):
+        self.calls.count('autoscaling:TerminateInstanceInAutoScalingGroup')
+        with self.lock:
+            instance = self.instances.get(InstanceId)
+            if instance and instance.state != 'terminated':
+                self._terminate(instance)
+                if ShouldDecrementDesiredCapacity:
+                    self.desired = max(self.min_size, self.desired - 1)
+                self._reconcile()
+
+    # ec2
+    def filter(self, InstanceIds=None, Filters=None):
+        self.calls.count('ec2:DescribeInstances')
+        with self.lock:
+            if InstanceIds is not None:
+                return [self.instances[i] for i in InstanceIds if i in self.instances]
+            # only the ASG and the running state filters are supported
+            return [i for i in self.instances.values() if i.state == 'running']
+
+    # cloudformation
+    def describe_stacks(self, StackName):
+        self.calls.count('cloudformation:DescribeStacks')
+        return {'Stacks': [{'StackName': StackName, 'StackStatus': 'CREATE_COMPLETE'}]}
+
+    # dynamodb
+    def list_tables(self):
+        self.calls.count('dynamodb:ListTables')
+        return {'TableNames': [self.table.name]}
+
+
+def _install_fake_modules(cloud):
+    """Register boto3, botocore and paramiko stand-ins, they must be installed before importing the daemons."""
+
+    class ClientError(Exception):
+        def __init__(self, error_response, operation_name):
+            Exception.__init__(self, "%s: %s" % (operation_name, error_response))
+            self.response = error_response
+            self.operation_name = operation_name
+
+    class BotoCoreError(Exception):
+        pass
+
+    class Config(object):
+        def __init__(self, **kwargs):
+            self.kwargs = kwargs
+
+    def client(service_name, **kwargs):
+        return cloud
+
+    def resource(service_name, **kwargs):
+        if service_name == 'sqs':
+            return _namespace(
+                get_queue_by_name=lambda QueueName: cloud.queue,
+                Queue=lambda url: cloud.queue,
+                Message=lambda url, receipt_handle: cloud.queue.get_message(receipt_handle),
+            )
+        if service_name == 'dynamodb':
+            return _namespace(Table=lambda name: cloud.table)
+        if service_name == 'ec2':
+            return _namespace(instances=cloud)
+        raise ValueError("Unsupported resource %s" % service_name)
+
+    class Session(object):
+        def resource(self, service_name, **kwargs):
+            return resource(service_name, **kwargs)
+
+    class PKey(object):
+        def get_name(self):
+            return 'ssh-rsa'
+
+        def get_base64(self):
+            return 'AAAAB3NzaC1yc2EAAAADAQABAAABAQ'
+
+    class SSHClient(object):
+        def set_missing_host_key_policy(self, policy):
+            pass
+
+        def connect(self, hostname, **kwargs):
+            cloud.calls.count('ssh:Connect')
+
+        def get_transport(self):
+            return _namespace(get_remote_server_key=PKey)
+
+        def exec_command(self, command):
+            cloud.calls.count('ssh:ExecCommand')
+            stdout = _namespace(channel=_namespace(exit_status_ready=lambda: True, recv_exit_status=lambda: 0))
+            return None, stdout, None
+
+        def close(self):
+            pass
+
+    modules = {
+        'boto3': _module('boto3', client=client, resource=resource),
+        'boto3.session': _module('boto3.session', Session=Session),
+        'botocore': _module('botocore'),
+        'botocore.config': _module('botocore.config', Config=Config),
+        'botocore.exceptions': _module(
+            'botocore.exceptions', BotoCoreError=BotoCoreError, ClientError=ClientError
+        ),
+        'paramiko': _module('paramiko', SSHClient=SSHClient, AutoAddPolicy=object),
+    }
+    modules['boto3'].session = modules['boto3.session']
+    modules['botocore'].config = modules['botocore.config']
+    modules['botocore'].exceptions = modules['botocore.exceptions']
+    sys.modules.update(modules)
+
+
+def _module(name, **attributes):
+    module = types.ModuleType(name)
+    module.__dict__.update(attributes)
+    return module
+
+
+def _namespace(**attributes):
+    namespace = _module('namespace')
+    namespace.__dict__.update(attributes)
+    return namespace
+
+
+class FakeNode(object):
+    def __init__(self, name, cpus):
+        self.name = name
+        self.cpus = cpus
+        self.hostname = None
+        self.jobs = set()
+        self.alloc_cpus = 0
+        self.drain = False
+        self.down = True
+
+    def state(self):
+        """:return: the long and short Slurm states of the node"""
+        if self.hostname is None:
+            return 'idle~', 'idle~'
+        if self.down:
+            return 'down', 'down'
+        if self.drain:
+            return ('draining', 'drng') if self.jobs else ('drained', 'drain')
+        if not self.jobs:
+            return 'idle', 'idle'
+        if self.alloc_cpus < self.cpus:
+            return 'mixed', 'mix'
+        return 'allocated', 'alloc'
+
+
+class FakeJob(object):
+    def __init__(self, job_id, submit_time, nodes, cpus, duration):
+        self.id = job_id
+        self.submit_time = submit_time
+        self.nodes = nodes
+        self.cpus = cpus
+        self.duration = duration
+        self.state = 'PD'
+        self.start_time = None
+        self.end_time = None
+        self.allocation = []
+
+
+class FakeSlurm(object):
+    """Simulated Slurm controller answering squeue, sinfo and scontrol."""
+
+    def __init__(self, clock, calls, pool_size, cpus, jobs):
+        self.clock = clock
+        self.calls = calls
+        self.lock = threading.RLock()
+        self.cpus = cpus
+        self.nodes = collections.OrderedDict()
+        for index in range(1, pool_size + 1):
+            name = 'compute-%d' % index
+            self.nodes[name] = FakeNode(name, cpus)
+        self.jobs = collections.OrderedDict()
+        self._arrivals = sorted(jobs, key=lambda job: job.submit_time)
+
+    # scheduling
+    def schedule_loop(self):
+        while True:
+            with self.lock:
+                now = self.clock.now
+                for job in self.jobs.values():
+                    if job.state == 'R' and job.start_time + job.duration <= now:
+                        self._complete(job)
+                while self._arrivals and self._arrivals[0].submit_time <= now:
+                    job = self._arrivals.pop(0)
+                    self.jobs[job.id] = job
+                self._schedule()
+                events = [j.start_time + j.duration for j in self.jobs.values() if j.state == 'R']
+                if self._arrivals:
+                    events.append(self._arrivals[0].submit_time)
+                next_event = min(events or [now + 60])
+            time.sleep(max(next_event - self.clock.now, 0.5))
+
+    def _complete(self, job):
+        job.state = 'CD'
+        job.end_time = self.clock.now
+        self._release(job)
+
+    def _release(self, job):
+        for node in job.allocation:
+            node.jobs.discard(job.id)
+            node.alloc_cpus -= job.cpus // job.nodes
+        job.allocation = []
+
+    def _schedule(self):
+        available = [n for n in self.nodes.values() if n.hostname and not n.down and not n.drain]
+        for job in self.jobs.values():
+            if job.state != 'PD':
+                continue
+            cpus_per_node = -(-job.cpus // job.nodes)
+            candidates = [n for n in available if n.cpus - n.alloc_cpus >= cpus_per_node][:job.nodes]
+            if len(candidates) < job.nodes:
+                continue
+            for node in candidates:
+                node.jobs.add(job.id)
+                node.alloc_cpus += cpus_per_node
+            job.allocation = candidates
+            job.state = 'R'
+            if job.start_time is None:
+                job.start_time = self.clock.now
+
+    def _requeue_jobs(self, node):
+        for job_id in list(node.jobs):
+            job = self.jobs[job_id]
+            self._release(job)
+            job.state = 'PD'
+
+    # commands
+    def execute(self, args, env=None, merge_stderr=False):
+        from common.scheduler_commands import CommandResult
+
+        command = os.path.basename(args[0])
+        self.calls.count('slurm:%s' % command)
+        handler = getattr(self, '_%s' % command, None)
+        if not handler:
+            return CommandResult(127, "%s: command not found\n" % command)
+        with self.lock:
+            return CommandResult(*handler(args[1:]))
+
+    @staticmethod
+    def _parse_options(args, flags):
+        options = {}
+        positional = []
+        args = list(args)
+        while args:
+            arg = args.pop(0)
+            if arg in flags:
+                options[arg] = True
+            elif arg.startswith('-'):
+                options[arg] = args.pop(0) if args else ''
+            else:
+                positional.append(arg)
+        return options, positional
+
+    @staticmethod
+    def _format(fmt, values):
+        return re.sub(r'%(\d*)([a-zA-Z])', lambda m: str(values.get(m.group(2), '')), fmt)
+
+    def _squeue(self, args):
+        options, _ = self._parse_options(args, ('-h', '--noheader', '-r'))
+        states = options.get('-t')
+        on_node = options.get('-w')
+        fmt = options.get('-o', '%i %t %D %C')
+        lines = []
+        for job in self.jobs.values():
+            if job.state == 'CD' or (states and job.state not in states.split(',')):
+                continue
+            if on_node and on_node not in [node.name for node in job.allocation]:
+                continue
+            lines.append(self._format(fmt, {
+                'i': job.id,
+                't': job.state,
+                'T': 'PENDING' if job.state == 'PD' else 'RUNNING',
+                'D': job.nodes,
+                'C': job.cpus,
+                'm': '0',
+                'b': '(null)',
+                'r': 'Resources' if job.state == 'PD' else 'None',
+                'N': ','.join(node.name for node in job.allocation),
+                'V': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(job.submit_time)),
+            }))
+        return 0, ''.join(line + '\n' for line in lines)
+
+    def _sinfo(self, args):
+        options, _ = self._parse_options(args, ('-h', '-N', '-r'))
+        fmt = options.get('-o', '%D %t')
+        names = self._expand(options['-n']) if '-n' in options else None
+        lines = []
+        groups = collections.OrderedDict()
+        for node in self.nodes.values():
+            if names is not None and node.name not in names:
+                continue
+            long_state, short_state = node.state()
+            if '-r' in options and (node.hostname is None or node.down):
+                continue
+            values = {
+                'N': node.name, 'n': node.hostname or node.name, 'T': long_state, 't': short_state, 'c': node.cpus,
+                'D': 1,
+            }
+            if '-N' in options:
+                lines.append(self._format(fmt, values))
+            else:
+                # one line per distinct set of values, %D being the number of nodes
+                key = self._format(fmt.replace('%D', ''), values)
+                if key in groups:
+                    groups[key]['D'] += 1
+                else:
+                    groups[key] = values
+        for values in groups.values():
+            lines.append(self._format(fmt, values))
+        return 0, ''.join(line + '\n' for line in lines)
+
+    def _scontrol(self, args):
+        if args[:2] == ['show', 'hostnames']:
+            return 0, ''.join(name + '\n' for name in self._expand(args[2]))
+        if args[:1] == ['reconfigure']:
+            return 0, ''
+        if args[:1] != ['update']:
+            return 1, 'unsupported scontrol command\n'
+
+        params = {}
+        for arg in args[1:]:
+            key, _, value = arg.partition('=')
+            params[key.lower()] = value
+        state = params.get('state', '').lower()
+        for name in self._expand(params.get('nodename', '')):
+            node = self.nodes.get(name)
+            if node is None:
+                return 1, 'Invalid node name specified\n'
+            if 'nodehostname' in params:
+                node.hostname = params['nodehostname']
+            if state == 'drain':
+                node.drain = True
+            elif state == 'resume':
+                node.drain = False
+                node.down = False
+            elif state == 'down':
+                node.down = True
+                node.drain = False
+                node.hostname = None
+                self._requeue_jobs(node)
+        self._schedule()
+        return 0, ''
+
+    def _expand(self, expression):
+        names = []
+        for part in re.findall(r'[^,\[]+(?:\[[^\]]*\])?', expression):
+            match = re.match(r'(.*)\[(\d+)-(\d+)\]$', part)
+            if match:
+                names.extend('%s%d' % (match.group(1), i) for i in range(int(match.group(2)), int(match.group(3)) + 1))
+            else:
+                names.append(part)
+        return names
+
+
+class DaemonExecutors(object):
+    """Stand-in for the shared scheduler command executor, keeping one executor per simulated host."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._executors = {}
+
+    def _get(self):
+        from common.scheduler_commands import CommandExecutor
+
+        name = getattr(_context, 'name', 'master')
+        with self._lock:
+            if name not in self._executors:
+                self._executors[name] = CommandExecutor()
+            return self._executors[name]
+
+    def run(self, args, env=None, merge_stderr=False):
+        return self._get().run(args, env, merge_stderr)
+
+    def invalidate(self):
+        self._get().invalidate()
+
+
+class NodeFilesystem(object):
+    """Stand-in for the os module in nodewatcher, mapping its state directories to a directory per simulated node."""
+
+    data_dirs = ('/var/run/nodewatcher/', '/var/lib/nodewatcher/')
+
+    def __init__(self, root):
+        self.root = root
+        self.path = _namespace(
+            exists=lambda p: os.path.exists(self.map(p)),
+            isfile=lambda p: os.path.isfile(self.map(p)),
+            isdir=lambda p: os.path.isdir(self.map(p)),
+            dirname=os.path.dirname,
+            join=os.path.join,
+        )
+
+    def map(self, path):
+        for data_dir in self.data_dirs:
+            if path.startswith(data_dir):
+                return os.path.join(self.root, getattr(_context, 'name', 'unknown'), data_dir.strip('/').split('/')[1],
+                                    path[len(data_dir):])
+        return path
+
+    def makedirs(self, path, *args):
+        os.makedirs(self.map(path), *args)
+
+    def remove(self, path):
+        os.remove(self.map(path))
+
+    def open(self, path, *args):
+        return open(self.map(path), *args)
+
+    def __getattr__(self, name):
+        return getattr(os, name)
+
+
+class Metrics(object):
+    """Time integrals of the cluster state, updated at every advance of the clock."""
+
+    def __init__(self, cloud, slurm):
+        self.cloud = cloud
+        self.slurm = slurm
+        self.instance_seconds = 0
+        self.booting_seconds = 0
+        self.idle_seconds = 0
+        self.busy_seconds = 0
+        self.peak_nodes = 0
+        self.peak_demand = 0
+        # (time, number of nodes available to the scheduler) at every change
+        self.available_nodes = []
+
+    def advance(self, previous, now):
+        elapsed = now - previous
+        instances = [i for i in self.cloud.instances.values() if i.state != 'terminated']
+        booting = len([i for i in instances if i.state == 'pending'])
+        available = [n for n in self.slurm.nodes.values() if n.hostname and not n.down]
+        busy = len([n for n in available if n.jobs])
+        self.instance_seconds += elapsed * len(instances)
+        self.booting_seconds += elapsed * booting
+        self.busy_seconds += elapsed * busy
+        self.idle_seconds += elapsed * (len(instances) - booting - busy)
+        self.peak_nodes = max(self.peak_nodes, len(instances))
+        # lower bound of the nodes required by the queued jobs
+        active = [j for j in self.slurm.jobs.values() if j.state in ('PD', 'R')]
+        demand = max([-(-sum(j.cpus for j in active) // self.slurm.cpus)] + [j.nodes for j in active])
+        self.peak_demand = max(self.peak_demand, demand)
+        if not self.available_nodes or self.available_nodes[-1][1] != len(available):
+            self.available_nodes.append((now, len(available)))
+
+
+def _percentile(values, percent):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(percent / 100.0 * (len(values) - 1))))]
+
+
+def _generate_jobs(args, start):
+    jobs = []
+    job_ids = itertools.count(1)
+    cpus = args.job_cpus or args.vcpus * args.job_nodes
+    if args.workload == 'burst':
+        for _ in range(args.jobs):
+            jobs.append(FakeJob(next(job_ids), start + args.submit_delay, args.job_nodes, cpus, args.job_duration))
+    elif args.workload == 'waves':
+        for wave in range(args.waves):
+            submit_time = start + args.submit_delay + wave * args.wave_interval
+            for _ in range(args.jobs):
+                jobs.append(FakeJob(next(job_ids), submit_time, args.job_nodes, cpus, args.job_duration))
+    else:
+        submit_time = start + args.submit_delay
+        while submit_time < start + args.submit_delay + args.arrival_window:
+            submit_time += random.expovariate(args.arrival_rate / 60.0)
+            duration = random.expovariate(1.0 / args.job_duration)
+            jobs.append(FakeJob(next(job_ids), submit_time, args.job_nodes, cpus, duration))
+    return jobs
+
+
+def _write_config(path, section, options, overrides):
+    options = dict(options)
+    for override in overrides:
+        target, _, value = override.partition('=')
+        override_section, _, key = target.partition('.')
+        if override_section == section:
+            options[key] = value
+    with open(path, 'w') as config_file:
+        config_file.write('[%s]\n' % section)
+        for key, value in sorted(options.items()):
+            config_file.write('%s = %s\n' % (key, value))
+
+
+def _setup_files(args, sim_dir, asg_name):
+    pricing_dir = os.path.join(sim_dir, 'pricing', 'instances')
+    os.makedirs(pricing_dir)
+    with open(os.path.join(pricing_dir, 'instances.json'), 'w') as pricing:
+        json.dump({args.instance_type: {'vcpus': str(args.vcpus), 'memory': '%d GiB' % (2 * args.vcpus)}}, pricing)
+    with open(os.path.join(sim_dir, 'cfnconfig'), 'w') as cfnconfig:
+        cfnconfig.write('cfn_scheduler_slots=vcpus\n')
+    with open(os.path.join(sim_dir, 'slurm.conf'), 'w') as slurm_conf:
+        slurm_conf.write('#NODEPOOL:compute\n')
+        slurm_conf.write('NodeName=compute-[1-%d] CPUs=%d State=CLOUD\n' % (args.max_size, args.vcpus))
+        slurm_conf.write('PartitionName=compute Nodes=compute-[1-%d] Default=YES MaxTime=INFINITE State=UP\n'
+                         % args.max_size)
+    os.makedirs(os.path.join(sim_dir, 'home', '.ssh'))
+
+    common = {
+        'region': 'us-east-1',
+        'scheduler': 'slurm',
+        'proxy': 'NONE',
+        'stack_name': 'simulation',
+        'latency_dir': os.path.join(sim_dir, 'latency'),
+        'cluster_state_file': os.path.join(sim_dir, 'cluster_state.json'),
+    }
+    _write_config(os.path.join(sim_dir, 'jobwatcher.cfg'), 'jobwatcher', dict(common, **{
+        'asg_name': asg_name,
+        'cfncluster_dir': os.path.join(sim_dir, 'pcluster'),
+        'compute_instance_type': args.instance_type,
+        'instances_source': os.path.join(sim_dir, 'pricing'),
+    }), args.option)
+    _write_config(os.path.join(sim_dir, 'sqswatcher.cfg'), 'sqswatcher', dict(common, **{
+        'sqsqueue': 'simulation',
+        'table_name': 'instances',
+        'cluster_user': 'simulation',
+        'journal_file': os.path.join(sim_dir, 'sqswatcher', 'events.journal'),
+    }), args.option)
+    _write_config(os.path.join(sim_dir, 'nodewatcher.cfg'), 'nodewatcher', dict(common, **{
+        'asg': asg_name,
+        'scaledown_idletime': args.scaledown_idletime,
+    }), args.option)
+
+
+def _report(args, clock, start, calls, metrics, slurm, cloud):
+    jobs = slurm.jobs.values()
+    started = [j for j in jobs if j.start_time is not None]
+    waits = [j.start_time - j.submit_time for j in started]
+    first_submit = min([j.submit_time for j in jobs] or [start])
+    target = min(metrics.peak_demand, args.max_size)
+    capacity_time = next((t for t, nodes in metrics.available_nodes if target and nodes >= target), None)
+    first_node = next((t for t, nodes in metrics.available_nodes if nodes > 0), None)
+    last_end = max([j.end_time for j in jobs if j.end_time] or [None])
+    scaled_in = next((t for t, nodes in metrics.available_nodes if last_end and t >= last_end and nodes == 0), None)
+    terminated = [i.terminate_time for i in cloud.instances.values() if i.terminate_time]
+
+    def _delay(instant, origin):
+        return "%.0f s" % (instant - origin) if instant is not None and origin is not None else "n/a"
+
+    print("Simulated %.0f minutes, %d jobs submitted, %d started, %d completed"
+          % ((clock.now - start) / 60, len(jobs), len(started), len([j for j in jobs if j.state == 'CD'])))
+    print("")
+    print("Scaling")
+    print("  peak demand:                   %d nodes" % metrics.peak_demand)
+    print("  peak fleet:                    %d instances" % metrics.peak_nodes)
+    print("  first node available after:    %s" % _delay(first_node, first_submit))
+    print("  time to capacity (%4d nodes): %s" % (target, _delay(capacity_time, first_submit)))
+    print("  scale-in to 0 after last job:  %s" % _delay(scaled_in, last_end))
+    print("  last termination after job:    %s" % _delay(max(terminated or [None]), last_end))
+    print("  instances launched:            %d" % len(cloud.instances))
+    print("  job wait p50/p90/p99:          %.0f / %.0f / %.0f s"
+          % (_percentile(waits, 50), _percentile(waits, 90), _percentile(waits, 99)))
+    print("")
+    print("Node-minutes")
+    print("  total:                         %.0f" % (metrics.instance_seconds / 60))
+    print("  booting:                       %.0f" % (metrics.booting_seconds / 60))
+    print("  busy:                          %.0f" % (metrics.busy_seconds / 60))
+    print("  idle:                          %.0f" % (metrics.idle_seconds / 60))
+    print("")
+    print("API calls and scheduler commands")
+    for name, count in sorted(calls.counts.items()):
+        print("  %-45s %d" % (name, count))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Simulate the scaling of a cluster driven by jobwatcher, sqswatcher and nodewatcher.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("--workload", choices=['burst', 'poisson', 'waves'], default='burst',
+                        help="burst: all the jobs submitted at once, poisson: random arrivals, waves: repeated bursts")
+    parser.add_argument("--jobs", type=int, default=200, help="number of jobs of the burst workload, or of each wave")
+    parser.add_argument("--waves", type=int, default=4, help="number of bursts of the waves workload")
+    parser.add_argument("--wave-interval", type=int, default=2700, help="seconds between two bursts")
+    parser.add_argument("--arrival-rate", type=float, default=10, help="jobs per minute of the poisson workload")
+    parser.add_argument("--arrival-window", type=int, default=3600, help="seconds of arrivals of the poisson workload")
+    parser.add_argument("--submit-delay", type=int, default=60, help="seconds before the first submission")
+    parser.add_argument("--job-nodes", type=int, default=1, help="nodes requested by each job")
+    parser.add_argument("--job-cpus", type=int, default=0,
+                        help="cpus requested by each job, all the cpus of its nodes if 0")
+    parser.add_argument("--job-duration", type=float, default=1800, help="(average) job duration in seconds")
+    parser.add_argument("--max-size", type=int, default=1000, help="ASG max size")
+    parser.add_argument("--instance-type", default='c5.xlarge', help="compute instance type")
+    parser.add_argument("--vcpus", type=int, default=4, help="vcpus of the compute instance type")
+    parser.add_argument("--boot-time", type=float, default=240,
+                        help="average seconds from launch to the COMPUTE_READY event")
+    parser.add_argument("--scaledown-idletime", type=int, default=10, help="nodewatcher scaledown_idletime, minutes")
+    parser.add_argument("--duration", type=float, default=6 * 3600, help="maximum simulated seconds")
+    parser.add_argument("--option", action='append', default=[], metavar="DAEMON.KEY=VALUE",
+                        help="override a daemon configuration option, e.g. jobwatcher.poll_interval_min=30")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    parser.add_argument("--log-file", help="file receiving the daemon logs, only warnings are printed otherwise")
+    parser.add_argument("--keep", action='store_true', help="keep the simulation directory")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    if args.log_file:
+        logging.basicConfig(filename=args.log_file, level=logging.INFO,
+                            format='%(asctime)s %(levelname)s %(threadName)s [%(module)s:%(funcName)s] %(message)s')
+    else:
+        logging.basicConfig(level=logging.WARNING, format='%(levelname)s %(threadName)s %(message)s')
+    # 1000 simulated nodes mean 1000 threads
+    threading.stack_size(512 * 1024)
+
+    start = 1546300800.0
+    clock = VirtualClock(start)
+    calls = ApiCalls()
+    sim_dir = tempfile.mkdtemp(prefix='scaling-simulation-')
+    asg_name = 'simulation-ComputeFleet'
+
+    def boot(instance):
+        _start_nodewatcher(clock, instance, nodewatcher)
+
+    cloud = FakeCloud(clock, calls, asg_name, args.max_size, args.vcpus, args.boot_time, boot)
+    slurm = FakeSlurm(clock, calls, args.max_size, args.vcpus, _generate_jobs(args, start))
+    _install_fake_modules(cloud)
+    _setup_files(args, sim_dir, asg_name)
+
+    # virtual time for every daemon, the threading and Queue internals keep the real time
+    time.time = clock.time
+    time.sleep = clock.sleep
+
+    import ConfigParser
+
+    read = ConfigParser.RawConfigParser.read
+
+    def read_simulation_config(self, filenames):
+        if isinstance(filenames, basestring):
+            filenames = [filenames]
+        return read(self, [os.path.join(sim_dir, os.path.basename(f)) if f.startswith('/etc/') else f
+                           for f in filenames])
+
+    ConfigParser.RawConfigParser.read = read_simulation_config
+
+    import common.latency as latency
+    import common.scheduler_commands
+    import common.utils
+    import jobwatcher.jobwatcher as jobwatcher
+    import nodewatcher.nodewatcher as nodewatcher
+    import sqswatcher.known_hosts as known_hosts
+    import sqswatcher.plugins.slurm as slurm_plugin
+    import sqswatcher.sqswatcher as sqswatcher
+
+    common.scheduler_commands.CommandExecutor._execute = staticmethod(slurm.execute)
+    common.scheduler_commands.executor = DaemonExecutors()
+    jobwatcher.cfnconfig_file = os.path.join(sim_dir, 'cfnconfig')
+    sqswatcher.signal = _namespace(signal=lambda signum, handler: None, SIGTERM=15, SIGINT=2)
+    sqswatcher.threading = SimulatedThreading(clock)
+    sqswatcher.Queue = SimulatedQueue(clock)
+    slurm_plugin.slurm_conf = os.path.join(sim_dir, 'slurm.conf')
+    slurm_plugin.node_map_file = os.path.join(sim_dir, 'sqswatcher', 'slurm_nodes.json')
+    known_hosts._managers['simulation'] = known_hosts.KnownHostsManager(
+        os.path.join(sim_dir, 'home', '.ssh', 'known_hosts')
+    )
+    filesystem = NodeFilesystem(os.path.join(sim_dir, 'nodes'))
+    nodewatcher.os = filesystem
+    nodewatcher.open = filesystem.open
+    nodewatcher.atomic_write = lambda path, data: common.utils.atomic_write(filesystem.map(path), data)
+    nodewatcher.monotonic = clock.time
+    nodewatcher._get_metadata = _get_metadata(calls)
+
+    metrics = Metrics(cloud, slurm)
+    clock.spawn(cloud.boot_loop, 'cloud', 'cloud')
+    clock.spawn(slurm.schedule_loop, 'slurm', 'slurm')
+    clock.spawn(jobwatcher.main, 'jobwatcher', 'jobwatcher')
+    clock.spawn(sqswatcher.main, 'sqswatcher', 'sqswatcher')
+
+    def finished():
+        done = slurm.jobs and not slurm._arrivals and all(j.state == 'CD' for j in slurm.jobs.values())
+        if not done or [i for i in cloud.instances.values() if i.state != 'terminated']:
+            return False
+        # wait for sqswatcher to remove the terminated instances from the scheduler
+        return not [n for n in slurm.nodes.values() if n.hostname]
+
+    wall_start = _wall_clock()
+    try:
+        clock.run(start + args.duration, metrics.advance, finished)
+        # record the changes made after the last advance
+        metrics.advance(clock.now, clock.now)
+        _report(args, clock, start, calls, metrics, slurm, cloud)
+        print("")
+        print("Scale-up latency breakdown, in seconds")
+        records = latency.read_records(glob.glob(os.path.join(sim_dir, 'latency', '*.jsonl')))
+        print(latency.format_report(latency.compute_latencies(records)))
+        print("")
+        print("Completed in %.1f seconds of wall time" % (_wall_clock() - wall_start))
+    finally:
+        if args.keep:
+            print("Simulation files kept in %s" % sim_dir)
+        else:
+            shutil.rmtree(sim_dir, ignore_errors=True)
+        sys.stdout.flush()
+        # the simulated threads never return
+        os._exit(0)
+
+
+def _wall_clock():
+    return os.times()[4]
+
+
+def _get_metadata(calls):
+    def get_metadata(metadata_path):
+        calls.count('imds:GetMetadata')
+        return _context.instance.instance_id if metadata_path == 'instance-id' else _context.instance.private_dns_name
+
+    return get_metadata
+
+
+def _start_nodewatcher(clock, instance, nodewatcher):
+    def run():
+        _context.instance = instance
+        nodewatcher.main()
+
+    instance.thread = clock.spawn(run, 'nodewatcher-%s' % instance.hostname, instance.id)
+
+
+if __name__ == '__main__':
+    main()